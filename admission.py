@@ -0,0 +1,121 @@
+# Контроль допуска обновлений
+# После простоя или перезапуска Telegram отдает накопившиеся обновления, в том
+# числе нажатия кнопок, сделанные, пока бот не работал. Возраст обновления
+# считается от момента его получения процессом (у нажатий кнопок нет своего
+# времени): нажатия, слишком долго ждавшие в очереди, и нажатия из очереди,
+# накопившейся до запуска процесса, отбрасываются до вызова обработчиков.
+# Повторные нажатия одной кнопки гасятся, а при глубокой очереди дорогие
+# действия выполняются в облегченном режиме (по закэшированным курсам).
+import asyncio
+import time
+
+DEFAULT_CALLBACK_MAX_WAIT = 60
+DEFAULT_MESSAGE_MAX_AGE = 300
+DEFAULT_DEBOUNCE_INTERVAL = 1.0
+DEFAULT_QUEUE_DEPTH_LIMIT = 50
+DEFAULT_STARTUP_WINDOW = 10
+MAX_TRACKED_PRESSES = 10000
+MAX_TRACKED_RECEIPTS = 100000
+
+ADMIT = "admit"
+STALE = "stale"
+DEBOUNCED = "debounced"
+
+
+class AdmissionControl:
+    """
+    :param callback_max_wait: Нажатия, ждавшие обработки дольше этого времени (с)
+        с момента получения, считаются устаревшими.
+    :param message_max_age: Текстовые сообщения старше этого времени (с) отбрасываются.
+    :param debounce_interval: Повторное нажатие той же кнопки раньше этого
+        времени (с) не обрабатывается.
+    :param route_debounce: Интервалы для отдельных маршрутов {код маршрута: секунды}.
+    :param queue_depth_limit: Очередь глубже этого значения считается перегрузкой.
+    :param startup_window: Сколько секунд после запуска процесса приходит очередь,
+        накопившаяся, пока бот не работал.
+    """
+
+    def __init__(self, callback_max_wait=DEFAULT_CALLBACK_MAX_WAIT, message_max_age=DEFAULT_MESSAGE_MAX_AGE,
+                 debounce_interval=DEFAULT_DEBOUNCE_INTERVAL, route_debounce=None,
+                 queue_depth_limit=DEFAULT_QUEUE_DEPTH_LIMIT, startup_window=DEFAULT_STARTUP_WINDOW):
+        self.callback_max_wait = callback_max_wait
+        self.message_max_age = message_max_age
+        self.debounce_interval = debounce_interval
+        self.route_debounce = dict(route_debounce or {})
+        self.queue_depth_limit = queue_depth_limit
+        self.startup_window = startup_window
+        self.started_at = None
+        self.last_presses = {}
+        self.receipts = {}
+
+    # Момент, с которого процесс принимает обновления
+    def mark_started(self, now=None):
+        self.started_at = now or time.time()
+
+    # Запоминание времени получения обновления (первое значение не перезаписывается)
+    def stamp(self, update_id, received_at=None):
+        if update_id is None:
+            return
+        if len(self.receipts) >= MAX_TRACKED_RECEIPTS:
+            self.receipts.clear()
+        self.receipts.setdefault(update_id, received_at or time.time())
+
+    def pop_receipt(self, update_id):
+        return self.receipts.pop(update_id, None)
+
+    # Проверка нажатия кнопки
+    def check_callback(self, user_id, data, route, received_at, message_time, now=None):
+        """
+        :param route: Код маршрута кнопки (для интервала подавления повторов).
+        :param received_at: Время получения обновления процессом (unix) или None.
+        :param message_time: Время последнего изменения сообщения с кнопкой (unix).
+        :return: ADMIT, STALE или DEBOUNCED.
+        """
+        now = now or time.time()
+        received_at = received_at or now
+        if now - received_at > self.callback_max_wait:
+            return STALE
+        # Очередь, накопившаяся до запуска: приходит сразу после старта и
+        # относится к сообщениям, которые не менялись с тех пор, как бот работал
+        if (self.started_at and received_at - self.started_at < self.startup_window
+                and message_time and message_time < self.started_at):
+            return STALE
+
+        key = (user_id, data)
+        interval = self.route_debounce.get(route, self.debounce_interval)
+        last_press = self.last_presses.get(key)
+        if last_press is not None and now - last_press < interval:
+            return DEBOUNCED
+        self.last_presses[key] = now
+        if len(self.last_presses) > MAX_TRACKED_PRESSES:
+            self._prune(now)
+        return ADMIT
+
+    # Проверка текстового сообщения (у сообщений есть время отправки)
+    def check_message(self, message_time, now=None):
+        now = now or time.time()
+        if message_time and now - message_time > self.message_max_age:
+            return STALE
+        return ADMIT
+
+    def is_overloaded(self, queue_depth):
+        return queue_depth > self.queue_depth_limit
+
+    # Удаление старых записей о нажатиях
+    def _prune(self, now):
+        horizon = max([self.debounce_interval, *self.route_debounce.values()])
+        self.last_presses = {key: pressed for key, pressed in self.last_presses.items() if now - pressed < horizon}
+
+
+class ReceiptQueue(asyncio.Queue):
+    """
+    Очередь обновлений Application, запоминающая время получения каждого обновления.
+    """
+
+    def __init__(self, admission):
+        super().__init__()
+        self.admission = admission
+
+    def put_nowait(self, item):
+        self.admission.stamp(getattr(item, "update_id", None))
+        super().put_nowait(item)
@@ -0,0 +1,192 @@
+# Ценовые оповещения пользователей
+# Оповещения хранятся в отсортированных индексах порогов по каждой паре валют,
+# поэтому при обновлении курсов проверяются только пороги, которые курс
+# действительно пересек между старым и новым значением.
+import json
+import logging
+import os
+import time
+from bisect import bisect_left, bisect_right, insort
+
+logger = logging.getLogger(__name__)
+
+ABOVE = ">"
+BELOW = "<"
+
+
+# Индекс порогов для одной пары валют
+class _PairIndex:
+    """
+    Два отсортированных списка (порог, id оповещения): для роста и для падения,
+    плюс последний известный курс пары.
+    """
+
+    __slots__ = ("above", "below", "last_rate")
+
+    def __init__(self, last_rate=None):
+        self.above = []
+        self.below = []
+        self.last_rate = last_rate
+
+    def __bool__(self):
+        return bool(self.above or self.below)
+
+
+class AlertIndex:
+    """
+    Хранилище ценовых оповещений с сохранением на диск.
+
+    Оповещение "BTC > 70000 USD" срабатывает, когда курс пересекает порог
+    снизу вверх, "EUR < 95 RUB" - когда курс опускается ниже порога.
+    Сработавшие оповещения удаляются.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self.alerts = {}
+        self.pairs = {}
+        self._next_id = 1
+        self.load()
+
+    # Загрузка оповещений из файла
+    def load(self):
+        if not os.path.exists(self.path):
+            return
+        try:
+            with open(self.path, "r", encoding="utf-8") as f:
+                data = json.load(f)
+        except (OSError, ValueError) as e:
+            logger.error(f"Ошибка при загрузке оповещений из {self.path}: {e}")
+            return
+
+        self._next_id = data.get("next_id", 1)
+        for pair_key, rate in data.get("last_rates", {}).items():
+            base, quote = pair_key.split("/")
+            self.pairs[(base, quote)] = _PairIndex(rate)
+        for alert in data.get("alerts", []):
+            self._index(alert)
+        logger.info(f"Загружено оповещений: {len(self.alerts)}")
+
+    # Сохранение оповещений в файл (атомарная замена)
+    def save(self):
+        data = {
+            "next_id": self._next_id,
+            "alerts": list(self.alerts.values()),
+            "last_rates": {
+                f"{base}/{quote}": index.last_rate
+                for (base, quote), index in self.pairs.items()
+                if index and index.last_rate is not None
+            },
+        }
+        directory = os.path.dirname(self.path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        tmp_path = f"{self.path}.tmp"
+        try:
+            with open(tmp_path, "w", encoding="utf-8") as f:
+                json.dump(data, f, ensure_ascii=False)
+            os.replace(tmp_path, self.path)
+        except OSError as e:
+            logger.error(f"Ошибка при сохранении оповещений в {self.path}: {e}")
+
+    def _index(self, alert):
+        self.alerts[alert["id"]] = alert
+        pair = (alert["base"], alert["quote"])
+        index = self.pairs.get(pair)
+        if index is None:
+            index = self.pairs[pair] = _PairIndex()
+        thresholds = index.above if alert["direction"] == ABOVE else index.below
+        insort(thresholds, (alert["threshold"], alert["id"]))
+
+    def _unindex(self, alert):
+        index = self.pairs.get((alert["base"], alert["quote"]))
+        if index is None:
+            return
+        thresholds = index.above if alert["direction"] == ABOVE else index.below
+        entry = (alert["threshold"], alert["id"])
+        position = bisect_left(thresholds, entry)
+        if position < len(thresholds) and thresholds[position] == entry:
+            del thresholds[position]
+
+    # Добавление оповещения
+    def add(self, chat_id, base, quote, direction, threshold, current_rate=None):
+        """
+        Создает оповещение и возвращает его.
+
+        :param current_rate: Текущий курс пары; становится точкой отсчета для
+            проверки пересечения порога.
+        """
+        alert = {
+            "id": self._next_id,
+            "chat_id": chat_id,
+            "base": base,
+            "quote": quote,
+            "direction": direction,
+            "threshold": float(threshold),
+            "created": int(time.time()),
+        }
+        self._next_id += 1
+        self._index(alert)
+        if current_rate is not None:
+            self.pairs[(base, quote)].last_rate = current_rate
+        self.save()
+        return alert
+
+    # Удаление оповещения пользователя
+    def remove(self, chat_id, alert_id):
+        alert = self.alerts.get(alert_id)
+        if alert is None or alert["chat_id"] != chat_id:
+            return False
+        self._unindex(alert)
+        del self.alerts[alert_id]
+        self.save()
+        return True
+
+    def list_for_chat(self, chat_id):
+        return [alert for alert in self.alerts.values() if alert["chat_id"] == chat_id]
+
+    def count_for_chat(self, chat_id):
+        return sum(1 for alert in self.alerts.values() if alert["chat_id"] == chat_id)
+
+    # Проверка оповещений после обновления курсов
+    def evaluate(self, get_rate):
+        """
+        Сравнивает новые курсы пар с предыдущими и возвращает сработавшие
+        оповещения, удаляя их из индекса.
+
+        :param get_rate: Функция (base, quote) -> курс или None.
+        :return: Список сработавших оповещений с полем "rate".
+        """
+        fired = []
+        for (base, quote), index in self.pairs.items():
+            if not index:
+                continue
+            new_rate = get_rate(base, quote)
+            if new_rate is None:
+                continue
+            old_rate = index.last_rate
+            index.last_rate = new_rate
+            if old_rate is None or old_rate == new_rate:
+                continue
+
+            if new_rate > old_rate:
+                # Рост: пороги из [old, new) пересечены снизу вверх
+                lo = bisect_left(index.above, (old_rate,))
+                hi = bisect_left(index.above, (new_rate,))
+                crossed = index.above[lo:hi]
+                del index.above[lo:hi]
+            else:
+                # Падение: пороги из (new, old] пересечены сверху вниз
+                lo = bisect_right(index.below, (new_rate, float("inf")))
+                hi = bisect_right(index.below, (old_rate, float("inf")))
+                crossed = index.below[lo:hi]
+                del index.below[lo:hi]
+
+            for _, alert_id in crossed:
+                alert = self.alerts.pop(alert_id)
+                alert["rate"] = new_rate
+                fired.append(alert)
+
+        if fired:
+            self.save()
+        return fired
@@ -0,0 +1,122 @@
+# Сравнение стандартного и быстрого режима (см. fast_runtime.py)
+# Запуск: python bench_runtime.py [--iterations N]
+# Каждый режим выполняется в отдельном процессе, потому что политика цикла
+# событий устанавливается на весь процесс.
+import argparse
+import asyncio
+import json
+import random
+import subprocess
+import sys
+import time
+
+import fast_runtime
+
+
+# Ответы API, похожие на настоящие по размеру и структуре
+def build_payloads():
+    rng = random.Random(42)
+    codes = [f"C{i:02d}{chr(65 + i % 26)}" for i in range(160)]
+    exchange_rates = {"base": "USD", "date": "2024-01-01", "rates": {code: rng.uniform(0.01, 5000) for code in codes}}
+    coingecko = {f"coin-{i}": {"usd": rng.uniform(0.0001, 70000)} for i in range(250)}
+    coinmarketcap = {
+        "data": {
+            f"SYM{i}": {
+                "id": i,
+                "name": f"Coin {i}",
+                "symbol": f"SYM{i}",
+                "quote": {"USD": {"price": rng.uniform(0.0001, 70000), "volume_24h": rng.uniform(1, 1e9),
+                                  "percent_change_24h": rng.uniform(-20, 20), "market_cap": rng.uniform(1e6, 1e12)}},
+            }
+            for i in range(250)
+        }
+    }
+    snapshot = {
+        "world": exchange_rates["rates"],
+        "regional": exchange_rates["rates"],
+        "crypto": {f"SYM{i}": rng.uniform(0.0001, 70000) for i in range(250)},
+        "last_update_world": time.time(),
+        "last_update_regional": time.time(),
+        "last_update_crypto": time.time(),
+        "crypto_coins": [{"id": f"coin-{i}", "symbol": f"SYM{i}", "name": f"Coin {i}"} for i in range(250)],
+    }
+    # Тексты ответов одинаковы для обоих режимов
+    return {
+        "exchange_rates": json.dumps(exchange_rates),
+        "coingecko": json.dumps(coingecko),
+        "coinmarketcap": json.dumps(coinmarketcap),
+    }, snapshot
+
+
+def measure(func, iterations):
+    started = time.perf_counter()
+    for _ in range(iterations):
+        func()
+    return (time.perf_counter() - started) / iterations
+
+
+# Нагрузка на цикл событий: обмен через очередь и переключения задач
+async def loop_workload(messages):
+    queue = asyncio.Queue()
+
+    async def producer():
+        for i in range(messages):
+            await queue.put(i)
+        await queue.put(None)
+
+    async def consumer():
+        while await queue.get() is not None:
+            await asyncio.sleep(0)
+
+    started = time.perf_counter()
+    await asyncio.gather(producer(), consumer())
+    return time.perf_counter() - started
+
+
+def run_mode(mode, iterations):
+    if mode == "fast":
+        fast_runtime.enable_fast_runtime()
+    payloads, snapshot = build_payloads()
+    results = {}
+    for name, text in payloads.items():
+        results[f"разбор {name} ({len(text) // 1024} КБ)"] = measure(lambda: fast_runtime.loads(text), iterations)
+    snapshot_text = fast_runtime.dumps(snapshot)
+    results["запись снимка курсов"] = measure(lambda: fast_runtime.dumps(snapshot), iterations)
+    results["чтение снимка курсов"] = measure(lambda: fast_runtime.loads(snapshot_text), iterations)
+    results["цикл событий (100k сообщений)"] = asyncio.run(loop_workload(100000))
+    header = f"{mode}: JSON - {fast_runtime.codec}, цикл событий - {fast_runtime.loop_implementation}"
+    return header, results
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Сравнение стандартного и быстрого режима")
+    parser.add_argument("--iterations", type=int, default=2000)
+    parser.add_argument("--mode", choices=["std", "fast"], help="Выполнить только один режим (используется внутри)")
+    args = parser.parse_args()
+
+    if args.mode:
+        header, results = run_mode(args.mode, args.iterations)
+        print(header)
+        for name, seconds in results.items():
+            print(f"{name}\t{seconds}")
+        return
+
+    runs = {}
+    for mode in ("std", "fast"):
+        output = subprocess.run(
+            [sys.executable, __file__, "--mode", mode, "--iterations", str(args.iterations)],
+            capture_output=True, text=True, check=True,
+        ).stdout.splitlines()
+        runs[mode] = (output[0], dict((name, float(value)) for name, value in (line.split("\t") for line in output[1:])))
+
+    print(runs["std"][0])
+    print(runs["fast"][0])
+    print()
+    print(f"{'операция':<40} {'std, мкс':>12} {'fast, мкс':>12} {'ускорение':>10}")
+    for name, std_seconds in runs["std"][1].items():
+        fast_seconds = runs["fast"][1][name]
+        print(f"{name:<40} {std_seconds * 1e6:12.1f} {fast_seconds * 1e6:12.1f} {std_seconds / fast_seconds:9.2f}x")
+
+
+if __name__ == "__main__":
+    main()
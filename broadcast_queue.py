@@ -0,0 +1,188 @@
+# Очередь массовой рассылки сообщений
+# Каждая рассылка хранится на диске (тексты + список получателей) вместе с
+# позицией, до которой она уже отправлена, поэтому после перезапуска бота
+# рассылка продолжается с места остановки.
+import asyncio
+import json
+import logging
+import os
+import time
+
+logger = logging.getLogger(__name__)
+
+MESSAGES_PER_SECOND = 25  # Лимит Telegram для рассылок - около 30 сообщений в секунду
+CHUNK_SIZE = 10  # Сколько сообщений отправляется одновременно
+MAX_RETRIES = 3
+
+PRIORITY_ALERT = 0
+PRIORITY_DIGEST = 1
+
+
+class BroadcastQueue:
+    """
+    Персистентная очередь рассылок с ограничением скорости отправки.
+
+    Рассылка - это набор текстов и список получателей (chat_id, ключ текста),
+    так что пользователи с одинаковым содержимым разделяют один текст.
+    Рассылки с меньшим приоритетом обрабатываются первыми; срочные сообщения
+    (оповещения) обгоняют идущую длинную рассылку.
+    """
+
+    def __init__(self, path, on_forbidden=None, messages_per_second=MESSAGES_PER_SECOND):
+        self.path = path
+        self.on_forbidden = on_forbidden
+        self.interval = CHUNK_SIZE / messages_per_second
+        self.broadcasts = {}
+        self.sent_total = 0
+        self.failed_total = 0
+        self._wakeup = asyncio.Event()
+        self._next_chunk_at = 0.0
+        self._load()
+
+    # Восстановление незавершенных рассылок после перезапуска
+    def _load(self):
+        if not os.path.isdir(self.path):
+            return
+        for filename in sorted(os.listdir(self.path)):
+            if not filename.endswith(".json"):
+                continue
+            broadcast_id = filename[:-len(".json")]
+            try:
+                with open(os.path.join(self.path, filename), "r", encoding="utf-8") as f:
+                    broadcast = json.load(f)
+            except (OSError, ValueError) as e:
+                logger.error(f"Поврежденная рассылка {filename}: {e}")
+                continue
+            broadcast["position"] = self._read_position(broadcast_id)
+            self.broadcasts[broadcast_id] = broadcast
+        if self.broadcasts:
+            pending = sum(self._remaining(b) for b in self.broadcasts.values())
+            logger.info(f"Восстановлено рассылок: {len(self.broadcasts)}, осталось сообщений: {pending}")
+
+    def _read_position(self, broadcast_id):
+        try:
+            with open(os.path.join(self.path, f"{broadcast_id}.pos"), "r") as f:
+                return int(f.read().strip() or 0)
+        except (OSError, ValueError):
+            return 0
+
+    def _write_position(self, broadcast_id, position):
+        pos_path = os.path.join(self.path, f"{broadcast_id}.pos")
+        tmp_path = f"{pos_path}.tmp"
+        with open(tmp_path, "w") as f:
+            f.write(str(position))
+        os.replace(tmp_path, pos_path)
+
+    def _remove(self, broadcast_id):
+        self.broadcasts.pop(broadcast_id, None)
+        for ext in (".json", ".pos"):
+            try:
+                os.remove(os.path.join(self.path, f"{broadcast_id}{ext}"))
+            except FileNotFoundError:
+                pass
+
+    @staticmethod
+    def _remaining(broadcast):
+        return len(broadcast["recipients"]) - broadcast["position"]
+
+    def depth(self):
+        """
+        Количество сообщений, ожидающих отправки.
+        """
+        return sum(self._remaining(b) for b in self.broadcasts.values())
+
+    # Постановка рассылки в очередь
+    def enqueue(self, texts, recipients, priority=PRIORITY_DIGEST):
+        """
+        Сохраняет рассылку на диск и будит обработчик очереди.
+
+        :param texts: Словарь {ключ: текст сообщения}.
+        :param recipients: Список пар (chat_id, ключ текста).
+        :param priority: Приоритет (меньше - срочнее).
+        :return: Идентификатор рассылки.
+        """
+        if not recipients:
+            return None
+        broadcast_id = f"{priority}-{time.time_ns()}"
+        broadcast = {
+            "priority": priority,
+            "texts": {str(key): text for key, text in texts.items()},
+            "recipients": [[chat_id, str(key)] for chat_id, key in recipients],
+        }
+        os.makedirs(self.path, exist_ok=True)
+        tmp_path = os.path.join(self.path, f"{broadcast_id}.json.tmp")
+        with open(tmp_path, "w", encoding="utf-8") as f:
+            json.dump(broadcast, f, ensure_ascii=False)
+        os.replace(tmp_path, os.path.join(self.path, f"{broadcast_id}.json"))
+        broadcast["position"] = 0
+        self.broadcasts[broadcast_id] = broadcast
+        self._wakeup.set()
+        logger.info(f"Рассылка {broadcast_id} поставлена в очередь: {len(recipients)} получателей")
+        return broadcast_id
+
+    def _next_broadcast(self):
+        if not self.broadcasts:
+            return None
+        return min(self.broadcasts, key=lambda b: (self.broadcasts[b]["priority"], b))
+
+    # Отправка одного сообщения с повторами при превышении лимитов
+    async def _send(self, bot, chat_id, text):
+        from telegram.error import Forbidden, RetryAfter, BadRequest
+
+        for _ in range(MAX_RETRIES):
+            try:
+                await bot.send_message(chat_id=chat_id, text=text)
+                self.sent_total += 1
+                return
+            except RetryAfter as e:
+                retry_after = e.retry_after
+                if hasattr(retry_after, "total_seconds"):
+                    retry_after = retry_after.total_seconds()
+                logger.warning("Превышен лимит Telegram, пауза %s с.", retry_after)
+                await asyncio.sleep(retry_after)
+            except Forbidden:
+                logger.info("Чат %s заблокировал бота, сообщение пропущено.", chat_id)
+                if self.on_forbidden:
+                    self.on_forbidden(chat_id)
+                break
+            except BadRequest as e:
+                logger.error("Ошибка при отправке сообщения в чат %s: %s", chat_id, e)
+                break
+            except Exception as e:
+                logger.error("Ошибка при отправке сообщения в чат %s: %s", chat_id, e)
+                await asyncio.sleep(1)
+        self.failed_total += 1
+
+    # Основной цикл обработки очереди
+    async def run(self, bot):
+        """
+        Отправляет рассылки пачками по CHUNK_SIZE сообщений с паузой между
+        пачками; позиция сохраняется после каждой пачки.
+        """
+        while True:
+            broadcast_id = self._next_broadcast()
+            if broadcast_id is None:
+                self._wakeup.clear()
+                await self._wakeup.wait()
+                continue
+
+            broadcast = self.broadcasts[broadcast_id]
+            start = broadcast["position"]
+            chunk = broadcast["recipients"][start:start + CHUNK_SIZE]
+            if not chunk:
+                self._remove(broadcast_id)
+                logger.info(f"Рассылка {broadcast_id} завершена.")
+                continue
+
+            delay = self._next_chunk_at - time.monotonic()
+            if delay > 0:
+                await asyncio.sleep(delay)
+            self._next_chunk_at = time.monotonic() + self.interval
+
+            texts = broadcast["texts"]
+            await asyncio.gather(*(self._send(bot, chat_id, texts[key]) for chat_id, key in chunk))
+            broadcast["position"] = start + len(chunk)
+            try:
+                self._write_position(broadcast_id, broadcast["position"])
+            except OSError as e:
+                logger.error(f"Ошибка при сохранении позиции рассылки {broadcast_id}: {e}")
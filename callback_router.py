@@ -0,0 +1,94 @@
+# Маршрутизация нажатий inline-кнопок
+# Данные кнопки кодируются компактно: "<версия>:<маршрут>[:<аргумент>...]",
+# например "1:f:USD". Обработчик находится по коду маршрута в словаре, поэтому
+# число маршрутов не влияет на время разбора, а кнопки старых версий клавиатур
+# (и любые неизвестные данные) отсекаются до вызова обработчиков.
+import logging
+
+logger = logging.getLogger(__name__)
+
+CALLBACK_VERSION = "1"
+SEPARATOR = ":"
+MAX_CALLBACK_DATA = 64  # Ограничение Telegram на размер callback_data в байтах
+
+
+# Кодирование данных кнопки
+def encode_callback(route, *args):
+    """
+    :param route: Код маршрута.
+    :param args: Аргументы маршрута (без символа-разделителя).
+    :return: Строка для callback_data.
+    """
+    data = SEPARATOR.join((CALLBACK_VERSION, route) + tuple(str(arg) for arg in args))
+    if len(data.encode("utf-8")) > MAX_CALLBACK_DATA:
+        raise ValueError(f"Слишком длинные данные кнопки: {data}")
+    return data
+
+
+# Разбор данных кнопки
+def decode_callback(data):
+    """
+    :return: Пара (код маршрута, список аргументов) или None для данных
+        другой версии и неверного формата.
+    """
+    if not data:
+        return None
+    parts = data.split(SEPARATOR)
+    if len(parts) < 2 or parts[0] != CALLBACK_VERSION:
+        return None
+    return parts[1], parts[2:]
+
+
+class CallbackRouter:
+    """
+    Таблица маршрутов: код -> (обработчик, число аргументов).
+    Обработчик вызывается как handler(query, context, *args).
+    """
+
+    def __init__(self):
+        self.routes = {}
+        self.stale_handler = None
+
+    def route(self, code, args=0):
+        """
+        Декоратор регистрации обработчика маршрута.
+
+        :param code: Код маршрута (короткий, чтобы данные кнопки укладывались в 64 байта).
+        :param args: Ожидаемое число аргументов.
+        """
+        def decorator(handler):
+            if code in self.routes:
+                raise ValueError(f"Маршрут {code} уже зарегистрирован")
+            self.routes[code] = (handler, args)
+            return handler
+        return decorator
+
+    def stale(self, handler):
+        """
+        Декоратор обработчика устаревших и неизвестных кнопок.
+        """
+        self.stale_handler = handler
+        return handler
+
+    def resolve(self, data):
+        """
+        :return: Пара (обработчик, аргументы) или None.
+        """
+        decoded = decode_callback(data)
+        if decoded is None:
+            return None
+        code, args = decoded
+        entry = self.routes.get(code)
+        if entry is None or len(args) != entry[1]:
+            return None
+        return entry[0], args
+
+    async def dispatch(self, query, context):
+        resolved = self.resolve(query.data)
+        if resolved is None:
+            logger.info(f"Устаревшая или неизвестная кнопка: {query.data!r}")
+            if self.stale_handler:
+                await self.stale_handler(query, context)
+            return
+        handler, args = resolved
+        await handler(query, context, *args)
@@ -0,0 +1,152 @@
+# Набор поддерживаемых криптовалют
+# Список монет загружается из рейтинга CoinGecko по капитализации (топ-N)
+# и используется всеми обработчиками через общий индекс символ -> id.
+import asyncio
+import json
+import logging
+import os
+import time
+
+from loop_monitor import read_json
+from metrics import metrics
+from refresh_scheduler import api_budgets
+
+logger = logging.getLogger(__name__)
+
+COINGECKO_MARKETS_URL = "https://api.coingecko.com/api/v3/coins/markets"
+MARKETS_PAGE_SIZE = 250  # Максимальный размер страницы CoinGecko
+
+# Монеты по умолчанию, пока рейтинг не загружен
+DEFAULT_COINS = [
+    {"id": "bitcoin", "symbol": "BTC", "name": "Bitcoin"},
+    {"id": "ethereum", "symbol": "ETH", "name": "Ethereum"},
+    {"id": "binancecoin", "symbol": "BNB", "name": "Binance Coin"},
+    {"id": "ripple", "symbol": "XRP", "name": "Ripple"},
+    {"id": "cardano", "symbol": "ADA", "name": "Cardano"},
+]
+
+
+# Разбиение списка на части фиксированного размера
+def chunked(items, size):
+    for start in range(0, len(items), size):
+        yield items[start:start + size]
+
+
+class CryptoUniverse:
+    """
+    Топ-N монет по капитализации с индексами символ -> id и id -> символ.
+    Порядок монет соответствует рейтингу; при совпадении символов
+    побеждает монета с большей капитализацией. Сохраненный список
+    подгружается вызовом load().
+    """
+
+    def __init__(self, top_n, path=None, excluded_symbols=()):
+        self.top_n = top_n
+        self.path = path
+        self.excluded_symbols = set(excluded_symbols)
+        self.loaded_at = 0
+        self.set_coins(DEFAULT_COINS)
+
+    def set_coins(self, coins):
+        self.coins = []
+        self.symbol_to_id = {}
+        self.id_to_symbol = {}
+        self.names = {}
+        for coin in coins:
+            symbol = coin["symbol"].upper()
+            if symbol in self.symbol_to_id or symbol in self.excluded_symbols:
+                continue
+            self.coins.append({"id": coin["id"], "symbol": symbol, "name": coin["name"]})
+            self.symbol_to_id[symbol] = coin["id"]
+            self.id_to_symbol[coin["id"]] = symbol
+            self.names[symbol] = coin["name"]
+            if len(self.coins) >= self.top_n:
+                break
+
+    def __contains__(self, symbol):
+        return symbol in self.symbol_to_id
+
+    def __len__(self):
+        return len(self.coins)
+
+    # Символы монет в порядке капитализации
+    def symbols(self, limit=None):
+        symbols = [coin["symbol"] for coin in self.coins]
+        return symbols[:limit] if limit else symbols
+
+    def ids(self):
+        return [coin["id"] for coin in self.coins]
+
+    # Загрузка сохраненного списка монет
+    def load(self):
+        if not self.path or not os.path.exists(self.path):
+            return
+        try:
+            with open(self.path, "r", encoding="utf-8") as f:
+                data = json.load(f)
+            self.set_coins(data["coins"])
+            self.loaded_at = data.get("loaded_at", 0)
+            logger.info(f"Загружен список криптовалют из {self.path}: {len(self.coins)} монет")
+        except (OSError, ValueError, KeyError) as e:
+            logger.error(f"Ошибка при загрузке списка криптовалют из {self.path}: {e}")
+
+    def save(self):
+        if not self.path:
+            return
+        directory = os.path.dirname(self.path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        tmp_path = f"{self.path}.tmp"
+        try:
+            with open(tmp_path, "w", encoding="utf-8") as f:
+                json.dump({"loaded_at": self.loaded_at, "coins": self.coins}, f, ensure_ascii=False)
+            os.replace(tmp_path, self.path)
+        except OSError as e:
+            logger.error(f"Ошибка при сохранении списка криптовалют в {self.path}: {e}")
+
+    # Загрузка одной страницы рейтинга
+    async def _fetch_page(self, session, page, per_page):
+        params = {
+            "vs_currency": "usd",
+            "order": "market_cap_desc",
+            "per_page": per_page,
+            "page": page,
+        }
+        api_budgets.spend("coingecko")
+        with metrics.track("coingecko_markets"):
+            async with session.get(COINGECKO_MARKETS_URL, params=params) as response:
+                if response.status != 200:
+                    raise RuntimeError(f"статус {response.status}")
+                return await read_json(response)
+
+    # Обновление списка монет из рейтинга CoinGecko
+    async def refresh(self, session, max_age=0):
+        """
+        Загружает топ-N монет; страницы рейтинга запрашиваются параллельно.
+
+        :param max_age: Не обновлять, если список загружен менее max_age секунд назад.
+        :return: True, если список обновлен.
+        """
+        if max_age and time.time() - self.loaded_at < max_age:
+            return False
+        # Запрашиваем с запасом: часть монет может быть отброшена из-за совпадения символов
+        wanted = self.top_n + max(10, self.top_n // 10)
+        per_page = min(MARKETS_PAGE_SIZE, wanted)
+        pages = range(1, (wanted + per_page - 1) // per_page + 1)
+        if not api_budgets.allow("coingecko", len(pages)):
+            return False
+        try:
+            results = await asyncio.gather(*(self._fetch_page(session, page, per_page) for page in pages))
+        except Exception as e:
+            logger.error(f"Ошибка при загрузке рейтинга криптовалют CoinGecko: {e}")
+            return False
+
+        coins = [coin for page in results for coin in page if coin.get("id") and coin.get("symbol")]
+        if not coins:
+            logger.error("Пустой рейтинг криптовалют от CoinGecko.")
+            return False
+        self.set_coins(coins)
+        self.loaded_at = time.time()
+        self.save()
+        logger.info(f"Список криптовалют обновлен: {len(self.coins)} монет")
+        return True
@@ -0,0 +1,258 @@
+# Справочник валют ISO 4217 и поисковый индекс по ним
+# Поиск идет по коду, русскому и английскому названию и стране;
+# индекс префиксов строится один раз, поэтому запрос - это несколько
+# обращений к словарю, а не перебор всех валют.
+import logging
+
+logger = logging.getLogger(__name__)
+
+# Код: (название, английское название, страна)
+ISO_CURRENCIES = {
+    "AED": ("Дирхам ОАЭ", "UAE Dirham", "Объединенные Арабские Эмираты"),
+    "AFN": ("Афганский афгани", "Afghan Afghani", "Афганистан"),
+    "ALL": ("Албанский лек", "Albanian Lek", "Албания"),
+    "AMD": ("Армянский драм", "Armenian Dram", "Армения"),
+    "ANG": ("Нидерландский антильский гульден", "Netherlands Antillean Guilder", "Кюрасао"),
+    "AOA": ("Ангольская кванза", "Angolan Kwanza", "Ангола"),
+    "ARS": ("Аргентинское песо", "Argentine Peso", "Аргентина"),
+    "AUD": ("Австралийский доллар", "Australian Dollar", "Австралия"),
+    "AWG": ("Арубанский флорин", "Aruban Florin", "Аруба"),
+    "AZN": ("Азербайджанский манат", "Azerbaijani Manat", "Азербайджан"),
+    "BAM": ("Конвертируемая марка", "Bosnia-Herzegovina Convertible Mark", "Босния и Герцеговина"),
+    "BBD": ("Барбадосский доллар", "Barbadian Dollar", "Барбадос"),
+    "BDT": ("Бангладешская така", "Bangladeshi Taka", "Бангладеш"),
+    "BGN": ("Болгарский лев", "Bulgarian Lev", "Болгария"),
+    "BHD": ("Бахрейнский динар", "Bahraini Dinar", "Бахрейн"),
+    "BIF": ("Бурундийский франк", "Burundian Franc", "Бурунди"),
+    "BMD": ("Бермудский доллар", "Bermudan Dollar", "Бермуды"),
+    "BND": ("Брунейский доллар", "Brunei Dollar", "Бруней"),
+    "BOB": ("Боливийский боливиано", "Bolivian Boliviano", "Боливия"),
+    "BRL": ("Бразильский реал", "Brazilian Real", "Бразилия"),
+    "BSD": ("Багамский доллар", "Bahamian Dollar", "Багамы"),
+    "BTN": ("Бутанский нгултрум", "Bhutanese Ngultrum", "Бутан"),
+    "BWP": ("Ботсванская пула", "Botswanan Pula", "Ботсвана"),
+    "BYN": ("Белорусский рубль", "Belarusian Ruble", "Беларусь"),
+    "BZD": ("Белизский доллар", "Belize Dollar", "Белиз"),
+    "CAD": ("Канадский доллар", "Canadian Dollar", "Канада"),
+    "CDF": ("Конголезский франк", "Congolese Franc", "ДР Конго"),
+    "CHF": ("Швейцарский франк", "Swiss Franc", "Швейцария"),
+    "CLP": ("Чилийское песо", "Chilean Peso", "Чили"),
+    "CNY": ("Китайский юань", "Chinese Yuan", "Китай"),
+    "COP": ("Колумбийское песо", "Colombian Peso", "Колумбия"),
+    "CRC": ("Костариканский колон", "Costa Rican Colon", "Коста-Рика"),
+    "CUP": ("Кубинское песо", "Cuban Peso", "Куба"),
+    "CVE": ("Эскудо Кабо-Верде", "Cape Verdean Escudo", "Кабо-Верде"),
+    "CZK": ("Чешская крона", "Czech Koruna", "Чехия"),
+    "DJF": ("Франк Джибути", "Djiboutian Franc", "Джибути"),
+    "DKK": ("Датская крона", "Danish Krone", "Дания"),
+    "DOP": ("Доминиканское песо", "Dominican Peso", "Доминиканская Республика"),
+    "DZD": ("Алжирский динар", "Algerian Dinar", "Алжир"),
+    "EGP": ("Египетский фунт", "Egyptian Pound", "Египет"),
+    "ERN": ("Эритрейская накфа", "Eritrean Nakfa", "Эритрея"),
+    "ETB": ("Эфиопский быр", "Ethiopian Birr", "Эфиопия"),
+    "EUR": ("Евро", "Euro", "Евросоюз"),
+    "FJD": ("Доллар Фиджи", "Fijian Dollar", "Фиджи"),
+    "FKP": ("Фунт Фолклендских островов", "Falkland Islands Pound", "Фолклендские острова"),
+    "FOK": ("Фарерская крона", "Faroese Krona", "Фарерские острова"),
+    "GBP": ("Британский фунт стерлингов", "British Pound Sterling", "Великобритания"),
+    "GEL": ("Грузинский лари", "Georgian Lari", "Грузия"),
+    "GGP": ("Гернсийский фунт", "Guernsey Pound", "Гернси"),
+    "GHS": ("Ганский седи", "Ghanaian Cedi", "Гана"),
+    "GIP": ("Гибралтарский фунт", "Gibraltar Pound", "Гибралтар"),
+    "GMD": ("Гамбийский даласи", "Gambian Dalasi", "Гамбия"),
+    "GNF": ("Гвинейский франк", "Guinean Franc", "Гвинея"),
+    "GTQ": ("Гватемальский кетсаль", "Guatemalan Quetzal", "Гватемала"),
+    "GYD": ("Гайанский доллар", "Guyanaese Dollar", "Гайана"),
+    "HKD": ("Гонконгский доллар", "Hong Kong Dollar", "Гонконг"),
+    "HNL": ("Гондурасская лемпира", "Honduran Lempira", "Гондурас"),
+    "HRK": ("Хорватская куна", "Croatian Kuna", "Хорватия"),
+    "HTG": ("Гаитянский гурд", "Haitian Gourde", "Гаити"),
+    "HUF": ("Венгерский форинт", "Hungarian Forint", "Венгрия"),
+    "IDR": ("Индонезийская рупия", "Indonesian Rupiah", "Индонезия"),
+    "ILS": ("Израильский шекель", "Israeli New Shekel", "Израиль"),
+    "IMP": ("Мэнский фунт", "Manx Pound", "Остров Мэн"),
+    "INR": ("Индийская рупия", "Indian Rupee", "Индия"),
+    "IQD": ("Иракский динар", "Iraqi Dinar", "Ирак"),
+    "IRR": ("Иранский риал", "Iranian Rial", "Иран"),
+    "ISK": ("Исландская крона", "Icelandic Krona", "Исландия"),
+    "JEP": ("Джерсийский фунт", "Jersey Pound", "Джерси"),
+    "JMD": ("Ямайский доллар", "Jamaican Dollar", "Ямайка"),
+    "JOD": ("Иорданский динар", "Jordanian Dinar", "Иордания"),
+    "JPY": ("Японская иена", "Japanese Yen", "Япония"),
+    "KES": ("Кенийский шиллинг", "Kenyan Shilling", "Кения"),
+    "KGS": ("Киргизский сом", "Kyrgystani Som", "Киргизия"),
+    "KHR": ("Камбоджийский риель", "Cambodian Riel", "Камбоджа"),
+    "KID": ("Доллар Кирибати", "Kiribati Dollar", "Кирибати"),
+    "KMF": ("Коморский франк", "Comorian Franc", "Коморы"),
+    "KRW": ("Южнокорейская вона", "South Korean Won", "Южная Корея"),
+    "KWD": ("Кувейтский динар", "Kuwaiti Dinar", "Кувейт"),
+    "KYD": ("Доллар Каймановых островов", "Cayman Islands Dollar", "Каймановы острова"),
+    "KZT": ("Казахстанский тенге", "Kazakhstani Tenge", "Казахстан"),
+    "LAK": ("Лаосский кип", "Laotian Kip", "Лаос"),
+    "LBP": ("Ливанский фунт", "Lebanese Pound", "Ливан"),
+    "LKR": ("Шри-ланкийская рупия", "Sri Lankan Rupee", "Шри-Ланка"),
+    "LRD": ("Либерийский доллар", "Liberian Dollar", "Либерия"),
+    "LSL": ("Лоти Лесото", "Lesotho Loti", "Лесото"),
+    "LYD": ("Ливийский динар", "Libyan Dinar", "Ливия"),
+    "MAD": ("Марокканский дирхам", "Moroccan Dirham", "Марокко"),
+    "MDL": ("Молдавский лей", "Moldovan Leu", "Молдова"),
+    "MGA": ("Малагасийский ариари", "Malagasy Ariary", "Мадагаскар"),
+    "MKD": ("Македонский денар", "Macedonian Denar", "Северная Македония"),
+    "MMK": ("Мьянманский кьят", "Myanmar Kyat", "Мьянма"),
+    "MNT": ("Монгольский тугрик", "Mongolian Tugrik", "Монголия"),
+    "MOP": ("Патака Макао", "Macanese Pataca", "Макао"),
+    "MRU": ("Мавританская угия", "Mauritanian Ouguiya", "Мавритания"),
+    "MUR": ("Маврикийская рупия", "Mauritian Rupee", "Маврикий"),
+    "MVR": ("Мальдивская руфия", "Maldivian Rufiyaa", "Мальдивы"),
+    "MWK": ("Малавийская квача", "Malawian Kwacha", "Малави"),
+    "MXN": ("Мексиканское песо", "Mexican Peso", "Мексика"),
+    "MYR": ("Малайзийский ринггит", "Malaysian Ringgit", "Малайзия"),
+    "MZN": ("Мозамбикский метикал", "Mozambican Metical", "Мозамбик"),
+    "NAD": ("Намибийский доллар", "Namibian Dollar", "Намибия"),
+    "NGN": ("Нигерийская наира", "Nigerian Naira", "Нигерия"),
+    "NIO": ("Никарагуанская кордоба", "Nicaraguan Cordoba", "Никарагуа"),
+    "NOK": ("Норвежская крона", "Norwegian Krone", "Норвегия"),
+    "NPR": ("Непальская рупия", "Nepalese Rupee", "Непал"),
+    "NZD": ("Новозеландский доллар", "New Zealand Dollar", "Новая Зеландия"),
+    "OMR": ("Оманский риал", "Omani Rial", "Оман"),
+    "PAB": ("Панамский бальбоа", "Panamanian Balboa", "Панама"),
+    "PEN": ("Перуанский соль", "Peruvian Sol", "Перу"),
+    "PGK": ("Кина Папуа — Новой Гвинеи", "Papua New Guinean Kina", "Папуа — Новая Гвинея"),
+    "PHP": ("Филиппинское песо", "Philippine Peso", "Филиппины"),
+    "PKR": ("Пакистанская рупия", "Pakistani Rupee", "Пакистан"),
+    "PLN": ("Польский злотый", "Polish Zloty", "Польша"),
+    "PYG": ("Парагвайский гуарани", "Paraguayan Guarani", "Парагвай"),
+    "QAR": ("Катарский риал", "Qatari Rial", "Катар"),
+    "RON": ("Румынский лей", "Romanian Leu", "Румыния"),
+    "RSD": ("Сербский динар", "Serbian Dinar", "Сербия"),
+    "RUB": ("Российский рубль", "Russian Ruble", "Россия"),
+    "RWF": ("Франк Руанды", "Rwandan Franc", "Руанда"),
+    "SAR": ("Саудовский риял", "Saudi Riyal", "Саудовская Аравия"),
+    "SBD": ("Доллар Соломоновых островов", "Solomon Islands Dollar", "Соломоновы острова"),
+    "SCR": ("Сейшельская рупия", "Seychellois Rupee", "Сейшелы"),
+    "SDG": ("Суданский фунт", "Sudanese Pound", "Судан"),
+    "SEK": ("Шведская крона", "Swedish Krona", "Швеция"),
+    "SGD": ("Сингапурский доллар", "Singapore Dollar", "Сингапур"),
+    "SHP": ("Фунт Святой Елены", "Saint Helena Pound", "Остров Святой Елены"),
+    "SLE": ("Леоне Сьерра-Леоне", "Sierra Leonean Leone", "Сьерра-Леоне"),
+    "SLL": ("Леоне Сьерра-Леоне (старый)", "Sierra Leonean Leone (old)", "Сьерра-Леоне"),
+    "SOS": ("Сомалийский шиллинг", "Somali Shilling", "Сомали"),
+    "SRD": ("Суринамский доллар", "Surinamese Dollar", "Суринам"),
+    "SSP": ("Южносуданский фунт", "South Sudanese Pound", "Южный Судан"),
+    "STN": ("Добра Сан-Томе и Принсипи", "Sao Tome and Principe Dobra", "Сан-Томе и Принсипи"),
+    "SYP": ("Сирийский фунт", "Syrian Pound", "Сирия"),
+    "SZL": ("Свазилендский лилангени", "Swazi Lilangeni", "Эсватини"),
+    "THB": ("Тайский бат", "Thai Baht", "Таиланд"),
+    "TJS": ("Таджикский сомони", "Tajikistani Somoni", "Таджикистан"),
+    "TMT": ("Туркменский манат", "Turkmenistani Manat", "Туркменистан"),
+    "TND": ("Тунисский динар", "Tunisian Dinar", "Тунис"),
+    "TOP": ("Тонганская паанга", "Tongan Paanga", "Тонга"),
+    "TRY": ("Турецкая лира", "Turkish Lira", "Турция"),
+    "TTD": ("Доллар Тринидада и Тобаго", "Trinidad and Tobago Dollar", "Тринидад и Тобаго"),
+    "TVD": ("Доллар Тувалу", "Tuvaluan Dollar", "Тувалу"),
+    "TWD": ("Новый тайваньский доллар", "New Taiwan Dollar", "Тайвань"),
+    "TZS": ("Танзанийский шиллинг", "Tanzanian Shilling", "Танзания"),
+    "UAH": ("Украинская гривна", "Ukrainian Hryvnia", "Украина"),
+    "UGX": ("Угандийский шиллинг", "Ugandan Shilling", "Уганда"),
+    "USD": ("Американский доллар", "US Dollar", "США"),
+    "UYU": ("Уругвайское песо", "Uruguayan Peso", "Уругвай"),
+    "UZS": ("Узбекский сум", "Uzbekistan Som", "Узбекистан"),
+    "VES": ("Венесуэльский боливар", "Venezuelan Bolivar", "Венесуэла"),
+    "VND": ("Вьетнамский донг", "Vietnamese Dong", "Вьетнам"),
+    "VUV": ("Вату Вануату", "Vanuatu Vatu", "Вануату"),
+    "WST": ("Самоанская тала", "Samoan Tala", "Самоа"),
+    "XAF": ("Франк КФА BEAC", "Central African CFA Franc", "Центральная Африка"),
+    "XCD": ("Восточно-карибский доллар", "East Caribbean Dollar", "Восточные Карибы"),
+    "XDR": ("Специальные права заимствования", "Special Drawing Rights", "МВФ"),
+    "XOF": ("Франк КФА BCEAO", "West African CFA Franc", "Западная Африка"),
+    "XPF": ("Франк КФП", "CFP Franc", "Французская Полинезия"),
+    "YER": ("Йеменский риал", "Yemeni Rial", "Йемен"),
+    "ZAR": ("Южноафриканский рэнд", "South African Rand", "ЮАР"),
+    "ZMW": ("Замбийская квача", "Zambian Kwacha", "Замбия"),
+    "ZWL": ("Доллар Зимбабве", "Zimbabwean Dollar", "Зимбабве"),
+}
+
+# Валюты, для которых флаг нельзя получить из первых двух букв кода
+SPECIAL_FLAGS = {
+    "EUR": "🇪🇺",
+    "ANG": "🇨🇼",
+    "XAF": "🌍",
+    "XOF": "🌍",
+    "XCD": "🌎",
+    "XDR": "🌐",
+    "XPF": "🇵🇫",
+}
+
+
+# Флаг страны по коду валюты
+def currency_flag(code):
+    """
+    Первые две буквы кода ISO 4217 - это код страны ISO 3166, из которого
+    собирается флаг из региональных индикаторов.
+    """
+    if code in SPECIAL_FLAGS:
+        return SPECIAL_FLAGS[code]
+    if code not in ISO_CURRENCIES:
+        return ""
+    return "".join(chr(0x1F1E6 + ord(letter) - ord("A")) for letter in code[:2])
+
+
+# Нормализация текста для поиска
+def normalize(text):
+    return text.lower().replace("ё", "е").replace("—", " ").replace("-", " ").replace("(", " ").replace(")", " ")
+
+
+class CurrencyIndex:
+    """
+    Индекс префиксов слов: каждому префиксу каждого слова (код, названия,
+    страна) сопоставлено множество кодов валют.
+    """
+
+    def __init__(self):
+        self.entries = {}
+        self.prefixes = {}
+        self.order = {}
+
+    # Построение индекса
+    def build(self, currencies):
+        """
+        :param currencies: Итерируемое из (код, название, английское название, страна)
+            в порядке популярности - он используется для сортировки результатов.
+        """
+        self.entries = {}
+        self.prefixes = {}
+        self.order = {}
+        for position, (code, name, english_name, country) in enumerate(currencies):
+            if code in self.entries:
+                continue
+            self.entries[code] = (name, english_name, country)
+            self.order[code] = position
+            for word in set(normalize(f"{code} {name} {english_name} {country}").split()):
+                for length in range(1, len(word) + 1):
+                    self.prefixes.setdefault(word[:length], set()).add(code)
+        logger.info(f"Поисковый индекс валют построен: {len(self.entries)} валют, {len(self.prefixes)} префиксов")
+
+    def __contains__(self, code):
+        return code in self.entries
+
+    def name(self, code):
+        entry = self.entries.get(code)
+        return entry[0] if entry else code
+
+    # Поиск валют по запросу
+    def search(self, query, limit=10):
+        """
+        Каждое слово запроса - префикс слова из описания валюты; результат
+        - пересечение множеств по всем словам. Точное совпадение кода идет первым.
+        """
+        words = normalize(query).split()
+        if not words:
+            return []
+        matches = None
+        for word in words:
+            codes = self.prefixes.get(word, set())
+            matches = codes if matches is None else matches & codes
+            if not matches:
+                return []
+        exact = query.strip().upper()
+        return sorted(matches, key=lambda code: (code != exact, self.order[code]))[:limit]
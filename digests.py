@@ -0,0 +1,117 @@
+# Подписки на ежедневные дайджесты курсов
+import json
+import logging
+import os
+
+logger = logging.getLogger(__name__)
+
+MAX_DIGEST_CURRENCIES = 10
+DEFAULT_DIGEST_TIME = "09:00"
+
+
+# Проверка времени вида ЧЧ:ММ
+def parse_digest_time(value):
+    """
+    Возвращает время в виде строки 'ЧЧ:ММ' или None, если формат неверный.
+    """
+    parts = value.split(":")
+    if len(parts) != 2 or not all(part.isdigit() for part in parts):
+        return None
+    hours, minutes = int(parts[0]), int(parts[1])
+    if not (0 <= hours < 24 and 0 <= minutes < 60):
+        return None
+    return f"{hours:02d}:{minutes:02d}"
+
+
+class DigestSubscriptions:
+    """
+    Подписки пользователей на дайджест: набор валют и время отправки.
+    Набор валют хранится отсортированным, чтобы пользователи с одинаковым
+    выбором попадали в одну группу и получали один и тот же текст.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self.subscriptions = {}
+        self.load()
+
+    def load(self):
+        if not os.path.exists(self.path):
+            return
+        try:
+            with open(self.path, "r", encoding="utf-8") as f:
+                data = json.load(f)
+        except (OSError, ValueError) as e:
+            logger.error(f"Ошибка при загрузке подписок из {self.path}: {e}")
+            return
+        self.subscriptions = {int(chat_id): subscription for chat_id, subscription in data.items()}
+        logger.info(f"Загружено подписок на дайджест: {len(self.subscriptions)}")
+
+    def save(self):
+        directory = os.path.dirname(self.path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        tmp_path = f"{self.path}.tmp"
+        try:
+            with open(tmp_path, "w", encoding="utf-8") as f:
+                json.dump({str(chat_id): s for chat_id, s in self.subscriptions.items()}, f, ensure_ascii=False)
+            os.replace(tmp_path, self.path)
+        except OSError as e:
+            logger.error(f"Ошибка при сохранении подписок в {self.path}: {e}")
+
+    def __len__(self):
+        return len(self.subscriptions)
+
+    def get(self, chat_id):
+        return self.subscriptions.get(chat_id)
+
+    # Оформление или изменение подписки
+    def subscribe(self, chat_id, currencies, send_time=DEFAULT_DIGEST_TIME, today=None, now_time=None):
+        """
+        :param today: Текущая дата 'ГГГГ-ММ-ДД' и now_time - текущее время 'ЧЧ:ММ':
+            новая подписка, время которой сегодня уже прошло, начинается с завтрашнего дня.
+        """
+        subscription = {
+            "currencies": sorted(set(currencies)),
+            "time": send_time,
+            "last_sent": None,
+        }
+        previous = self.subscriptions.get(chat_id)
+        if previous:
+            # Дайджест, уже отправленный сегодня, не повторяется после смены времени
+            subscription["last_sent"] = previous["last_sent"]
+        elif today and now_time and send_time <= now_time:
+            subscription["last_sent"] = today
+        self.subscriptions[chat_id] = subscription
+        self.save()
+        return subscription
+
+    def unsubscribe(self, chat_id):
+        if self.subscriptions.pop(chat_id, None) is None:
+            return False
+        self.save()
+        return True
+
+    # Поиск подписок, которым пора отправить дайджест
+    def due(self, today, now_time):
+        """
+        Группирует подписчиков, у которых время отправки наступило, а
+        дайджест за сегодня еще не отправлялся.
+
+        :param today: Дата в виде 'ГГГГ-ММ-ДД'.
+        :param now_time: Текущее время 'ЧЧ:ММ'.
+        :return: Словарь {кортеж валют: [chat_id, ...]}.
+        """
+        groups = {}
+        for chat_id, subscription in self.subscriptions.items():
+            if subscription["last_sent"] == today or subscription["time"] > now_time:
+                continue
+            groups.setdefault(tuple(subscription["currencies"]), []).append(chat_id)
+        return groups
+
+    def mark_sent(self, chat_ids, today):
+        for chat_id in chat_ids:
+            subscription = self.subscriptions.get(chat_id)
+            if subscription:
+                subscription["last_sent"] = today
+        self.save()
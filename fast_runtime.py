@@ -0,0 +1,53 @@
+# Быстрый режим работы (включается через FAST_RUNTIME=1 или --fast)
+# uvloop вместо стандартного цикла событий asyncio и orjson вместо модуля json
+# для ответов API и сохраняемых снимков. Обе библиотеки необязательны: если
+# какой-то нет, используется стандартная реализация.
+import asyncio
+import json
+import logging
+
+logger = logging.getLogger(__name__)
+
+codec = "json"
+loop_implementation = "asyncio"
+
+
+def loads(data):
+    return json.loads(data)
+
+
+def dumps(obj):
+    return json.dumps(obj, ensure_ascii=False)
+
+
+# Включение быстрого режима
+def enable_fast_runtime():
+    """
+    Подключает orjson и uvloop, если они установлены. Вызывается до запуска
+    цикла событий.
+
+    :return: Пара (кодек JSON, реализация цикла событий).
+    """
+    global loads, dumps, codec, loop_implementation
+    try:
+        import orjson
+
+        def orjson_dumps(obj):
+            return orjson.dumps(obj).decode("utf-8")
+
+        loads = orjson.loads
+        dumps = orjson_dumps
+        codec = "orjson"
+    except ImportError:
+        logger.warning("orjson не установлен, используется стандартный модуль json.")
+
+    try:
+        import uvloop
+
+        asyncio.set_event_loop_policy(uvloop.EventLoopPolicy())
+        loop_implementation = "uvloop"
+    except ImportError:
+        logger.warning("uvloop не установлен, используется стандартный цикл событий asyncio.")
+
+    logger.info(f"Быстрый режим: JSON - {codec}, цикл событий - {loop_implementation}.")
+    return codec, loop_implementation
@@ -0,0 +1,125 @@
+# Избранные валютные пары пользователей
+# Пара попадает в избранное, если пользователь закрепил ее кнопкой, или
+# если он часто ее конвертирует. Закрепленные пары показываются первыми.
+import json
+import logging
+import os
+from collections import OrderedDict
+
+logger = logging.getLogger(__name__)
+
+MAX_PINNED_PAIRS = 5
+MAX_COUNTED_PAIRS = 10  # Сколько пар со счетчиками хранится на пользователя
+MIN_LEARNED_COUNT = 2  # Сколько конвертаций нужно, чтобы пара попала в избранное
+DEFAULT_MAX_USERS = 100000
+
+
+class FavoritePairs:
+    """
+    Для каждого пользователя: список закрепленных пар и счетчики конвертаций.
+    Счетчики меняются при каждой конвертации, поэтому файл пишется не сразу,
+    а вызовом flush() (периодически и при остановке бота). Хранятся данные не
+    больше max_users пользователей: при превышении вытесняются те, кто дольше
+    всех не пользовался ботом.
+    """
+
+    def __init__(self, path, max_users=DEFAULT_MAX_USERS):
+        self.path = path
+        self.max_users = max_users
+        self.users = OrderedDict()
+        self.evicted = 0
+        self.dirty = False
+        self.load()
+
+    def load(self):
+        if not os.path.exists(self.path):
+            return
+        try:
+            with open(self.path, "r", encoding="utf-8") as f:
+                data = json.load(f)
+        except (OSError, ValueError) as e:
+            logger.error(f"Ошибка при загрузке избранных пар из {self.path}: {e}")
+            return
+        self.users = OrderedDict((int(user_id), favorites) for user_id, favorites in data.items())
+        self._evict()
+        logger.info(f"Загружено избранных пар для пользователей: {len(self.users)}")
+
+    def flush(self):
+        if not self.dirty:
+            return
+        directory = os.path.dirname(self.path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        tmp_path = f"{self.path}.tmp"
+        try:
+            with open(tmp_path, "w", encoding="utf-8") as f:
+                json.dump({str(user_id): favorites for user_id, favorites in self.users.items()}, f)
+            os.replace(tmp_path, self.path)
+            self.dirty = False
+        except OSError as e:
+            logger.error(f"Ошибка при сохранении избранных пар в {self.path}: {e}")
+
+    # Данные пользователя (создаются при первом обращении, порядок - по времени обращения)
+    def _user(self, user_id):
+        favorites = self.users.get(user_id)
+        if favorites is None:
+            favorites = self.users[user_id] = {"pinned": [], "counts": {}}
+            self._evict()
+        else:
+            self.users.move_to_end(user_id)
+        return favorites
+
+    def _evict(self):
+        while len(self.users) > self.max_users:
+            self.users.popitem(last=False)
+            self.evicted += 1
+            self.dirty = True
+
+    # Учет конвертации пары
+    def record(self, user_id, base, quote):
+        counts = self._user(user_id)["counts"]
+        key = f"{base}>{quote}"
+        # Место освобождается до добавления новой пары, иначе вытеснялась бы она сама
+        if key not in counts and len(counts) >= MAX_COUNTED_PAIRS:
+            del counts[min(counts, key=counts.get)]
+        counts[key] = counts.get(key, 0) + 1
+        self.dirty = True
+
+    def is_pinned(self, user_id, base, quote):
+        favorites = self.users.get(user_id)
+        return bool(favorites) and [base, quote] in favorites["pinned"]
+
+    # Закрепление или открепление пары
+    def toggle_pin(self, user_id, base, quote):
+        """
+        :return: True, если пара закреплена; False, если откреплена.
+        """
+        pinned = self._user(user_id)["pinned"]
+        self.dirty = True
+        if [base, quote] in pinned:
+            pinned.remove([base, quote])
+            return False
+        pinned.insert(0, [base, quote])
+        del pinned[MAX_PINNED_PAIRS:]
+        return True
+
+    # Пары для клавиатуры главного меню
+    def top(self, user_id, limit=3):
+        """
+        :return: Список пар (base, quote): сначала закрепленные, затем самые частые.
+        """
+        favorites = self.users.get(user_id)
+        if not favorites:
+            return []
+        pairs = [tuple(pair) for pair in favorites["pinned"]]
+        learned = sorted(favorites["counts"].items(), key=lambda item: -item[1])
+        for key, count in learned:
+            if len(pairs) >= limit or count < MIN_LEARNED_COUNT:
+                break
+            pair = tuple(key.split(">"))
+            if pair not in pairs:
+                pairs.append(pair)
+        return pairs[:limit]
+
+    def __len__(self):
+        return len(self.users)
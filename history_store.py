@@ -0,0 +1,300 @@
+# Хранилище исторических курсов валют
+# Формат на диске:
+#   timestamps.i64      - метки времени (int64, секунды), по одной на строку
+#   columns/<CODE>.f64  - значения одной валюты (float64), по одному на строку
+# Все значения хранятся как "единиц валюты за 1 USD" (как в ответе exchangerate-api),
+# поэтому курс любой пары считается как отношение двух столбцов.
+# Пишет историю один процесс (RateHistoryStore); другие процессы открывают
+# тот же каталог через RateHistoryReader, который файлы не меняет.
+import math
+import mmap
+import os
+import struct
+import logging
+from bisect import bisect_left, bisect_right
+
+logger = logging.getLogger(__name__)
+
+TIMESTAMP_FORMAT = "q"
+VALUE_FORMAT = "d"
+TIMESTAMP_SIZE = struct.calcsize(TIMESTAMP_FORMAT)
+VALUE_SIZE = struct.calcsize(VALUE_FORMAT)
+MISSING = float("nan")
+
+
+# Столбец, отображенный в память для чтения, с открытым файлом для дозаписи
+class _MappedColumn:
+    """
+    Обертка над файлом фиксированной ширины, отображенным в память.
+    Переотображает файл, если он вырос после последнего чтения. Файл для
+    дозаписи открывается один раз и остается открытым до close().
+    """
+
+    def __init__(self, path, fmt):
+        self.path = path
+        self.fmt = fmt
+        self.itemsize = struct.calcsize(fmt)
+        self._file = None
+        self._mmap = None
+        self._view = None
+        self._size = 0
+        self._writer = None
+
+    # Дозапись значений в конец файла (без буфера: запись сразу видна при чтении)
+    def append(self, data):
+        if self._writer is None:
+            self._writer = open(self.path, "ab", buffering=0)
+        self._writer.write(data)
+
+    def view(self):
+        """
+        Возвращает memoryview на содержимое файла (без копирования).
+        """
+        size = os.path.getsize(self.path) if os.path.exists(self.path) else 0
+        size -= size % self.itemsize
+        if size != self._size or self._view is None:
+            self.close()
+            self._size = size
+            if size == 0:
+                self._view = memoryview(b"").cast(self.fmt)
+            else:
+                self._file = open(self.path, "rb")
+                self._mmap = mmap.mmap(self._file.fileno(), size, access=mmap.ACCESS_READ)
+                self._view = memoryview(self._mmap).cast(self.fmt)
+        return self._view
+
+    def close(self):
+        if self._view is not None:
+            self._view.release()
+            self._view = None
+        if self._mmap is not None:
+            self._mmap.close()
+            self._mmap = None
+        if self._file is not None:
+            self._file.close()
+            self._file = None
+        self._size = 0
+
+    def close_writer(self):
+        if self._writer is not None:
+            self._writer.close()
+            self._writer = None
+
+
+class RateHistoryReader:
+    """
+    Чтение колоночного временного ряда курсов, который пишет другой процесс.
+
+    Файлы не изменяются. Число строк определяется размером timestamps.i64
+    при каждом запросе (метка времени пишется последней и фиксирует строку),
+    новые столбцы подхватываются, когда появляются новые строки. Чтение идет
+    через mmap, поэтому в память Python попадает только запрошенный диапазон.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self.columns_path = os.path.join(path, "columns")
+        self._timestamps = _MappedColumn(os.path.join(path, "timestamps.i64"), TIMESTAMP_FORMAT)
+        self._columns = {}
+        self._rows = 0
+        self._scanned_rows = None
+
+    # Число строк и список столбцов по текущему состоянию файлов
+    def _sync(self):
+        try:
+            size = os.path.getsize(self._timestamps.path)
+        except OSError:
+            size = 0
+        self._rows = size // TIMESTAMP_SIZE
+        if self._rows == self._scanned_rows:
+            return
+        self._scanned_rows = self._rows
+        try:
+            filenames = os.listdir(self.columns_path)
+        except OSError:
+            return
+        for filename in filenames:
+            code, ext = os.path.splitext(filename)
+            if ext == ".f64" and code not in self._columns:
+                self._columns[code] = _MappedColumn(os.path.join(self.columns_path, filename), VALUE_FORMAT)
+
+    def __len__(self):
+        self._sync()
+        return self._rows
+
+    def currencies(self):
+        """
+        Возвращает множество валют, для которых есть история.
+        """
+        self._sync()
+        return set(self._columns)
+
+    # Поиск диапазона строк по времени
+    def range_indices(self, start, end):
+        """
+        Возвращает полуинтервал индексов строк [lo, hi) для времени [start, end].
+        """
+        self._sync()
+        timestamps = self._timestamps.view()[:self._rows]
+        return bisect_left(timestamps, int(start)), bisect_right(timestamps, int(end))
+
+    # Итерация по курсу пары в диапазоне
+    def pair_series(self, base, quote, start, end):
+        """
+        Отдает пары (время, курс) для 1 base в quote, пропуская строки без данных.
+        """
+        lo, hi = self.range_indices(start, end)
+        if base not in self._columns or quote not in self._columns:
+            return
+        timestamps = self._timestamps.view()
+        base_values = self._columns[base].view()
+        quote_values = self._columns[quote].view()
+        # Столбец, созданный пишущим процессом только что, может быть еще короче ряда
+        hi = min(hi, len(base_values), len(quote_values))
+        for i in range(lo, hi):
+            base_value = base_values[i]
+            quote_value = quote_values[i]
+            if math.isnan(base_value) or math.isnan(quote_value) or base_value == 0:
+                continue
+            yield timestamps[i], quote_value / base_value
+
+    # Сводная статистика по паре
+    def stats(self, base, quote, start, end):
+        """
+        Возвращает первое/последнее значение, минимум, максимум и изменение
+        курса пары за период или None, если данных нет.
+        """
+        first = last = low = high = None
+        count = 0
+        for timestamp, value in self.pair_series(base, quote, start, end):
+            if first is None:
+                first = (timestamp, value)
+                low = high = value
+            low = min(low, value)
+            high = max(high, value)
+            last = (timestamp, value)
+            count += 1
+        if first is None:
+            return None
+        change = last[1] - first[1]
+        return {
+            "first": first,
+            "last": last,
+            "min": low,
+            "max": high,
+            "change": change,
+            "change_pct": change / first[1] * 100 if first[1] else 0.0,
+            "count": count,
+        }
+
+    # Прореживание ряда
+    def downsample(self, base, quote, start, end, points):
+        """
+        Делит период на points равных интервалов и возвращает последнее
+        значение в каждом непустом интервале.
+        """
+        if points <= 0 or end <= start:
+            return []
+        step = (end - start) / points
+        buckets = {}
+        for timestamp, value in self.pair_series(base, quote, start, end):
+            bucket = min(int((timestamp - start) / step), points - 1)
+            buckets[bucket] = (timestamp, value)
+        return [buckets[key] for key in sorted(buckets)]
+
+    def close(self):
+        self._timestamps.close()
+        self._timestamps.close_writer()
+        for column in self._columns.values():
+            column.close()
+            column.close_writer()
+
+
+class RateHistoryStore(RateHistoryReader):
+    """
+    Компактный колоночный временной ряд курсов валют (пишущий процесс).
+
+    Каждое обновление курсов дописывает одну строку: метку времени и значение
+    для каждого известного столбца. Число строк и столбцы известны самому
+    процессу, поэтому файлы при запросах заново не проверяются.
+    """
+
+    def __init__(self, path):
+        super().__init__(path)
+        os.makedirs(self.columns_path, exist_ok=True)
+        self._last_timestamp = None
+        self._repair()
+
+    def _sync(self):
+        pass
+
+    # Приведение файлов к согласованному состоянию после аварийного завершения
+    def _repair(self):
+        """
+        Столбцы дописываются раньше меток времени, поэтому число строк
+        определяется файлом timestamps.i64; лишние хвосты столбцов обрезаются,
+        недостающие дополняются пропусками.
+        """
+        ts_path = self._timestamps.path
+        if not os.path.exists(ts_path):
+            open(ts_path, "wb").close()
+        ts_size = os.path.getsize(ts_path)
+        if ts_size % TIMESTAMP_SIZE:
+            ts_size -= ts_size % TIMESTAMP_SIZE
+            os.truncate(ts_path, ts_size)
+        self._rows = ts_size // TIMESTAMP_SIZE
+
+        for filename in os.listdir(self.columns_path):
+            code, ext = os.path.splitext(filename)
+            if ext != ".f64":
+                continue
+            column_path = os.path.join(self.columns_path, filename)
+            expected = self._rows * VALUE_SIZE
+            size = os.path.getsize(column_path)
+            if size > expected:
+                os.truncate(column_path, expected)
+            elif size < expected:
+                with open(column_path, "ab") as f:
+                    f.write(struct.pack(f"{(expected - size) // VALUE_SIZE}{VALUE_FORMAT}",
+                                        *([MISSING] * ((expected - size) // VALUE_SIZE))))
+            self._columns[code] = _MappedColumn(column_path, VALUE_FORMAT)
+
+        if self._rows:
+            self._last_timestamp = self._timestamps.view()[self._rows - 1]
+
+    # Добавление строки с курсами
+    def append(self, timestamp, rates):
+        """
+        Дописывает снимок курсов в конец ряда.
+
+        :param timestamp: Время снимка (секунды с эпохи).
+        :param rates: Словарь {код валюты: единиц валюты за 1 USD}.
+        :return: True, если строка записана.
+        """
+        timestamp = int(timestamp)
+        if self._last_timestamp is not None and timestamp < self._last_timestamp:
+            logger.warning(f"Пропущен снимок истории с меткой времени из прошлого: {timestamp}")
+            return False
+
+        # Новые валюты получают столбец, заполненный пропусками для прошлых строк
+        for code in rates:
+            if code not in self._columns:
+                column_path = os.path.join(self.columns_path, f"{code}.f64")
+                with open(column_path, "wb") as f:
+                    if self._rows:
+                        f.write(struct.pack(f"{self._rows}{VALUE_FORMAT}", *([MISSING] * self._rows)))
+                self._columns[code] = _MappedColumn(column_path, VALUE_FORMAT)
+
+        for code, column in self._columns.items():
+            value = rates.get(code)
+            try:
+                value = float(value) if value is not None else MISSING
+            except (TypeError, ValueError):
+                value = MISSING
+            column.append(struct.pack(VALUE_FORMAT, value))
+
+        # Метка времени пишется последней: она фиксирует строку
+        self._timestamps.append(struct.pack(TIMESTAMP_FORMAT, timestamp))
+        self._rows += 1
+        self._last_timestamp = timestamp
+        return True
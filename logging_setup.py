@@ -0,0 +1,142 @@
+# Неблокирующее логирование
+# Обработчики логгеров только кладут запись в очередь; форматирование и вывод
+# выполняются в отдельном потоке QueueListener, поэтому медленный stdout не
+# останавливает цикл событий. Частые события (попадания в кэш, нажатия кнопок)
+# дополнительно ограничиваются по количеству.
+import atexit
+import json
+import logging
+import logging.handlers
+import os
+import queue
+import sys
+import time
+
+TEXT_FORMAT = "%(asctime)s - %(name)s - %(levelname)s - %(message)s"
+
+# Ограничения для частых событий: событие -> (не больше N записей, за интервал в секундах)
+DEFAULT_EVENT_LIMITS = {
+    "cache_hit": (5, 60),
+    "callback": (60, 60),
+    "message_unchanged": (5, 60),
+}
+
+# Стандартные атрибуты LogRecord, которые не выводятся как дополнительные поля
+_RECORD_ATTRIBUTES = set(logging.LogRecord("", 0, "", 0, "", None, None).__dict__) | {"message", "asctime"}
+
+
+class JsonFormatter(logging.Formatter):
+    """
+    Форматирует запись в одну строку JSON. Поля, переданные через extra=,
+    выводятся как отдельные ключи.
+    """
+
+    def format(self, record):
+        data = {
+            "ts": round(record.created, 3),
+            "level": record.levelname,
+            "logger": record.name,
+            "msg": record.getMessage(),
+        }
+        for key, value in record.__dict__.items():
+            if key not in _RECORD_ATTRIBUTES and not key.startswith("_"):
+                data[key] = value
+        if record.exc_info:
+            data["exc"] = self.formatException(record.exc_info)
+        return json.dumps(data, ensure_ascii=False, default=str)
+
+
+class TextFormatter(logging.Formatter):
+    """
+    Текстовый формат; если перед записью были отброшены похожие записи,
+    их количество дописывается в конец строки.
+    """
+
+    def format(self, record):
+        text = super().format(record)
+        suppressed = getattr(record, "suppressed", 0)
+        if suppressed:
+            text += f" (пропущено похожих записей: {suppressed})"
+        return text
+
+
+class EventRateLimitFilter(logging.Filter):
+    """
+    Пропускает не больше N записей одного события за интервал. Событие задается
+    через extra={"event": ...}; записи без события не ограничиваются.
+    Количество отброшенных записей добавляется к первой записи следующего интервала.
+    """
+
+    def __init__(self, limits=None):
+        super().__init__()
+        self.limits = dict(DEFAULT_EVENT_LIMITS if limits is None else limits)
+        self.windows = {}
+
+    def filter(self, record):
+        event = getattr(record, "event", None)
+        limit = self.limits.get(event)
+        if limit is None:
+            return True
+
+        max_records, interval = limit
+        now = time.monotonic()
+        window = self.windows.get(event)
+        if window is None or now - window[0] >= interval:
+            suppressed = window[2] if window else 0
+            self.windows[event] = [now, 1, 0]
+            if suppressed:
+                record.suppressed = suppressed
+            return True
+        if window[1] < max_records:
+            window[1] += 1
+            return True
+        window[2] += 1
+        return False
+
+
+class LazyQueueHandler(logging.handlers.QueueHandler):
+    """
+    QueueHandler, который не форматирует запись в вызывающем потоке:
+    сообщение собирается из шаблона и аргументов уже в потоке QueueListener.
+    """
+
+    def prepare(self, record):
+        return record
+
+
+# Настройка логирования
+def setup_logging(level=None, log_format=None, event_limits=None):
+    """
+    Настраивает корневой логгер: очередь + поток вывода.
+
+    :param level: Уровень логирования (по умолчанию LOG_LEVEL или INFO).
+    :param log_format: 'text' или 'json' (по умолчанию LOG_FORMAT или text).
+    :param event_limits: Ограничения для частых событий (см. DEFAULT_EVENT_LIMITS).
+    :return: Запущенный QueueListener.
+    """
+    level = level or os.getenv("LOG_LEVEL", "INFO").upper()
+    log_format = (log_format or os.getenv("LOG_FORMAT", "text")).lower()
+
+    stream_handler = logging.StreamHandler(sys.stdout)
+    if log_format == "json":
+        stream_handler.setFormatter(JsonFormatter())
+    else:
+        stream_handler.setFormatter(TextFormatter(TEXT_FORMAT))
+
+    log_queue = queue.SimpleQueue()
+    queue_handler = LazyQueueHandler(log_queue)
+    queue_handler.addFilter(EventRateLimitFilter(event_limits))
+
+    root = logging.getLogger()
+    for handler in list(root.handlers):
+        root.removeHandler(handler)
+    root.addHandler(queue_handler)
+    root.setLevel(level)
+
+    # httpx (внутри python-telegram-bot) пишет строку на каждый запрос к Bot API
+    logging.getLogger("httpx").setLevel(logging.WARNING)
+
+    listener = logging.handlers.QueueListener(log_queue, stream_handler, respect_handler_level=True)
+    listener.start()
+    atexit.register(listener.stop)
+    return listener
@@ -0,0 +1,172 @@
+# Измерение задержки цикла событий
+# Задача засыпает на фиксированный интервал и сравнивает фактическое время
+# пробуждения с ожидаемым: разница - это время, на которое цикл был занят
+# другим кодом (блокирующим вызовом или долгим вычислением).
+# Сторожевой поток следит за тем, что задача продолжает просыпаться, и если
+# цикл завис дольше порога, выводит в лог стек потока цикла - то место, где
+# выполняется блокирующий код.
+# Блокирующие вызовы можно выносить в пул через run_blocking(). Разбор JSON
+# (json и orjson) держит GIL все время разбора, поэтому поток не сокращает
+# зависание цикла: большие ответы разбираются в пуле процессов, а в режиме
+# 'thread' - прямо в цикле событий.
+import asyncio
+import logging
+import os
+import sys
+import threading
+import time
+import traceback
+
+import fast_runtime
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_SAMPLE_INTERVAL = 0.5
+DEFAULT_LAG_THRESHOLD = 0.5
+LAG_WINDOW = 120  # Сколько последних замеров учитывается в максимуме
+
+# Вынос тяжелой работы: 'process', 'thread' или 'off'
+offload_mode = "process"
+offload_min_bytes = 65536
+_executor = None
+
+
+class LoopLagMonitor:
+    def __init__(self, interval=DEFAULT_SAMPLE_INTERVAL, threshold=DEFAULT_LAG_THRESHOLD):
+        self.interval = interval
+        self.threshold = threshold
+        self.last_lag = 0.0
+        self.samples = []
+        self.stalls = 0
+        self.heartbeat = time.monotonic()
+        self.loop_thread_id = None
+        self.running = False  # Задача замера выполняется (иначе пробуждений нет и зависанием это не считается)
+        self._stop = threading.Event()
+        self._watchdog = None
+
+    async def run(self):
+        loop = asyncio.get_running_loop()
+        self.loop_thread_id = threading.get_ident()
+        self.running = True
+        try:
+            while True:
+                started = loop.time()
+                self.heartbeat = time.monotonic()
+                await asyncio.sleep(self.interval)
+                self.record(max(0.0, loop.time() - started - self.interval))
+        finally:
+            self.running = False
+
+    def record(self, lag):
+        self.last_lag = lag
+        self.samples.append(lag)
+        if len(self.samples) > LAG_WINDOW:
+            del self.samples[0]
+        if lag > self.threshold:
+            self.stalls += 1
+            logger.warning(f"Цикл событий был заблокирован на {lag * 1000:.0f} мс", extra={"event": "loop_lag"})
+
+    def stats(self):
+        return {
+            "loop_lag_ms": round(self.last_lag * 1000, 1),
+            "loop_lag_max_ms": round(max(self.samples, default=0.0) * 1000, 1),
+            "loop_stalls": self.stalls,
+        }
+
+    # Запуск сторожевого потока
+    def start_watchdog(self):
+        if self._watchdog is not None and self._watchdog.is_alive():
+            return self._watchdog
+        self._stop.clear()
+        self._watchdog = threading.Thread(target=self._watch, name="loop-watchdog", daemon=True)
+        self._watchdog.start()
+        return self._watchdog
+
+    # Остановка сторожевого потока (при завершении работы бота)
+    def stop_watchdog(self):
+        self._stop.set()
+        if self._watchdog is not None:
+            self._watchdog.join(timeout=self.threshold)
+            self._watchdog = None
+
+    def _watch(self):
+        reported_heartbeat = None
+        while not self._stop.wait(self.threshold / 2):
+            if not self.running or self.loop_thread_id is None:
+                continue
+            heartbeat = self.heartbeat
+            blocked_for = time.monotonic() - heartbeat - self.interval
+            if blocked_for <= self.threshold or heartbeat == reported_heartbeat:
+                continue
+            # Сообщаем один раз на каждое зависание
+            reported_heartbeat = heartbeat
+            frame = sys._current_frames().get(self.loop_thread_id)
+            if frame is None:
+                continue
+            stack = "".join(traceback.format_list(_task_frames(traceback.extract_stack(frame))))
+            logger.error(
+                f"Цикл событий заблокирован дольше {blocked_for * 1000:.0f} мс, стек:\n{stack}",
+                extra={"event": "loop_stall_stack"},
+            )
+
+
+# Кадры стека после внутренних вызовов asyncio - код выполняемой задачи
+def _task_frames(frames):
+    start = 0
+    for index, frame in enumerate(frames):
+        if f"{os.sep}asyncio{os.sep}" in frame.filename:
+            start = index + 1
+    return frames[start:] or frames
+
+
+# Настройка выноса тяжелой работы
+def configure_offload(mode, min_bytes=None):
+    """
+    :param mode: 'process' - пул процессов; 'thread' - пул потоков для run_blocking(),
+        а JSON разбирается в цикле событий (разбор держит GIL, поток не помогает);
+        'off' - все в цикле событий.
+    :param min_bytes: Ответы меньшего размера разбираются прямо в цикле событий.
+    """
+    global offload_mode, offload_min_bytes
+    if mode not in ("thread", "process", "off"):
+        logger.error(f"Неверное значение режима выноса работы: {mode}. Используется 'process'.")
+        mode = "process"
+    offload_mode = mode
+    if min_bytes is not None:
+        offload_min_bytes = min_bytes
+
+
+def _get_executor():
+    global _executor
+    if _executor is None:
+        if offload_mode == "process":
+            from concurrent.futures import ProcessPoolExecutor
+
+            _executor = ProcessPoolExecutor(max_workers=2)
+        else:
+            from concurrent.futures import ThreadPoolExecutor
+
+            _executor = ThreadPoolExecutor(max_workers=2, thread_name_prefix="offload")
+    return _executor
+
+
+# Выполнение блокирующей функции вне цикла событий
+async def run_blocking(func, *args):
+    if offload_mode == "off":
+        return func(*args)
+    return await asyncio.get_running_loop().run_in_executor(_get_executor(), func, *args)
+
+
+# Разбор JSON-ответа aiohttp; большие ответы разбираются в пуле процессов
+async def read_json(response):
+    text = await response.text()
+    if len(text) < offload_min_bytes or offload_mode != "process":
+        return fast_runtime.loads(text)
+    return await run_blocking(fast_runtime.loads, text)
+
+
+def shutdown_offload():
+    global _executor
+    if _executor is not None:
+        _executor.shutdown(wait=False)
+        _executor = None
@@ -1,54 +1,89 @@
 # первый блок
 # Импорты библиотек
+# python-telegram-bot и aiohttp импортируются лениво (в фабрике приложения и при
+# первом запросе), чтобы модуль быстро импортировался и для инструментов, и при запуске.
+from __future__ import annotations
+
+import time
+
+MODULE_IMPORT_STARTED = time.perf_counter()
+
 import asyncio
-from dotenv import load_dotenv
+import contextlib
 import os
+import re
+import sys
 import logging
-import time
-from telegram import Update, InlineKeyboardButton, InlineKeyboardMarkup
-from telegram.ext import ApplicationBuilder
-from telegram.ext import (
-    Application,
-    CommandHandler,
-    CallbackQueryHandler,
-    MessageHandler,
-    ContextTypes,
-    filters,
-)
-import aiohttp
+from typing import TYPE_CHECKING
+from dotenv import load_dotenv
+import fast_runtime
+import state_shards
+from logging_setup import setup_logging
+from history_store import RateHistoryReader, RateHistoryStore
+from alerts import AlertIndex, ABOVE, BELOW
+from broadcast_queue import BroadcastQueue, PRIORITY_ALERT, PRIORITY_DIGEST
+from admission import ADMIT, AdmissionControl, ReceiptQueue, STALE
+from callback_router import CallbackRouter, decode_callback, encode_callback
+from crypto_universe import CryptoUniverse, chunked
+from currency_index import CurrencyIndex, ISO_CURRENCIES, currency_flag
+from favorites import FavoritePairs
+from loop_monitor import LoopLagMonitor, configure_offload, read_json, shutdown_offload
+from metrics import metrics, get_process_rss
+from refresh_scheduler import RefreshScheduler, api_budgets
+from sessions import SessionStore, Step
+from digests import DigestSubscriptions, parse_digest_time, MAX_DIGEST_CURRENCIES, DEFAULT_DIGEST_TIME
+
+if TYPE_CHECKING:
+    from telegram import Update
+    from telegram.ext import ContextTypes
 
 
 # Переход к следующему блоку2
-# Настройка логирования
-logging.basicConfig(
-    format="%(asctime)s - %(name)s - %(levelname)s - %(message)s", level=logging.INFO
-)
+# Логгер модуля; обработчики настраиваются в main() (запись в очередь, вывод в отдельном потоке)
 logger = logging.getLogger(__name__)
 
+# Метки частых событий: такие записи ограничиваются по количеству (см. logging_setup)
+CACHE_HIT_LOG_EXTRA = {"event": "cache_hit"}
+CALLBACK_LOG_EXTRA = {"event": "callback"}
+
 # Переход к следующему блоку3
-# Загрузка переменных окружения
+# Загрузка переменных окружения (файл .env необязателен: переменные могут быть заданы платформой)
 dotenv_path = os.path.join(os.getcwd(), ".env")
-if not os.path.exists(dotenv_path):
-    logger.error(f"Файл .env не найден по пути: {dotenv_path}")
-    exit(1)
-else:
-    logger.info(f"Файл .env найден: {dotenv_path}")
+if os.path.exists(dotenv_path):
     load_dotenv(dotenv_path)
 
+
 # Логирование переменных окружения
-logger.info("Переменные окружения:")
-for key in ["TELEGRAM_BOT_TOKEN", "CACHE_TIME"]:
-    value = os.getenv(key)
-    if value:
-        logger.info(f"{key}: {'*' * len(value) if key == 'TELEGRAM_BOT_TOKEN' else value}")
+def log_environment():
+    if os.path.exists(dotenv_path):
+        logger.info(f"Файл .env найден: {dotenv_path}")
     else:
-        logger.warning(f"{key} не установлена.")
+        logger.info(f"Файл .env не найден по пути: {dotenv_path}, используются переменные окружения.")
+    logger.info("Переменные окружения:")
+    for key in ["TELEGRAM_BOT_TOKEN", "CACHE_TIME"]:
+        value = os.getenv(key)
+        if value:
+            logger.info(f"{key}: {'*' * len(value) if key == 'TELEGRAM_BOT_TOKEN' else value}")
+        else:
+            logger.warning(f"{key} не установлена.")
+
+
+# Получение токена бота (проверяется при создании приложения, а не при импорте)
+def get_token():
+    return os.getenv("TELEGRAM_BOT_TOKEN")
+
+
+# Числовая переменная окружения; при неверном значении используется значение по умолчанию
+def env_number(name, default, kind=int):
+    value = os.getenv(name)
+    if not value:
+        return default
+    try:
+        return kind(value)
+    except ValueError:
+        logger.error(f"Неверное значение для {name}: {value}. Используется значение по умолчанию ({default}).")
+        return default
 
-# Получение токена и времени кэширования
-token = os.getenv("TELEGRAM_BOT_TOKEN")
-if not token:
-    logger.error("Токен бота не настроен. Установите переменную окружения TELEGRAM_BOT_TOKEN.")
-    exit(1)
 
 cache_time_env = os.getenv("CACHE_TIME")
 try:
@@ -61,6 +96,51 @@ except ValueError:
     CACHE_TIME_REGIONAL = 18000  # 5 часов
     CACHE_TIME_CRYPTO = 28800  # 8 часов
 
+# Адаптивные интервалы обновления (см. refresh_scheduler.py): CACHE_TIME_* - начальные значения,
+# дальше интервал подстраивается под изменение курсов и спрос в пределах [MIN, MAX]
+REFRESH_MIN_INTERVAL_FIAT = env_number("REFRESH_MIN_INTERVAL_FIAT", 600)
+REFRESH_MAX_INTERVAL_FIAT = env_number("REFRESH_MAX_INTERVAL_FIAT", 86400)
+REFRESH_MIN_INTERVAL_CRYPTO = env_number("REFRESH_MIN_INTERVAL_CRYPTO", 60)
+REFRESH_MAX_INTERVAL_CRYPTO = env_number("REFRESH_MAX_INTERVAL_CRYPTO", CACHE_TIME_CRYPTO)
+REFRESH_CHECK_INTERVAL = 30  # Как часто фоновая задача проверяет, не пора ли обновить курсы
+refresh_scheduler = None
+
+# Месячные бюджеты запросов к API (0 - без ограничения); расход хранится в API_BUDGETS_FILE
+API_BUDGETS_FILE = os.getenv("API_BUDGETS_FILE", os.path.join(os.getcwd(), "data", "api_budgets.json"))
+
+
+# Настройка планировщика обновлений, бюджетов API и выноса работы из цикла событий
+def configure_runtime():
+    """
+    Вызывается при создании приложения (и в супервизоре), а не при импорте
+    модуля. Повторные вызовы ничего не делают.
+    """
+    global refresh_scheduler
+    if refresh_scheduler is not None:
+        return
+    refresh_scheduler = RefreshScheduler(
+        {
+            "world": (CACHE_TIME_WORLD, REFRESH_MIN_INTERVAL_FIAT, REFRESH_MAX_INTERVAL_FIAT),
+            "regional": (CACHE_TIME_REGIONAL, REFRESH_MIN_INTERVAL_FIAT, REFRESH_MAX_INTERVAL_FIAT),
+            "crypto": (CACHE_TIME_CRYPTO, REFRESH_MIN_INTERVAL_CRYPTO, REFRESH_MAX_INTERVAL_CRYPTO),
+        },
+        target_change=env_number("REFRESH_TARGET_CHANGE", 0.005, float),
+    )
+    metrics.gauge("refresh", refresh_scheduler.stats)
+    api_budgets.configure(
+        {
+            "exchangerate": env_number("EXCHANGERATE_MONTHLY_REQUESTS", 0),
+            "coingecko": env_number("COINGECKO_MONTHLY_REQUESTS", 10000),
+            "coinmarketcap": env_number("COINMARKETCAP_MONTHLY_CREDITS", 10000),
+        },
+        API_BUDGETS_FILE,
+        read_only=PROCESS_ROLE == "worker",
+    )
+    metrics.gauge("api_budgets", api_budgets.stats)
+    # Разбор больших ответов API в пуле процессов: process, thread (разбор в цикле) или off
+    configure_offload(os.getenv("OFFLOAD_POOL", "process"), env_number("OFFLOAD_MIN_BYTES", 65536))
+    metrics.gauge("loop", loop_monitor.stats)
+
 
 # Переход к следующему блоку4
 # Глобальные переменные для хранения курсов валют
@@ -74,22 +154,432 @@ last_update_crypto = 0
 # Глобальный ClientSession для минимизации создания новых HTTP-соединений
 client_session = None
 
+# Хранилище истории курсов (каталог можно переопределить через HISTORY_DIR)
+HISTORY_DIR = os.getenv("HISTORY_DIR", os.path.join(os.getcwd(), "data", "history"))
+rate_history = None
+last_history_snapshot = {}
+
+# Ценовые оповещения (файл можно переопределить через ALERTS_FILE)
+ALERTS_FILE = os.getenv("ALERTS_FILE", os.path.join(os.getcwd(), "data", "alerts.json"))
+MAX_ALERTS_PER_CHAT = 20
+alert_index = None
+
+# Избранные валютные пары (закрепленные и часто используемые)
+FAVORITES_FILE = os.getenv("FAVORITES_FILE", os.path.join(os.getcwd(), "data", "favorites.json"))
+FAVORITES_FLUSH_INTERVAL = 60
+MAX_FAVORITE_USERS = env_number("MAX_FAVORITE_USERS", 100000)
+FAVORITES_KEYBOARD_SIZE = 3
+favorite_pairs = None
+
+# Очередь рассылок и подписки на дайджесты
+BROADCAST_DIR = os.getenv("BROADCAST_DIR", os.path.join(os.getcwd(), "data", "broadcasts"))
+DIGESTS_FILE = os.getenv("DIGESTS_FILE", os.path.join(os.getcwd(), "data", "digests.json"))
+try:
+    DIGEST_UTC_OFFSET = int(os.getenv("DIGEST_UTC_OFFSET", "3"))  # Часовой пояс времени дайджестов
+except ValueError:
+    logger.error("Неверное значение для DIGEST_UTC_OFFSET. Используется значение по умолчанию.")
+    DIGEST_UTC_OFFSET = 3
+broadcast_queue = None
+digest_subscriptions = None
+BROADCAST_MESSAGES_PER_SECOND = 25  # Общий лимит рассылок бота; делится между воркерами
+
+# Версии курсов по источникам: увеличиваются при каждом обновлении
+rates_versions = {"world": 0, "regional": 0, "crypto": 0}
+
+# Администраторы бота (через запятую), которым доступна команда /stats
+admin_ids_env = [user_id for user_id in os.getenv("ADMIN_IDS", "").replace(" ", "").split(",") if user_id]
+ADMIN_IDS = {int(user_id) for user_id in admin_ids_env if user_id.lstrip("-").isdigit()}
+if any(not user_id.lstrip("-").isdigit() for user_id in admin_ids_env):
+    logger.error("Неверные значения в ADMIN_IDS пропущены.")
+PROCESS_STARTED = time.time()
+# Задержка цикла событий: при зависании дольше LOOP_LAG_THRESHOLD секунд в лог выводится стек
+LOOP_LAG_THRESHOLD = env_number("LOOP_LAG_THRESHOLD", 0.5, float)
+loop_monitor = LoopLagMonitor(threshold=LOOP_LAG_THRESHOLD)
+
+# Контроль допуска: устаревшие кнопки и сообщения, повторные нажатия, перегрузка очереди
+UPDATE_RATES_MIN_INTERVAL = env_number("UPDATE_RATES_MIN_INTERVAL", 60)  # Не чаще раза в минуту для всех пользователей
+admission = AdmissionControl(
+    callback_max_wait=env_number("CALLBACK_MAX_WAIT", 60),
+    message_max_age=env_number("MESSAGE_MAX_AGE", 300),
+    debounce_interval=env_number("CALLBACK_DEBOUNCE", 1.0, float),
+    route_debounce={"u": env_number("UPDATE_RATES_DEBOUNCE", 30.0, float)},
+    queue_depth_limit=env_number("ADMISSION_QUEUE_DEPTH", 50),
+    startup_window=env_number("STARTUP_BACKLOG_WINDOW", 10),
+)
+
+# Роль процесса: single - обычный режим, supervisor - принимает webhook и
+# обновляет курсы, worker - обрабатывает обновления своей части чатов (см. workers.py)
+PROCESS_ROLE = "single"
+WORKER_INDEX = None
 
-# Предварительная загрузка данных при старте бота
-async def preload_exchange_rates():
+# Общий снимок курсов, через который супервизор передает курсы воркерам
+RATES_SNAPSHOT_FILE = os.getenv("RATES_SNAPSHOT_FILE", os.path.join(os.getcwd(), "data", "rates_snapshot.json"))
+SHARED_RATES_CHECK_INTERVAL = 2
+shared_rates_mtime = None
+
+# Плавный перезапуск: состояние диалогов сохраняется между процессами,
+# обработка начатых обновлений ограничена по времени
+CONVERSATIONS_FILE = os.getenv("CONVERSATIONS_FILE", os.path.join(os.getcwd(), "data", "conversations.json"))
+SHUTDOWN_DRAIN_TIMEOUT = env_number("SHUTDOWN_DRAIN_TIMEOUT", 10.0, float)
+
+# HTTP API курсов для других сервисов (0 - выключено, см. rate_api.py)
+RATE_API_PORT = env_number("RATE_API_PORT", 0)
+RATE_API_HOST = os.getenv("RATE_API_HOST", "127.0.0.1")
+RATE_API_TOKEN = os.getenv("RATE_API_TOKEN")
+
+
+# Объединенный снимок курсов: единиц валюты за 1 USD
+def build_rates_snapshot():
+    """
+    Объединяет фиатные и криптовалютные курсы в один словарь с базой USD.
+    Криптовалюты переводятся в количество монет за 1 USD.
+    """
+    snapshot = dict(exchange_rates_world or exchange_rates_regional)
+    for currency, price in (exchange_rates_crypto or {}).items():
+        if price:
+            snapshot[currency] = 1 / price
+    return snapshot
+
+
+# Курс пары по снимку: сколько quote стоит 1 base
+def get_pair_rate(base, quote, snapshot=None):
+    snapshot = build_rates_snapshot() if snapshot is None else snapshot
+    base_rate = snapshot.get(base)
+    quote_rate = snapshot.get(quote)
+    if not base_rate or not quote_rate:
+        return None
+    return quote_rate / base_rate
+
+
+# Получение истории курсов (открывается при первом обращении)
+def get_rate_history():
+    """
+    Историю пишет процесс, который запрашивает курсы (single/supervisor);
+    воркеры только читают каталог супервизора и файлы не меняют.
+    """
+    global rate_history
+    if rate_history is None:
+        if PROCESS_ROLE == "worker":
+            rate_history = RateHistoryReader(HISTORY_DIR)
+        else:
+            rate_history = RateHistoryStore(HISTORY_DIR)
+    return rate_history
+
+
+# Запись текущего снимка курсов в историю
+def record_rates_history(current_time, snapshot=None):
+    """
+    Дописывает в историю объединенный снимок фиатных и криптовалютных курсов.
+    Криптовалюты хранятся как количество монет за 1 USD, чтобы все столбцы
+    имели одну базу. Одинаковые подряд снимки не записываются.
+    """
+    global last_history_snapshot
+    snapshot = build_rates_snapshot() if snapshot is None else snapshot
+    if not snapshot or snapshot == last_history_snapshot:
+        return
+
+    try:
+        if get_rate_history().append(current_time, snapshot):
+            last_history_snapshot = snapshot
+    except OSError as e:
+        logger.error(f"Ошибка при записи истории курсов: {e}")
+
+
+# Получение очереди рассылок (незавершенные рассылки подхватываются с диска)
+def get_broadcast_queue():
+    global broadcast_queue
+    if broadcast_queue is None:
+        broadcast_queue = BroadcastQueue(
+            BROADCAST_DIR, on_forbidden=on_chat_forbidden, messages_per_second=BROADCAST_MESSAGES_PER_SECOND
+        )
+        metrics.gauge("broadcast_queue_depth", broadcast_queue.depth)
+    return broadcast_queue
+
+
+# Получение подписок на дайджесты
+def get_digest_subscriptions():
+    global digest_subscriptions
+    if digest_subscriptions is None:
+        digest_subscriptions = DigestSubscriptions(DIGESTS_FILE)
+    return digest_subscriptions
+
+
+# Пользователь заблокировал бота - больше не шлем ему дайджест
+def on_chat_forbidden(chat_id):
+    if get_digest_subscriptions().unsubscribe(chat_id):
+        logger.info("Подписка чата %s на дайджест отменена: бот заблокирован.", chat_id)
+
+
+# Сколько обновлений обрабатывается одновременно (1 - по одному, как раньше);
+# обновления одного чата всегда обрабатываются по порядку
+CONCURRENT_UPDATES = env_number("CONCURRENT_UPDATES", 32)
+
+# Сессии пользователей: вытесняются после SESSION_TTL секунд простоя и при превышении MAX_SESSIONS
+MAX_SESSIONS = env_number("MAX_SESSIONS", 100000)
+SESSION_TTL = env_number("SESSION_TTL", 86400)
+sessions = SessionStore(MAX_SESSIONS, SESSION_TTL)
+metrics.gauge("sessions", sessions.stats)
+
+
+# Сессия пользователя Telegram
+def get_session(user):
+    return sessions.get(user.id)
+
+
+# Получение избранных пар (загружаются с диска при первом обращении)
+def get_favorite_pairs():
+    global favorite_pairs
+    if favorite_pairs is None:
+        favorite_pairs = FavoritePairs(FAVORITES_FILE, MAX_FAVORITE_USERS)
+    return favorite_pairs
+
+
+# Периодическое сохранение избранных пар
+async def flush_favorites_periodically():
+    while True:
+        await asyncio.sleep(FAVORITES_FLUSH_INTERVAL)
+        get_favorite_pairs().flush()
+
+
+# Получение индекса оповещений (загружается с диска при первом обращении)
+def get_alert_index():
+    global alert_index
+    if alert_index is None:
+        alert_index = AlertIndex(ALERTS_FILE)
+    return alert_index
+
+
+# Проверка ценовых оповещений после обновления курсов
+def check_price_alerts(snapshot):
+    """
+    Находит сработавшие оповещения и ставит их в очередь рассылки.
+    """
+    fired = get_alert_index().evaluate(lambda base, quote: get_pair_rate(base, quote, snapshot))
+    if not fired:
+        return
+    logger.info("Сработало оповещений: %s", len(fired))
+
+    # Одно сообщение на чат, даже если сработало несколько оповещений
+    messages = {}
+    for alert in fired:
+        line = (
+            f"🔔 {alert['base']} {alert['direction']} {alert['threshold']:g} {alert['quote']}: "
+            f"сейчас 1 {alert['base']} = {alert['rate']:.4f} {alert['quote']}"
+        )
+        messages.setdefault(alert["chat_id"], []).append(line)
+    texts = {chat_id: "\n".join(lines) for chat_id, lines in messages.items()}
+    get_broadcast_queue().enqueue(texts, [(chat_id, chat_id) for chat_id in texts], priority=PRIORITY_ALERT)
+
+
+# Перестроение поискового индекса валют при изменении их набора
+def rebuild_currency_index():
+    """
+    Порядок валют в индексе задает сортировку результатов поиска:
+    сначала популярные (мировые и региональные), затем крупные криптовалюты,
+    затем остальные валюты по алфавиту.
+    """
+    global currency_index_codes
+    fiat_codes = set(exchange_rates_world or exchange_rates_regional) | set(ALL_CURRENCIES)
+    crypto_codes = crypto_universe.symbols()
+    codes = (frozenset(fiat_codes), tuple(crypto_codes))
+    if codes == currency_index_codes:
+        return
+    currency_index_codes = codes
+
+    ordered = list(dict.fromkeys(
+        list(WORLD_CURRENCIES) + list(REGIONAL_CURRENCIES) + list(ALL_CURRENCIES)
+        + get_keyboard_crypto_symbols() + sorted(fiat_codes) + crypto_codes
+    ))
+    entries = []
+    for code in ordered:
+        if code in crypto_universe:
+            name = crypto_universe.names.get(code, code)
+            entries.append((code, name, name, "криптовалюта crypto"))
+        elif code in fiat_codes:
+            name, english_name, country = ISO_CURRENCIES.get(code, (code, code, ""))
+            entries.append((code, name, english_name, country))
+    currency_index.build(entries)
+
+
+# Обработка обновления курсов: история, оповещения и поисковый индекс
+def on_rates_updated(current_time):
+    """
+    История пишется процессом, который запрашивает курсы (single/supervisor),
+    оповещения проверяются процессами, которые обслуживают чаты (single/worker).
+    """
+    snapshot = build_rates_snapshot()
+    rebuild_currency_index()
+    if PROCESS_ROLE != "worker":
+        record_rates_history(current_time, snapshot)
+    if PROCESS_ROLE == "supervisor":
+        save_rates_snapshot()
+    else:
+        check_price_alerts(snapshot)
+
+
+# Сохранение общего снимка курсов (атомарная замена файла)
+def save_rates_snapshot(path=None):
+    path = path or RATES_SNAPSHOT_FILE
+    data = {
+        "world": exchange_rates_world,
+        "regional": exchange_rates_regional,
+        "crypto": exchange_rates_crypto,
+        "last_update_world": last_update_world,
+        "last_update_regional": last_update_regional,
+        "last_update_crypto": last_update_crypto,
+        "crypto_coins": crypto_universe.coins,
+        "versions": rates_versions,
+    }
+    directory = os.path.dirname(path)
+    if directory:
+        os.makedirs(directory, exist_ok=True)
+    tmp_path = f"{path}.{os.getpid()}.tmp"
+    try:
+        with open(tmp_path, "w", encoding="utf-8") as f:
+            f.write(fast_runtime.dumps(data))
+        os.replace(tmp_path, path)
+    except OSError as e:
+        logger.error(f"Ошибка при сохранении снимка курсов в {path}: {e}")
+
+
+# Загрузка общего снимка курсов
+def load_rates_snapshot(path=None):
+    """
+    Подставляет курсы из снимка в глобальные переменные.
+
+    :return: True, если снимок загружен.
+    """
+    global exchange_rates_world, exchange_rates_regional, exchange_rates_crypto
+    global last_update_world, last_update_regional, last_update_crypto
+    path = path or RATES_SNAPSHOT_FILE
+    if not os.path.exists(path):
+        return False
+    try:
+        with open(path, "r", encoding="utf-8") as f:
+            data = fast_runtime.loads(f.read())
+    except (OSError, ValueError) as e:
+        logger.error(f"Ошибка при загрузке снимка курсов из {path}: {e}")
+        return False
+    exchange_rates_world = data.get("world") or {}
+    exchange_rates_regional = data.get("regional") or {}
+    exchange_rates_crypto = data.get("crypto") or {}
+    last_update_world = data.get("last_update_world", 0)
+    last_update_regional = data.get("last_update_regional", 0)
+    last_update_crypto = data.get("last_update_crypto", 0)
+    if data.get("crypto_coins"):
+        crypto_universe.set_coins(data["crypto_coins"])
+    rates_versions.update(data.get("versions") or {})
+    return True
+
+
+# Отслеживание общего снимка курсов в воркере
+async def watch_shared_rates():
+    """
+    Воркер не обращается к API курсов: он перечитывает снимок, который
+    пишет супервизор, когда меняется время модификации файла.
+    """
+    global shared_rates_mtime
+    while True:
+        try:
+            mtime = os.path.getmtime(RATES_SNAPSHOT_FILE)
+            if mtime != shared_rates_mtime and load_rates_snapshot():
+                shared_rates_mtime = mtime
+                on_rates_updated(time.time())
+        except FileNotFoundError:
+            pass
+        except Exception as e:
+            logger.error(f"Ошибка при чтении общего снимка курсов: {e}")
+        await asyncio.sleep(SHARED_RATES_CHECK_INTERVAL)
+
+
+# Настройка процесса-воркера
+def configure_worker(index, count):
+    """
+    Каждый воркер хранит оповещения, подписки и очередь рассылок своей части
+    чатов в отдельных файлах; лимит рассылок делится между воркерами.
+    """
+    global PROCESS_ROLE, WORKER_INDEX, ALERTS_FILE, DIGESTS_FILE, BROADCAST_DIR, BROADCAST_MESSAGES_PER_SECOND
+    global CONVERSATIONS_FILE, FAVORITES_FILE
+    PROCESS_ROLE = "worker"
+    WORKER_INDEX = index
+    CONVERSATIONS_FILE = state_shards.shard_path(CONVERSATIONS_FILE, index)
+    FAVORITES_FILE = state_shards.shard_path(FAVORITES_FILE, index)
+    ALERTS_FILE = state_shards.shard_path(ALERTS_FILE, index)
+    DIGESTS_FILE = state_shards.shard_path(DIGESTS_FILE, index)
+    BROADCAST_DIR = os.path.join(BROADCAST_DIR, f"w{index}")
+    BROADCAST_MESSAGES_PER_SECOND = max(1, BROADCAST_MESSAGES_PER_SECOND // count)
+
+
+# Раскладка состояния чатов под число процессов (до запуска воркеров)
+def reshard_state(count):
+    """
+    Собирает оповещения, подписки, избранное и сессии из файлов, оставшихся от
+    запуска с другим числом воркеров (или без них), и раскладывает по файлам
+    для count процессов (1 - обычный режим). См. state_shards.py.
+    """
+    try:
+        state_shards.reshard_file(ALERTS_FILE, count, state_shards.split_alerts, state_shards.alert_keys)
+        for path in (DIGESTS_FILE, FAVORITES_FILE, CONVERSATIONS_FILE):
+            state_shards.reshard_file(path, count, state_shards.split_mapping, state_shards.mapping_keys)
+        state_shards.reshard_broadcasts(BROADCAST_DIR, count)
+    except OSError as e:
+        logger.error(f"Ошибка при перераспределении состояния чатов: {e}")
+
+
+# Предельное время запроса к API курсов (у aiohttp по умолчанию 5 минут)
+UPSTREAM_TIMEOUT = env_number("UPSTREAM_TIMEOUT", 20.0, float)
+
+
+# Получение общего ClientSession (aiohttp импортируется при первом обращении)
+def get_client_session():
     global client_session
-    if client_session is None or (client_session and client_session.closed):
-        client_session = aiohttp.ClientSession()
+    if client_session is None or client_session.closed:
+        import aiohttp
+
+        client_session = aiohttp.ClientSession(timeout=aiohttp.ClientTimeout(total=UPSTREAM_TIMEOUT))
+    return client_session
+
+
+# Предварительная загрузка данных при старте бота
+async def preload_exchange_rates(force_update=True):
+    """
+    :param force_update: False - запрашивать только источники, курсы которых
+        устарели (после загрузки снимка, оставленного предыдущим процессом).
+    """
+    get_client_session()
     logger.info("Предварительная загрузка курсов валют...")
 
     # Обновление курсов мировых валют
-    await get_exchange_rates(force_update=True, cache_key="world_rates", cache_time=CACHE_TIME_WORLD)
+    await get_exchange_rates(force_update=force_update, cache_key="world_rates")
 
     # Обновление курсов региональных валют
-    await get_exchange_rates(force_update=True, cache_key="regional_rates", cache_time=CACHE_TIME_REGIONAL)
+    await get_exchange_rates(force_update=force_update, cache_key="regional_rates")
+
+    # Обновление списка криптовалют (не чаще раза в сутки) и их курсов
+    await crypto_universe.refresh(client_session, max_age=CRYPTO_UNIVERSE_REFRESH)
+    await get_crypto_exchange_rates_with_fallback(force_update=force_update)
 
-    # Обновление курсов криптовалют через CoinGecko
-    await get_crypto_exchange_rates_with_fallback(force_update=True)
+
+# Фоновое обновление курсов по адаптивным интервалам
+async def refresh_rates_periodically():
+    """
+    Источник запрашивается, когда истек его интервал (см. refresh_scheduler);
+    функции запроса сами проверяют свежесть кэша и бюджет API. Здесь же раз в
+    CRYPTO_UNIVERSE_REFRESH секунд обновляется список криптовалют (и в супервизоре).
+    """
+    while True:
+        await asyncio.sleep(REFRESH_CHECK_INTERVAL)
+        try:
+            await get_exchange_rates(cache_key="world_rates")
+            await get_exchange_rates(cache_key="regional_rates")
+            # Список криптовалют обновляется раз в сутки
+            if await crypto_universe.refresh(get_client_session(), max_age=CRYPTO_UNIVERSE_REFRESH):
+                rebuild_currency_index()
+            await get_crypto_exchange_rates_with_fallback()
+        except Exception as e:
+            logger.error(f"Ошибка при фоновом обновлении курсов: {e}")
+        # Расход API за проход сохраняется одной записью
+        api_budgets.flush()
 
 
 # Закрытие ClientSession при завершении работы
@@ -191,166 +681,185 @@ ALL_CURRENCIES = {
     **REGIONAL_CURRENCIES,
 }
 
+# Набор криптовалют: топ-N монет по капитализации из рейтинга CoinGecko
+try:
+    CRYPTO_TOP_N = int(os.getenv("CRYPTO_TOP_N", "50"))
+except ValueError:
+    logger.error("Неверное значение для CRYPTO_TOP_N. Используется значение по умолчанию.")
+    CRYPTO_TOP_N = 50
+CRYPTO_BATCH_SIZE = 100  # Монет в одном запросе к CoinGecko/CoinMarketCap
+CRYPTO_KEYBOARD_SIZE = 10  # Монет на клавиатурах и в списке курсов
+CRYPTO_MIN_COVERAGE = 0.5  # Минимальная доля монет с курсом, чтобы принять ответ источника
+CRYPTO_UNIVERSE_REFRESH = 86400  # Рейтинг монет обновляется раз в сутки
+CRYPTO_UNIVERSE_FILE = os.getenv("CRYPTO_UNIVERSE_FILE", os.path.join(os.getcwd(), "data", "crypto_universe.json"))
+crypto_universe = CryptoUniverse(
+    CRYPTO_TOP_N, CRYPTO_UNIVERSE_FILE, excluded_symbols=set(ISO_CURRENCIES) | set(ALL_CURRENCIES)
+)
+
+# Поисковый индекс по всем валютам (фиат из ответа API + криптовалюты)
+currency_index = CurrencyIndex()
+currency_index_codes = None
+CURRENCY_SEARCH_LIMIT = 10
+CURRENCY_SEARCH_HINT = "\n\n🔎 Или отправьте код, название или страну валюты для поиска."
+
+# Шаги диалога, на которых текст пользователя считается поисковым запросом,
+# и шаг клавиатуры с результатами ('from' - исходная валюта, 'to' - целевая)
+CURRENCY_SEARCH_STEPS = {
+    Step.SEARCH_CURRENCY: "from",
+    Step.SELECT_FROM: "from",
+    Step.SELECT_FROM_CRYPTO: "from",
+    Step.SELECT_TO: "to",
+    Step.SELECT_TO_CRYPTO: "to",
+}
+
+
+# Проверка, является ли валюта криптовалютой
+def is_crypto_currency(currency):
+    return currency in crypto_universe
+
+
+# Криптовалюты для клавиатур (самые крупные по капитализации)
+def get_keyboard_crypto_symbols():
+    return crypto_universe.symbols(CRYPTO_KEYBOARD_SIZE)
+
+
+# Проверка полноты ответа источника курсов криптовалют
+def has_enough_crypto_rates(rates):
+    return bool(rates) and len(rates) >= len(crypto_universe) * CRYPTO_MIN_COVERAGE
+
 
 # Безопасное редактирование сообщения
 async def safe_edit_message(query, text, reply_markup):
     if query.message.text != text or query.message.reply_markup != reply_markup:
         await query.edit_message_text(text=text, reply_markup=reply_markup)
     else:
-        logger.info("Сообщение не изменилось, обновление не требуется.")
-
+        logger.info("Сообщение не изменилось, обновление не требуется.", extra={"event": "message_unchanged"})
 
-# Закрытие ClientSession
-async def close_connector():
-    global client_session
-    if client_session and not client_session.closed:
-        try:
-            await client_session.close()
-            logger.info("ClientSession успешно закрыт.")
-        except Exception as e:
-            logger.error(f"Ошибка при закрытии ClientSession: {e}")
-    client_session = None
 
 # Переход к следующему блоку6
-# Функция для получения курсов валют
-async def get_exchange_rates(force_update=False, cache_key="world_rates", cache_time=CACHE_TIME_WORLD):
-    """
-    Получает курсы валют из API с возможностью использования закэшированных данных.
-    Поддерживает как фиатные валюты, так и криптовалюты.
-    """
-    global exchange_rates_world, exchange_rates_regional, last_update_world, last_update_regional, client_session
-    current_time = time.time()
-
-    # Определяем используемые глобальные переменные в зависимости от ключа кэша
-    rates_dict = {
-        "world_rates": [exchange_rates_world, last_update_world],
-        "regional_rates": [exchange_rates_regional, last_update_regional]
+# Запрос одной части списка монет к CoinGecko
+async def fetch_coingecko_chunk(ids):
+    url = "https://api.coingecko.com/api/v3/simple/price"
+    params = {
+        "ids": ",".join(ids),
+        "vs_currencies": "usd",
     }
-    rates, last_update = rates_dict.get(cache_key, (None, None))
-
-    # Проверяем, можно ли использовать закэшированные данные
-    if not force_update and last_update and (current_time - last_update < cache_time):
-        logger.info(f"Используются закэшированные курсы ({cache_key}).")
-        return rates
-
-    # Инициализация ClientSession, если она не создана или закрыта
-    if not client_session or client_session.closed:
-        client_session = aiohttp.ClientSession()
-
-    # URL для запроса курсов валют
-    url = "https://api.exchangerate-api.com/v4/latest/USD"
-    try:
-        async with client_session.get(url) as response:
+    api_budgets.spend("coingecko")
+    with metrics.track("coingecko"):
+        async with client_session.get(url, params=params) as response:
             if response.status != 200:
-                logger.error(f"Ошибка при запросе к API ({url}): {response.status}")
-                return None
-            data = await response.json()
-            new_rates = data.get("rates", {})
-
-            # Обновляем глобальные переменные в зависимости от ключа кэша
-            if cache_key == "world_rates":
-                exchange_rates_world = new_rates
-                last_update_world = current_time
-            elif cache_key == "regional_rates":
-                exchange_rates_regional = new_rates
-                last_update_regional = current_time
-
-            logger.info(f"Курсы валют обновлены ({cache_key}).")
-            return new_rates
-    except Exception as e:
-        logger.error(f"Ошибка при запросе к API ({url}): {e}")
-        return None
+                raise RuntimeError(f"статус {response.status}")
+            return await read_json(response)
 
 
 # Функция для получения курсов криптовалют через CoinGecko
 async def get_crypto_exchange_rates_coingecko(force_update=False):
     """
     Получает курсы криптовалют через CoinGecko API.
+    Список монет разбивается на части по CRYPTO_BATCH_SIZE, части запрашиваются параллельно.
     """
     global client_session, exchange_rates_crypto, last_update_crypto
 
     current_time = time.time()
 
     # Проверяем, можно ли использовать закэшированные данные
-    if not force_update and last_update_crypto and (current_time - last_update_crypto < CACHE_TIME_CRYPTO):
-        logger.info("Используются закэшированные курсы криптовалют.")
+    if not force_update and refresh_scheduler.is_fresh("crypto", last_update_crypto, current_time):
+        logger.info("Используются закэшированные курсы криптовалют.", extra=CACHE_HIT_LOG_EXTRA)
         return exchange_rates_crypto
 
-    url = "https://api.coingecko.com/api/v3/simple/price"
-    params = {
-        "ids": "bitcoin,ethereum,binancecoin,ripple,cardano",
-        "vs_currencies": "usd",
-    }
+    chunks = list(chunked(crypto_universe.ids(), CRYPTO_BATCH_SIZE))
+    if not api_budgets.allow("coingecko", len(chunks)):
+        return None
+
+    get_client_session()
 
     try:
-        async with client_session.get(url, params=params) as response:
-            if response.status == 200:
-                data = await response.json()
-                new_rates = {
-                    "BTC": data.get("bitcoin", {}).get("usd"),
-                    "ETH": data.get("ethereum", {}).get("usd"),
-                    "BNB": data.get("binancecoin", {}).get("usd"),
-                    "XRP": data.get("ripple", {}).get("usd"),
-                    "ADA": data.get("cardano", {}).get("usd"),
-                }
-                if all(new_rates.values()):
-                    exchange_rates_crypto = new_rates
-                    last_update_crypto = current_time
-                    logger.info("Курсы криптовалют успешно обновлены через CoinGecko.")
-                    return new_rates
-                else:
-                    logger.error("Некорректные данные от CoinGecko.")
-            else:
-                logger.error(f"Ошибка при запросе к CoinGecko: {response.status}")
+        results = await asyncio.gather(*(fetch_coingecko_chunk(ids) for ids in chunks))
+        new_rates = {}
+        for data in results:
+            for coin_id, prices in data.items():
+                symbol = crypto_universe.id_to_symbol.get(coin_id)
+                if symbol and prices.get("usd"):
+                    new_rates[symbol] = prices["usd"]
+        if has_enough_crypto_rates(new_rates):
+            refresh_scheduler.observe("crypto", exchange_rates_crypto, new_rates)
+            exchange_rates_crypto = new_rates
+            last_update_crypto = current_time
+            rates_versions["crypto"] += 1
+            on_rates_updated(current_time)
+            logger.info("Курсы криптовалют успешно обновлены через CoinGecko (%s монет, %s запросов).", len(new_rates), len(results))
+            return new_rates
+        else:
+            logger.error("Некорректные данные от CoinGecko.")
     except Exception as e:
         logger.error(f"Ошибка при запросе к CoinGecko: {e}")
     return None
 
 
+# Стоимость запроса котировок CoinMarketCap: 1 кредит за каждые 100 монет
+def coinmarketcap_credits(symbols):
+    return (len(symbols) + 99) // 100
+
+
+# Запрос одной части списка монет к CoinMarketCap
+async def fetch_coinmarketcap_chunk(symbols):
+    url = "https://pro-api.coinmarketcap.com/v1/cryptocurrency/quotes/latest"
+    params = {
+        "symbol": ",".join(symbols),
+        "convert": "USD",
+        "skip_invalid": "true",
+    }
+    headers = {
+        "X-CMC_PRO_API_KEY": os.getenv("COINMARKETCAP_API_KEY"),
+    }
+    api_budgets.spend("coinmarketcap", coinmarketcap_credits(symbols))
+    with metrics.track("coinmarketcap"):
+        async with client_session.get(url, params=params, headers=headers) as response:
+            if response.status != 200:
+                raise RuntimeError(f"статус {response.status}")
+            data = await read_json(response)
+            return data.get("data", {})
+
+
 # Функция для получения курсов криптовалют через CoinMarketCap
 async def get_crypto_exchange_rates_coinmarketcap(force_update=False):
     """
     Получает курсы криптовалют через CoinMarketCap API.
+    Символы запрашиваются частями по CRYPTO_BATCH_SIZE параллельно.
     """
     global client_session, exchange_rates_crypto, last_update_crypto
 
     current_time = time.time()
 
     # Проверяем, можно ли использовать закэшированные данные
-    if not force_update and last_update_crypto and (current_time - last_update_crypto < CACHE_TIME_CRYPTO):
-        logger.info("Используются закэшированные курсы криптовалют.")
+    if not force_update and refresh_scheduler.is_fresh("crypto", last_update_crypto, current_time):
+        logger.info("Используются закэшированные курсы криптовалют.", extra=CACHE_HIT_LOG_EXTRA)
         return exchange_rates_crypto
 
-    url = "https://pro-api.coinmarketcap.com/v1/cryptocurrency/quotes/latest"
-    params = {
-        "symbol": "BTC,ETH,BNB,XRP,ADA",
-        "convert": "USD",
-    }
-    headers = {
-        "X-CMC_PRO_API_KEY": os.getenv("COINMARKETCAP_API_KEY"),
-    }
+    chunks = list(chunked(crypto_universe.symbols(), CRYPTO_BATCH_SIZE))
+    if not api_budgets.allow("coinmarketcap", sum(coinmarketcap_credits(symbols) for symbols in chunks)):
+        return None
+
+    get_client_session()
 
     try:
-        async with client_session.get(url, params=params, headers=headers) as response:
-            if response.status == 200:
-                data = await response.json()
-                quotes = data.get("data", {})
-                new_rates = {
-                    "BTC": quotes.get("BTC", {}).get("quote", {}).get("USD", {}).get("price"),
-                    "ETH": quotes.get("ETH", {}).get("quote", {}).get("USD", {}).get("price"),
-                    "BNB": quotes.get("BNB", {}).get("quote", {}).get("USD", {}).get("price"),
-                    "XRP": quotes.get("XRP", {}).get("quote", {}).get("USD", {}).get("price"),
-                    "ADA": quotes.get("ADA", {}).get("quote", {}).get("USD", {}).get("price"),
-                }
-                if all(new_rates.values()):
-                    exchange_rates_crypto = new_rates
-                    last_update_crypto = current_time
-                    logger.info("Курсы криптовалют успешно обновлены через CoinMarketCap.")
-                    return new_rates
-                else:
-                    logger.error("Некорректные данные от CoinMarketCap.")
-            else:
-                logger.error(f"Ошибка при запросе к CoinMarketCap: {response.status}")
+        results = await asyncio.gather(*(fetch_coinmarketcap_chunk(symbols) for symbols in chunks))
+        new_rates = {}
+        for quotes in results:
+            for symbol, quote in quotes.items():
+                price = quote.get("quote", {}).get("USD", {}).get("price")
+                if symbol in crypto_universe and price:
+                    new_rates[symbol] = price
+        if has_enough_crypto_rates(new_rates):
+            refresh_scheduler.observe("crypto", exchange_rates_crypto, new_rates)
+            exchange_rates_crypto = new_rates
+            last_update_crypto = current_time
+            rates_versions["crypto"] += 1
+            on_rates_updated(current_time)
+            logger.info("Курсы криптовалют успешно обновлены через CoinMarketCap (%s монет, %s запросов).", len(new_rates), len(results))
+            return new_rates
+        else:
+            logger.error("Некорректные данные от CoinMarketCap.")
     except Exception as e:
         logger.error(f"Ошибка при запросе к CoinMarketCap: {e}")
     return None
@@ -361,6 +870,10 @@ async def get_crypto_exchange_rates_with_fallback(force_update=False):
     """
     Получает курсы криптовалют через несколько источников с возможностью самозамены.
     """
+    # Воркер использует общий снимок курсов, который обновляет супервизор
+    if PROCESS_ROLE == "worker":
+        return exchange_rates_crypto
+
     sources = [
         {"func": get_crypto_exchange_rates_coingecko, "name": "CoinGecko"},
         {"func": get_crypto_exchange_rates_coinmarketcap, "name": "CoinMarketCap"},
@@ -368,38 +881,54 @@ async def get_crypto_exchange_rates_with_fallback(force_update=False):
 
     for source in sources:
         try:
-            rates = await source["func"](force_update=True)
+            rates = await source["func"](force_update=force_update)
             if rates:
-                logger.info(f"Курсы криптовалют успешно получены через {source['name']}.")
+                logger.info("Курсы криптовалют успешно получены через %s.", source["name"])
                 return rates
             else:
-                logger.warning(f"Некорректные данные от {source['name']}.")
+                logger.warning("Некорректные данные от %s.", source["name"])
         except Exception as e:
-            logger.error(f"Ошибка при запросе к {source['name']}: {e}")
+            logger.error("Ошибка при запросе к %s: %s", source["name"], e)
 
     logger.error("Не удалось получить курсы криптовалют ни из одного источника.")
     return None
 
 # Переход к следующему блоку7
 # Создание главного меню
-def create_main_menu_keyboard():
-    keyboard = [
-        [InlineKeyboardButton("🌍 Европа 🇪🇺", callback_data="europe_currencies")],
-        [InlineKeyboardButton("🌏 Азия 🇯🇵", callback_data="asia_currencies")],
-        [InlineKeyboardButton("NORTH Америка 🇺🇸", callback_data="north_america_currencies")],
-        [InlineKeyboardButton("SOUTH Америка 🇧🇷", callback_data="south_america_currencies")],
-        [InlineKeyboardButton("🇦🇺 Австралия и Океания 🌊", callback_data="australia_oceania_currencies")],
-        [InlineKeyboardButton("🌍 Африка 🇪🇬", callback_data="africa_currencies")],
-        [InlineKeyboardButton("₿ Криптовалюты ⚡", callback_data="crypto_currencies")],
-        [InlineKeyboardButton("🔍 Конвертировать валюту 💱", callback_data="convert_currency")],
-        [InlineKeyboardButton("🔄 Обновить курсы 🔄", callback_data="update_rates")],
+def create_main_menu_keyboard(user_id=None):
+    """
+    :param user_id: Если указан, первой строкой показываются избранные пары пользователя.
+    """
+    from telegram import InlineKeyboardButton, InlineKeyboardMarkup
+
+    keyboard = []
+    if user_id is not None:
+        pairs = get_favorite_pairs().top(user_id, FAVORITES_KEYBOARD_SIZE)
+        if pairs:
+            keyboard.append([
+                InlineKeyboardButton(f"⭐ {base} → {quote}", callback_data=encode_callback("p", base, quote))
+                for base, quote in pairs
+            ])
+    keyboard += [
+        [InlineKeyboardButton("🌍 Европа 🇪🇺", callback_data=encode_callback("r", "eu"))],
+        [InlineKeyboardButton("🌏 Азия 🇯🇵", callback_data=encode_callback("r", "as"))],
+        [InlineKeyboardButton("NORTH Америка 🇺🇸", callback_data=encode_callback("r", "na"))],
+        [InlineKeyboardButton("SOUTH Америка 🇧🇷", callback_data=encode_callback("r", "sa"))],
+        [InlineKeyboardButton("🇦🇺 Австралия и Океания 🌊", callback_data=encode_callback("r", "oc"))],
+        [InlineKeyboardButton("🌍 Африка 🇪🇬", callback_data=encode_callback("r", "af"))],
+        [InlineKeyboardButton("₿ Криптовалюты ⚡", callback_data=encode_callback("c"))],
+        [InlineKeyboardButton("🔍 Конвертировать валюту 💱", callback_data=encode_callback("cv"))],
+        [InlineKeyboardButton("🔎 Найти валюту", callback_data=encode_callback("s"))],
+        [InlineKeyboardButton("🔄 Обновить курсы 🔄", callback_data=encode_callback("u"))],
     ]
     return InlineKeyboardMarkup(keyboard)
 
 
 # Создание кнопки "Назад"
 def create_back_keyboard():
-    keyboard = [[InlineKeyboardButton("⬅️ Назад", callback_data="start")]]
+    from telegram import InlineKeyboardButton, InlineKeyboardMarkup
+
+    keyboard = [[InlineKeyboardButton("⬅️ Назад", callback_data=encode_callback("m"))]]
     return InlineKeyboardMarkup(keyboard)
 
 
@@ -412,13 +941,15 @@ def create_currency_selection_keyboard(currencies, step):
     :param step: Текущий шаг выбора ('from' - исходная валюта, 'to' - целевая валюта, 'from_crypto' - исходная криптовалюта, 'to_crypto' - целевая криптовалюта).
     :return: InlineKeyboardMarkup объект.
     """
+    from telegram import InlineKeyboardButton, InlineKeyboardMarkup
+
     keyboard = []
     for currency in currencies:
         flag = get_currency_flag(currency)  # Получаем флаг или символ для валюты
-        keyboard.append([InlineKeyboardButton(f"{currency} {flag}", callback_data=f"{step}_{currency}")])
+        keyboard.append([InlineKeyboardButton(f"{currency} {flag}", callback_data=encode_callback(STEP_ROUTES[step], currency))])
 
     # Добавляем кнопку "Назад"
-    keyboard.append([InlineKeyboardButton("⬅️ Назад", callback_data="back")])
+    keyboard.append([InlineKeyboardButton("⬅️ Назад", callback_data=encode_callback("b"))])
     return InlineKeyboardMarkup(keyboard)
 
 
@@ -469,7 +1000,9 @@ def get_currency_flag(currency):
         "XRP": "✨",  # Ripple
         "ADA": "♠️",  # Cardano
     }
-    return flags.get(currency, "")  # Возвращаем пустую строку, если флаг не найден
+    if currency in flags:
+        return flags[currency]
+    return currency_flag(currency)  # Флаг по коду ISO 4217 или пустая строка
 
 
 # Переход к следующему блоку8
@@ -479,7 +1012,7 @@ async def start(update: Update, context: ContextTypes.DEFAULT_TYPE):
     Обработчик команды /start.
     """
     user = update.effective_user
-    logger.info(f"Пользователь {user.id} ({user.username}) вызвал команду /start")
+    logger.info("Пользователь %s (%s) вызвал команду /start", user.id, user.username)
 
     # Приветствие на двух языках
     await update.message.reply_text(
@@ -489,318 +1022,332 @@ async def start(update: Update, context: ContextTypes.DEFAULT_TYPE):
         "Я могу показывать актуальные курсы валют и помогать вам конвертировать одну валюту в другую.\n\n"
         "Choose an action / Выберите действие:",
         parse_mode="HTML",
-        reply_markup=create_main_menu_keyboard(),
+        reply_markup=create_main_menu_keyboard(user.id),
     )
 
 
 # Переход к следующему блоку9
-# Обработка нажатий на кнопки
-async def button_handler(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    query = update.callback_query
-    await query.answer()  # Подтверждаем получение запроса от Telegram
+# Таблица маршрутов inline-кнопок (см. callback_router.py)
+callback_router = CallbackRouter()
+
+# Коды регионов в данных кнопок
+REGION_ROUTES = {
+    "eu": (EUROPE_CURRENCIES, "Европы"),
+    "as": (ASIA_CURRENCIES, "Азии"),
+    "na": (NORTH_AMERICA_CURRENCIES, "Северной Америки"),
+    "sa": (SOUTH_AMERICA_CURRENCIES, "Южной Америки"),
+    "oc": (AUSTRALIA_OCEANIA_CURRENCIES, "Австралии и Океании"),
+    "af": (AFRICA_CURRENCIES, "Африки"),
+}
 
-    try:
-        if query.data == "start":
-            # Пользователь вернулся в главное меню
-            logger.info(f"Пользователь {query.from_user.id} ({query.from_user.username}) вернулся в главное меню")
-            message = "Главное меню\nВыберите действие:"
-            await safe_edit_message(query, message, create_main_menu_keyboard())
-            context.user_data.clear()  # Очищаем данные пользователя при возврате в главное меню
-
-        elif query.data == "update_rates":
-            # Обновление курсов валют
-            logger.info(f"Пользователь {query.from_user.id} ({query.from_user.username}) выбрал 'Обновить курсы'")
-            rates = await get_crypto_exchange_rates_with_fallback(force_update=True)
-            if rates:
-                message = "Курсы валют успешно обновлены!"
-            else:
-                message = "Не удалось обновить курсы валют. Попробуйте позже."
-            await safe_edit_message(query, message, create_main_menu_keyboard())
-
-        elif query.data in [
-            "europe_currencies", "asia_currencies",
-            "north_america_currencies", "south_america_currencies",
-            "australia_oceania_currencies", "africa_currencies"
-        ]:
-            # Обработка выбора региональных валют
-            region_map = {
-                "europe_currencies": (EUROPE_CURRENCIES, "Европы"),
-                "asia_currencies": (ASIA_CURRENCIES, "Азии"),
-                "north_america_currencies": (NORTH_AMERICA_CURRENCIES, "Северной Америки"),
-                "south_america_currencies": (SOUTH_AMERICA_CURRENCIES, "Южной Америки"),
-                "australia_oceania_currencies": (AUSTRALIA_OCEANIA_CURRENCIES, "Австралии и Океании"),
-                "africa_currencies": (AFRICA_CURRENCIES, "Африки"),
-            }
-
-            if query.data in region_map:
-                region_currencies, region_name = region_map[query.data]
-                await handle_region_currencies(query, region_currencies, region_name)
-            else:
-                logger.error(f"Неизвестный регион: {query.data}")
-                message = "Произошла ошибка. Пожалуйста, начните заново."
-                await safe_edit_message(query, message, create_main_menu_keyboard())
-
-        elif query.data == "crypto_currencies":
-            # Обработка выбора криптовалют
-            logger.info(f"Пользователь {query.from_user.id} ({query.from_user.username}) выбрал 'Криптовалюты'")
-            rates = await get_crypto_exchange_rates_with_fallback()
-            if rates:
-                crypto_currencies = {
-                    "BTC": "Bitcoin ₿",
-                    "ETH": "Ethereum Ξ",
-                    "BNB": "Binance Coin 💎",
-                    "XRP": "Ripple ✨",
-                    "ADA": "Cardano ♠️",
-                }
-                message = "Текущие курсы популярных криптовалют:\n\n"
-                for currency, name in crypto_currencies.items():
-                    message += f"{name} ({currency}) = {rates.get(currency, '— данные недоступны'):.2f} USD\n"
-
-                keyboard = []
-                for currency in crypto_currencies.keys():
-                    emoji = {"BTC": "₿", "ETH": "Ξ", "BNB": "💎", "XRP": "✨", "ADA": "♠️"}.get(currency, "")
-                    keyboard.append([InlineKeyboardButton(f"{currency} {emoji}", callback_data=f"convert_from_crypto_{currency}")])
-
-                keyboard.append([InlineKeyboardButton("🔍 Конвертировать крипту", callback_data="convert_crypto_currency")])
-                keyboard.append([InlineKeyboardButton("⬅️ Назад", callback_data="start")])
-
-                await safe_edit_message(query, message, InlineKeyboardMarkup(keyboard))
-            else:
-                message = "Не удалось получить курсы криптовалют. Попробуйте позже."
-                await safe_edit_message(query, message, create_main_menu_keyboard())
+# Маршруты выбора валюты для каждого шага клавиатуры
+STEP_ROUTES = {
+    "from": "f",
+    "to": "t",
+    "from_crypto": "fc",
+    "to_crypto": "tc",
+}
 
-        elif query.data == "convert_currency":
-            # Начало конвертации обычных валют
-            logger.info(f"Пользователь {query.from_user.id} ({query.from_user.username}) выбрал 'Конвертировать валюту'")
-            rates = await get_exchange_rates(cache_key="world_rates", cache_time=CACHE_TIME_WORLD)
-            if rates:
-                message = "Выберите исходную валюту:"
-                available_currencies = list(ALL_CURRENCIES.keys()) + ["BTC", "ETH", "BNB", "XRP", "ADA"]
-                await safe_edit_message(query, message, create_currency_selection_keyboard(available_currencies, step="from"))
-                context.user_data["step"] = "select_from_currency"
-            else:
-                message = "Не удалось получить курсы валют. Попробуйте позже."
-                await safe_edit_message(query, message, create_main_menu_keyboard())
 
-        elif query.data == "convert_crypto_currency":
-            # Начало конвертации криптовалют
-            logger.info(f"Пользователь {query.from_user.id} ({query.from_user.username}) выбрал 'Конвертировать криптовалюту'")
-            rates = await get_crypto_exchange_rates_with_fallback()
-            if rates:
-                message = "Выберите исходную криптовалюту:"
-                available_currencies = ["BTC", "ETH", "BNB", "XRP", "ADA"]
-                await safe_edit_message(query, message, create_currency_selection_keyboard(available_currencies, step="from_crypto"))
-                context.user_data["step"] = "select_from_crypto_currency"
-            else:
-                message = "Не удалось получить курсы криптовалют. Попробуйте позже."
-                await safe_edit_message(query, message, create_main_menu_keyboard())
-
-        elif query.data.startswith("from_"):
-            # Пользователь выбрал исходную валюту
-            from_currency = query.data.split("_")[1]
-            context.user_data["from_currency"] = from_currency
-            logger.info(f"Пользователь {query.from_user.id} ({query.from_user.username}) выбрал исходную валюту: {from_currency}")
-
-            message = f"Вы выбрали исходную валюту: {from_currency}\n\nВыберите целевую валюту:"
-            available_currencies = [c for c in list(ALL_CURRENCIES.keys()) + ["BTC", "ETH", "BNB", "XRP", "ADA"] if c != from_currency]
-            await safe_edit_message(query, message, create_currency_selection_keyboard(available_currencies, step="to"))
-            context.user_data["step"] = "select_to_currency"
-
-        elif query.data.startswith("from_crypto_"):
-            # Пользователь выбрал исходную криптовалюту
-            from_currency = query.data.split("_")[2]
-            context.user_data["from_currency"] = from_currency
-            logger.info(f"Пользователь {query.from_user.id} ({query.from_user.username}) выбрал исходную криптовалюту: {from_currency}")
-
-            message = f"Вы выбрали исходную криптовалюту: {from_currency}\n\nВыберите целевую валюту:"
-            available_currencies = list(ALL_CURRENCIES.keys()) + ["BTC", "ETH", "BNB", "XRP", "ADA"]
-            await safe_edit_message(query, message, create_currency_selection_keyboard(available_currencies, step="to_crypto"))
-            context.user_data["step"] = "select_to_currency_crypto"
-
-        elif query.data.startswith("to_"):
-            # Пользователь выбрал целевую валюту
-            to_currency = query.data.split("_")[1]
-            context.user_data["to_currency"] = to_currency
-            logger.info(f"Пользователь {query.from_user.id} ({query.from_user.username}) выбрал целевую валюту: {to_currency}")
-
-            from_currency = context.user_data.get("from_currency")
-            if not from_currency:
-                message = "Ошибка: Не выбрана исходная валюта."
-                await safe_edit_message(query, message, create_main_menu_keyboard())
-                return
+# Клавиатура выбора исходной валюты
+async def show_from_currency_selection(query, context):
+    message = "Выберите исходную валюту:" + CURRENCY_SEARCH_HINT
+    available_currencies = list(ALL_CURRENCIES.keys()) + get_keyboard_crypto_symbols()
+    await safe_edit_message(query, message, create_currency_selection_keyboard(available_currencies, step="from"))
+    get_session(query.from_user).step = Step.SELECT_FROM
 
-            message = f"Вы выбрали конвертацию из {from_currency} в {to_currency}.\n\nВведите сумму для конвертации:"
-            await safe_edit_message(query, message, create_back_keyboard())
-            context.user_data["step"] = "enter_amount"
 
-        elif query.data.startswith("to_crypto_"):
-            # Пользователь выбрал целевую валюту для криптовалют
-            to_currency = query.data.split("_")[2]
-            context.user_data["to_currency"] = to_currency
-            logger.info(f"Пользователь {query.from_user.id} ({query.from_user.username}) выбрал целевую валюту: {to_currency}")
+# Клавиатура выбора исходной криптовалюты
+async def show_from_crypto_selection(query, context):
+    message = "Выберите исходную криптовалюту:"
+    available_currencies = get_keyboard_crypto_symbols()
+    await safe_edit_message(query, message, create_currency_selection_keyboard(available_currencies, step="from_crypto"))
+    get_session(query.from_user).step = Step.SELECT_FROM_CRYPTO
 
-            from_currency = context.user_data.get("from_currency")
-            if not from_currency:
-                message = "Ошибка: Не выбрана исходная валюта."
-                await safe_edit_message(query, message, create_main_menu_keyboard())
-                return
 
-            message = f"Вы выбрали конвертацию из {from_currency} в {to_currency}.\n\nВведите сумму для конвертации:"
-            await safe_edit_message(query, message, create_back_keyboard())
-            context.user_data["step"] = "enter_amount_crypto"
-
-        elif query.data == "back":
-            # Возвращение назад
-            current_step = context.user_data.get("step")
-            if current_step == "select_to_currency":
-                message = "Выберите исходную валюту:"
-                available_currencies = list(ALL_CURRENCIES.keys()) + ["BTC", "ETH", "BNB", "XRP", "ADA"]
-                await safe_edit_message(query, message, create_currency_selection_keyboard(available_currencies, step="from"))
-                context.user_data["step"] = "select_from_currency"
-            elif current_step == "enter_amount":
-                from_currency = context.user_data.get("from_currency")
-                if from_currency:
-                    message = f"Вы выбрали исходную валюту: {from_currency}\n\nВыберите целевую валюту:"
-                    available_currencies = [c for c in list(ALL_CURRENCIES.keys()) + ["BTC", "ETH", "BNB", "XRP", "ADA"] if c != from_currency]
-                    await safe_edit_message(query, message, create_currency_selection_keyboard(available_currencies, step="to"))
-                    context.user_data["step"] = "select_to_currency"
-                else:
-                    message = "Выберите исходную валюту:"
-                    available_currencies = list(ALL_CURRENCIES.keys()) + ["BTC", "ETH", "BNB", "XRP", "ADA"]
-                    await safe_edit_message(query, message, create_currency_selection_keyboard(available_currencies, step="from"))
-                    context.user_data["step"] = "select_from_currency"
-            elif current_step == "select_to_currency_crypto":
-                message = "Выберите исходную криптовалюту:"
-                available_currencies = ["BTC", "ETH", "BNB", "XRP", "ADA"]
-                await safe_edit_message(query, message, create_currency_selection_keyboard(available_currencies, step="from_crypto"))
-                context.user_data["step"] = "select_from_crypto_currency"
-            elif current_step == "enter_amount_crypto":
-                from_currency = context.user_data.get("from_currency")
-                if from_currency:
-                    message = f"Вы выбрали исходную криптовалюту: {from_currency}\n\nВыберите целевую валюту:"
-                    available_currencies = list(ALL_CURRENCIES.keys()) + ["BTC", "ETH", "BNB", "XRP", "ADA"]
-                    await safe_edit_message(query, message, create_currency_selection_keyboard(available_currencies, step="to_crypto"))
-                    context.user_data["step"] = "select_to_currency_crypto"
-                else:
-                    message = "Выберите исходную криптовалюту:"
-                    available_currencies = ["BTC", "ETH", "BNB", "XRP", "ADA"]
-                    await safe_edit_message(query, message, create_currency_selection_keyboard(available_currencies, step="from_crypto"))
-                    context.user_data["step"] = "select_from_crypto_currency"
-            else:
-                message = "Главное меню\nВыберите действие:"
-                await safe_edit_message(query, message, create_main_menu_keyboard())
+# Клавиатура выбора целевой валюты после выбора исходной
+async def show_to_currency_selection(query, context, from_currency):
+    message = f"Вы выбрали исходную валюту: {from_currency}\n\nВыберите целевую валюту:" + CURRENCY_SEARCH_HINT
+    available_currencies = [c for c in list(ALL_CURRENCIES.keys()) + get_keyboard_crypto_symbols() if c != from_currency]
+    await safe_edit_message(query, message, create_currency_selection_keyboard(available_currencies, step="to"))
+    get_session(query.from_user).step = Step.SELECT_TO
 
-    except Exception as e:
-        logger.error(f"Ошибка при обработке кнопки: {e}")
-        message = "Произошла ошибка. Пожалуйста, попробуйте еще раз."
-        await safe_edit_message(query, message, create_main_menu_keyboard())
 
+# Клавиатура выбора целевой валюты после выбора исходной криптовалюты
+async def show_to_crypto_selection(query, context, from_currency):
+    message = f"Вы выбрали исходную криптовалюту: {from_currency}\n\nВыберите целевую валюту:" + CURRENCY_SEARCH_HINT
+    available_currencies = list(ALL_CURRENCIES.keys()) + get_keyboard_crypto_symbols()
+    await safe_edit_message(query, message, create_currency_selection_keyboard(available_currencies, step="to_crypto"))
+    get_session(query.from_user).step = Step.SELECT_TO_CRYPTO
 
-# Обработка текстового ввода для конвертации
-async def convert_currency(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    try:
-        current_step = context.user_data.get("step")
-        if current_step not in ["enter_amount", "enter_amount_crypto"]:
-            message = "Ошибка: Неверный шаг. Пожалуйста, начните заново."
-            await update.message.reply_text(
-                text=message,
-                parse_mode="HTML",
-                reply_markup=create_main_menu_keyboard(),
-            )
-            return
 
-        logger.info(f"Пользователь {update.effective_user.id} ({update.effective_user.username}) ввел сумму для конвертации")
+# Перегружена ли очередь обновлений
+def is_overloaded(context):
+    # При параллельной обработке очередь Application сразу разбирается в задачи,
+    # поэтому учитываются и обновления, ожидающие в обработчике очереди
+    pending = getattr(context.application.update_processor, "pending", 0)
+    return admission.is_overloaded(context.application.update_queue.qsize() + pending)
 
-        # Парсим введенную сумму
-        try:
-            amount = float(update.message.text.strip())
-            if amount <= 0:
-                message = "Сумма должна быть больше нуля."
-                await update.message.reply_text(message, reply_markup=create_back_keyboard())
-                return
-        except ValueError:
-            message = "Некорректный ввод. Введите число."
-            await update.message.reply_text(message, reply_markup=create_back_keyboard())
-            return
 
-        from_currency = context.user_data.get("from_currency")
-        to_currency = context.user_data.get("to_currency")
+# Контроль допуска (группа -1: выполняется до остальных обработчиков)
+async def admission_control(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """
+    Отбрасывает нажатия кнопок, долго ждавшие в очереди или накопившиеся до
+    запуска процесса, старые текстовые сообщения и повторные нажатия одной
+    кнопки. Отброшенные нажатия получают только answerCallbackQuery.
+    """
+    from telegram.error import TelegramError
+    from telegram.ext import ApplicationHandlerStop
 
-        if not from_currency or not to_currency:
-            message = "Ошибка: Не выбрана исходная или целевая валюта."
-            await update.message.reply_text(message, reply_markup=create_main_menu_keyboard())
+    received_at = admission.pop_receipt(update.update_id)
+    query = update.callback_query
+    if query is not None:
+        if query.message is not None:
+            touch_message(query.message.chat_id, query.message.message_id)
+        message_time = None
+        if query.message is not None:
+            message_time = (getattr(query.message, "edit_date", None) or query.message.date).timestamp()
+        decoded = decode_callback(query.data)
+        verdict = admission.check_callback(
+            query.from_user.id, query.data, decoded[0] if decoded else None, received_at, message_time
+        )
+        if verdict == ADMIT:
             return
+        metrics.inc(f"admission_{verdict}_callbacks")
+        logger.info("Нажатие %s пользователя %s отброшено: %s", query.data, query.from_user.id, verdict, extra={"event": "admission"})
+        try:
+            if verdict == STALE:
+                await query.answer("Это меню устарело. Отправьте /start, чтобы открыть новое.")
+            else:
+                await query.answer()
+        except TelegramError:
+            pass  # Слишком старые запросы Telegram уже не принимает
+        raise ApplicationHandlerStop
 
-        # Получаем актуальные курсы
-        rates = {}
-        if from_currency in ALL_CURRENCIES or to_currency in ALL_CURRENCIES:
-            rates.update(await get_exchange_rates(force_update=True, cache_key="world_rates", cache_time=CACHE_TIME_WORLD))
-        if from_currency in ["BTC", "ETH", "BNB", "XRP", "ADA"] or to_currency in ["BTC", "ETH", "BNB", "XRP", "ADA"]:
-            rates.update(await get_crypto_exchange_rates_with_fallback(force_update=True))
+    message = update.message
+    if message is not None and message.text and not message.text.startswith("/"):
+        if admission.check_message(message.date.timestamp()) == STALE:
+            metrics.inc("admission_stale_messages")
+            logger.info("Старое сообщение пользователя %s отброшено", update.effective_user.id, extra={"event": "admission"})
+            raise ApplicationHandlerStop
 
-        if not rates:
-            message = "Не удалось получить курсы валют. Попробуйте позже."
-            await update.message.reply_text(message, reply_markup=create_main_menu_keyboard())
-            return
 
-        # Выполняем конвертацию
-        rate_from = rates.get(from_currency)
-        rate_to = rates.get(to_currency)
-
-        # Логика для конвертации из фиата в крипту
-        if from_currency in ALL_CURRENCIES and to_currency in ["BTC", "ETH", "BNB", "XRP", "ADA"]:
-            # Конвертируем из фиата в USD
-            usd_rate = rates.get("USD", 1)  # Если исходная валюта USD, курс = 1
-            if from_currency != "USD":
-                rate_from = rates.get(from_currency, None)
-                if rate_from is None:
-                    message = f"Не найден курс для {from_currency}."
-                    await update.message.reply_text(message, reply_markup=create_main_menu_keyboard())
-                    return
-                usd_amount = amount / rate_from  # Переводим в USD
-            else:
-                usd_amount = amount  # Если исходная валюта USD
+# Обработка нажатий на кнопки
+async def button_handler(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    query = update.callback_query
+    await query.answer()  # Подтверждаем получение запроса от Telegram
 
-            # Конвертируем из USD в крипту
-            crypto_rate = rates.get(to_currency, None)
-            if crypto_rate is None:
-                message = f"Не найден курс для {to_currency}."
-                await update.message.reply_text(message, reply_markup=create_main_menu_keyboard())
-                return
-            result = usd_amount / crypto_rate  # Переводим в крипту
+    try:
+        await callback_router.dispatch(query, context)
+    except Exception as e:
+        logger.error("Ошибка при обработке кнопки: %s", e)
+        message = "Произошла ошибка. Пожалуйста, попробуйте еще раз."
+        await safe_edit_message(query, message, create_main_menu_keyboard(query.from_user.id))
+
+
+# Кнопка из клавиатуры старой версии или неизвестные данные
+@callback_router.stale
+async def on_stale_callback(query, context):
+    message = "Эта кнопка устарела.\n\nГлавное меню\nВыберите действие:"
+    await safe_edit_message(query, message, create_main_menu_keyboard(query.from_user.id))
+    sessions.drop(query.from_user.id)
+
+
+@callback_router.route("m")
+async def on_main_menu(query, context):
+    # Пользователь вернулся в главное меню
+    logger.info("Пользователь %s (%s) вернулся в главное меню", query.from_user.id, query.from_user.username, extra=CALLBACK_LOG_EXTRA)
+    message = "Главное меню\nВыберите действие:"
+    await safe_edit_message(query, message, create_main_menu_keyboard(query.from_user.id))
+    sessions.drop(query.from_user.id)  # Очищаем данные пользователя при возврате в главное меню
+
+
+@callback_router.route("u")
+async def on_update_rates(query, context):
+    # Обновление курсов валют
+    logger.info("Пользователь %s (%s) выбрал 'Обновить курсы'", query.from_user.id, query.from_user.username, extra=CALLBACK_LOG_EXTRA)
+    # Принудительный запрос к API - не чаще UPDATE_RATES_MIN_INTERVAL и не при перегрузке
+    force_update = time.time() - last_update_crypto >= UPDATE_RATES_MIN_INTERVAL and not is_overloaded(context)
+    rates = await get_source_rates("crypto", force_update=force_update)
+    if rates:
+        message = "Курсы валют успешно обновлены!"
+    else:
+        message = "Не удалось обновить курсы валют. Попробуйте позже."
+    await safe_edit_message(query, message, create_main_menu_keyboard(query.from_user.id))
 
-        # Логика для других типов конвертации
-        else:
-            if from_currency in ["BTC", "ETH", "BNB", "XRP", "ADA"]:
-                rate_from = 1 / rate_from if rate_from else None
-            if to_currency in ["BTC", "ETH", "BNB", "XRP", "ADA"]:
-                rate_to = 1 / rate_to if rate_to else None
-
-            if rate_from is None or rate_to is None:
-                message = "Не удалось выполнить конвертацию. Убедитесь, что выбраны корректные валюты."
-                await update.message.reply_text(message, reply_markup=create_main_menu_keyboard())
-                return
 
-            result = (amount * rate_from) / rate_to if rate_to else None
+@callback_router.route("r", args=1)
+async def on_region(query, context, region):
+    # Обработка выбора региональных валют
+    if region not in REGION_ROUTES:
+        logger.error("Неизвестный регион: %s", region)
+        message = "Произошла ошибка. Пожалуйста, начните заново."
+        await safe_edit_message(query, message, create_main_menu_keyboard(query.from_user.id))
+        return
+    region_currencies, region_name = REGION_ROUTES[region]
+    await handle_region_currencies(query, context, region_currencies, region_name)
 
-        if result is not None:
-            message = f"{amount:.2f} {from_currency} = {result:.8f} {to_currency}"
-        else:
-            message = "Не удалось выполнить конвертацию."
 
-        await update.message.reply_text(message, reply_markup=create_main_menu_keyboard())
+@callback_router.route("c")
+async def on_crypto_rates(query, context):
+    # Обработка выбора криптовалют
+    from telegram import InlineKeyboardButton, InlineKeyboardMarkup
+
+    logger.info("Пользователь %s (%s) выбрал 'Криптовалюты'", query.from_user.id, query.from_user.username, extra=CALLBACK_LOG_EXTRA)
+    rates = await get_source_rates("crypto")
+    if not rates:
+        message = "Не удалось получить курсы криптовалют. Попробуйте позже."
+        await safe_edit_message(query, message, create_main_menu_keyboard(query.from_user.id))
+        return
+
+    crypto_currencies = get_keyboard_crypto_symbols()
+    message = "Текущие курсы популярных криптовалют:\n\n"
+    for currency in crypto_currencies:
+        name = f"{crypto_universe.names.get(currency, currency)} {get_currency_flag(currency)}".strip()
+        rate = rates.get(currency)
+        message += f"{name} ({currency}) = {f'{rate:.2f} USD' if rate else '— данные недоступны'}\n"
+
+    # Нажатие на монету сразу переходит к выбору целевой валюты
+    keyboard = []
+    for currency in crypto_currencies:
+        emoji = get_currency_flag(currency)
+        keyboard.append([InlineKeyboardButton(f"{currency} {emoji}", callback_data=encode_callback("fc", currency))])
+
+    keyboard.append([InlineKeyboardButton("🔍 Конвертировать крипту", callback_data=encode_callback("cc"))])
+    keyboard.append([InlineKeyboardButton("⬅️ Назад", callback_data=encode_callback("m"))])
+    await safe_edit_message(query, message, InlineKeyboardMarkup(keyboard))
+
+
+@callback_router.route("s")
+async def on_find_currency(query, context):
+    # Поиск валюты по названию
+    logger.info("Пользователь %s (%s) выбрал 'Найти валюту'", query.from_user.id, query.from_user.username, extra=CALLBACK_LOG_EXTRA)
+    message = "Отправьте код, название или страну валюты (например: фунт, Japan, KZT):"
+    await safe_edit_message(query, message, create_back_keyboard())
+    get_session(query.from_user).step = Step.SEARCH_CURRENCY
+
+
+@callback_router.route("cv")
+async def on_convert_currency(query, context):
+    # Начало конвертации обычных валют
+    logger.info("Пользователь %s (%s) выбрал 'Конвертировать валюту'", query.from_user.id, query.from_user.username, extra=CALLBACK_LOG_EXTRA)
+    rates = await get_source_rates("world")
+    if rates:
+        await show_from_currency_selection(query, context)
+    else:
+        message = "Не удалось получить курсы валют. Попробуйте позже."
+        await safe_edit_message(query, message, create_main_menu_keyboard(query.from_user.id))
+
+
+@callback_router.route("cc")
+async def on_convert_crypto_currency(query, context):
+    # Начало конвертации криптовалют
+    logger.info("Пользователь %s (%s) выбрал 'Конвертировать криптовалюту'", query.from_user.id, query.from_user.username, extra=CALLBACK_LOG_EXTRA)
+    rates = await get_source_rates("crypto")
+    if rates:
+        await show_from_crypto_selection(query, context)
+    else:
+        message = "Не удалось получить курсы криптовалют. Попробуйте позже."
+        await safe_edit_message(query, message, create_main_menu_keyboard(query.from_user.id))
+
+
+@callback_router.route("f", args=1)
+async def on_from_currency(query, context, from_currency):
+    # Пользователь выбрал исходную валюту
+    get_session(query.from_user).set_from(from_currency)
+    logger.info("Пользователь %s (%s) выбрал исходную валюту: %s", query.from_user.id, query.from_user.username, from_currency, extra=CALLBACK_LOG_EXTRA)
+    await show_to_currency_selection(query, context, from_currency)
+
+
+@callback_router.route("fc", args=1)
+async def on_from_crypto_currency(query, context, from_currency):
+    # Пользователь выбрал исходную криптовалюту
+    get_session(query.from_user).set_from(from_currency)
+    logger.info("Пользователь %s (%s) выбрал исходную криптовалюту: %s", query.from_user.id, query.from_user.username, from_currency, extra=CALLBACK_LOG_EXTRA)
+    await show_to_crypto_selection(query, context, from_currency)
+
+
+# Выбор целевой валюты: общий для обычной и крипто-конвертации
+async def select_to_currency(query, context, to_currency, next_step):
+    session = get_session(query.from_user)
+    session.set_to(to_currency)
+    logger.info("Пользователь %s (%s) выбрал целевую валюту: %s", query.from_user.id, query.from_user.username, to_currency, extra=CALLBACK_LOG_EXTRA)
+
+    from_currency = session.from_currency
+    if not from_currency:
+        message = "Ошибка: Не выбрана исходная валюта."
+        await safe_edit_message(query, message, create_main_menu_keyboard(query.from_user.id))
+        return
+
+    message = f"Вы выбрали конвертацию из {from_currency} в {to_currency}.\n\nВведите сумму для конвертации:"
+    await safe_edit_message(query, message, create_back_keyboard())
+    session.step = next_step
 
-    except Exception as e:
-        logger.error(f"Ошибка при конвертации валют: {e}")
-        message = "Произошла ошибка. Пожалуйста, попробуйте еще раз."
-        await update.message.reply_text(message, reply_markup=create_main_menu_keyboard())
+
+@callback_router.route("t", args=1)
+async def on_to_currency(query, context, to_currency):
+    await select_to_currency(query, context, to_currency, Step.ENTER_AMOUNT)
+
+
+@callback_router.route("tc", args=1)
+async def on_to_crypto_currency(query, context, to_currency):
+    await select_to_currency(query, context, to_currency, Step.ENTER_AMOUNT_CRYPTO)
+
+
+@callback_router.route("p", args=2)
+async def on_favorite_pair(query, context, base, quote):
+    # Избранная пара: сразу переходим к вводу суммы
+    logger.info("Пользователь %s (%s) выбрал избранную пару %s → %s", query.from_user.id, query.from_user.username, base, quote, extra=CALLBACK_LOG_EXTRA)
+    session = get_session(query.from_user)
+    session.set_from(base)
+    session.set_to(quote)
+    session.step = Step.ENTER_AMOUNT_CRYPTO if is_crypto_currency(base) or is_crypto_currency(quote) else Step.ENTER_AMOUNT
+    message = f"Конвертация {base} → {quote}.\n\nВведите сумму для конвертации:"
+    await safe_edit_message(query, message, create_back_keyboard())
+
+
+@callback_router.route("pin", args=2)
+async def on_toggle_pin(query, context, base, quote):
+    # Закрепление пары из результата конвертации: меняется только клавиатура
+    pinned = get_favorite_pairs().toggle_pin(query.from_user.id, base, quote)
+    logger.info("Пользователь %s (%s) %s пару %s → %s", query.from_user.id, query.from_user.username, "закрепил" if pinned else "открепил", base, quote, extra=CALLBACK_LOG_EXTRA)
+    await query.edit_message_reply_markup(reply_markup=create_conversion_result_keyboard(query.from_user.id, base, quote))
+
+
+@callback_router.route("b")
+async def on_back(query, context):
+    # Возвращение на предыдущий шаг конвертации
+    session = get_session(query.from_user)
+    current_step = session.step
+    from_currency = session.from_currency
+    if current_step == Step.SELECT_TO:
+        await show_from_currency_selection(query, context)
+    elif current_step == Step.ENTER_AMOUNT:
+        if from_currency:
+            await show_to_currency_selection(query, context, from_currency)
+        else:
+            await show_from_currency_selection(query, context)
+    elif current_step == Step.SELECT_TO_CRYPTO:
+        await show_from_crypto_selection(query, context)
+    elif current_step == Step.ENTER_AMOUNT_CRYPTO:
+        if from_currency:
+            await show_to_crypto_selection(query, context, from_currency)
+        else:
+            await show_from_crypto_selection(query, context)
+    else:
+        message = "Главное меню\nВыберите действие:"
+        await safe_edit_message(query, message, create_main_menu_keyboard(query.from_user.id))
 
 
 # Переход к следующему блоку10
 # Функция для получения курсов валют с возможностью использования закэшированных данных
-async def get_exchange_rates(force_update=False, cache_key="world_rates", cache_time=CACHE_TIME_WORLD):
+async def get_exchange_rates(force_update=False, cache_key="world_rates", cache_time=None):
     """
     Получает курсы валют из API с возможностью использования закэшированных данных.
+    Мировые и региональные курсы берутся из одного ответа API, поэтому запрос
+    обновляет оба источника и расходует бюджет один раз.
+
+    :param cache_time: Время кэширования; по умолчанию - адаптивный интервал источника.
     """
     global exchange_rates_world, exchange_rates_regional, last_update_world, last_update_regional, client_session
     current_time = time.time()
@@ -811,89 +1358,273 @@ async def get_exchange_rates(force_update=False, cache_key="world_rates", cache_
         "regional_rates": [exchange_rates_regional, last_update_regional]
     }
     rates, last_update = rates_dict.get(cache_key, (None, None))
+    source = "regional" if cache_key == "regional_rates" else "world"
+
+    # Воркер использует общий снимок курсов, который обновляет супервизор
+    if PROCESS_ROLE == "worker":
+        return rates
 
     # Проверяем, можно ли использовать закэшированные данные
-    if not force_update and last_update and (current_time - last_update < cache_time):
-        logger.info(f"Используются закэшированные курсы ({cache_key}).")
+    if cache_time is None:
+        is_fresh = refresh_scheduler.is_fresh(source, last_update, current_time)
+    else:
+        is_fresh = bool(last_update) and current_time - last_update < cache_time
+    if not force_update and is_fresh:
+        logger.info("Используются закэшированные курсы (%s).", cache_key, extra=CACHE_HIT_LOG_EXTRA)
+        return rates
+
+    # Бюджет запросов исчерпан на текущий момент - остаемся на закэшированных курсах
+    if not api_budgets.allow("exchangerate"):
         return rates
 
     # Инициализация ClientSession, если она не создана или закрыта
-    if not client_session or client_session.closed:
-        client_session = aiohttp.ClientSession()
+    get_client_session()
 
     # URL для запроса курсов валют
     url = "https://api.exchangerate-api.com/v4/latest/USD"
     try:
-        async with client_session.get(url) as response:
-            if response.status != 200:
-                logger.error(f"Ошибка при запросе к API ({url}): {response.status}")
-                return None
-            data = await response.json()
-            new_rates = data.get("rates", {})
-
-            # Обновляем глобальные переменные в зависимости от ключа кэша
-            if cache_key == "world_rates":
-                exchange_rates_world = new_rates
-                last_update_world = current_time
-            elif cache_key == "regional_rates":
-                exchange_rates_regional = new_rates
-                last_update_regional = current_time
-
-            logger.info(f"Курсы валют обновлены ({cache_key}).")
-            return new_rates
+        api_budgets.spend("exchangerate")
+        with metrics.track("exchangerate"):
+            async with client_session.get(url) as response:
+                if response.status != 200:
+                    raise RuntimeError(f"статус {response.status}")
+                data = await read_json(response)
+        new_rates = data.get("rates", {})
+        refresh_scheduler.observe("world", exchange_rates_world, new_rates)
+        refresh_scheduler.observe("regional", exchange_rates_regional, new_rates)
+
+        # Один ответ обновляет оба источника: следующий запрос другого источника возьмет их из кэша
+        exchange_rates_world = exchange_rates_regional = new_rates
+        last_update_world = last_update_regional = current_time
+        rates_versions["world"] += 1
+        rates_versions["regional"] += 1
+        on_rates_updated(current_time)
+
+        logger.info("Курсы валют обновлены (%s).", cache_key)
+        return new_rates
     except Exception as e:
         logger.error(f"Ошибка при запросе к API ({url}): {e}")
         return None
 
 
-# Универсальная функция для обработки регионов
-async def handle_region_currencies(query, region_currencies, region_name):
+# Ответ в пределах бюджета задержки
+# Если свежие курсы не получены за RESPONSE_BUDGET секунд, пользователь сразу
+# получает ответ по последнему снимку с пометкой его возраста, а сообщение
+# редактируется, когда запрос к API завершится.
+RESPONSE_BUDGET = env_number("RESPONSE_BUDGET", 1.5, float)
+REFINE_TIMEOUT = env_number("REFINE_TIMEOUT", 15.0, float)  # Дольше уточнение не ждет ответа API
+inflight_refreshes = {}
+# Сообщения, ожидающие уточнения: (chat_id, message_id) -> токен. Любое нажатие
+# кнопки под сообщением снимает токен, и уточнение больше его не редактирует.
+refine_tokens = {}
+
+
+# Пользователь снова работает с сообщением (вызывается для каждого нажатия кнопки)
+def touch_message(chat_id, message_id):
+    refine_tokens.pop((chat_id, message_id), None)
+
+
+# Блокировка чата из обработчика очереди (см. update_processor.py), чтобы фоновое
+# редактирование не пересекалось с обработкой обновлений этого чата
+def chat_lock(application, chat_id):
+    processor = application.update_processor
+    if hasattr(processor, "chat_lock"):
+        return processor.chat_lock(chat_id)
+    return contextlib.nullcontext()
+
+
+# Курсы источника ('world' или 'crypto') для ответа пользователю; обращение учитывается как спрос
+async def get_source_rates(source, force_update=False):
+    refresh_scheduler.record_demand(source)
+    if source == "crypto":
+        return await get_crypto_exchange_rates_with_fallback(force_update=force_update)
+    return await get_exchange_rates(force_update=force_update, cache_key="world_rates")
+
+
+# Общий для всех пользователей запрос к источнику курсов ('world' или 'crypto')
+def refresh_source(source):
+    refresh_scheduler.record_demand(source)
+    task = inflight_refreshes.get(source)
+    if task is not None and not task.done():
+        metrics.inc("coalesced_fetches")
+    else:
+        if source == "crypto":
+            coro = get_crypto_exchange_rates_with_fallback()
+        else:
+            coro = get_exchange_rates(cache_key="world_rates")
+        task = asyncio.ensure_future(coro)
+        inflight_refreshes[source] = task
+    return task
+
+
+def has_source_rates(source):
+    return bool(exchange_rates_crypto if source == "crypto" else exchange_rates_world)
+
+
+def get_source_update_time(source):
+    return last_update_crypto if source == "crypto" else last_update_world
+
+
+# Возраст курсов в виде "5 мин назад"
+def format_rates_age(updated_at):
+    age = max(0, time.time() - updated_at)
+    if age < 60:
+        return "меньше минуты назад"
+    if age < 3600:
+        return f"{int(age // 60)} мин назад"
+    if age < 86400:
+        return f"{int(age // 3600)} ч назад"
+    return f"{int(age // 86400)} дн назад"
+
+
+async def respond_with_rates(context, sources, render, send, edit):
     """
-    Отображает курсы валют для выбранного региона.
+    Отвечает пользователю, не дожидаясь медленного API дольше RESPONSE_BUDGET.
+
+    :param sources: Источники курсов, нужные для ответа ('world', 'crypto').
+    :param render: Функция без аргументов -> (текст, клавиатура) по текущим курсам.
+    :param send: Корутина send(текст, клавиатура) - первый ответ; возвращает сообщение с ответом.
+    :param edit: Корутина edit(текст, клавиатура) - уточнение ответа.
     """
-    logger.info(f"Пользователь {query.from_user.id} ({query.from_user.username}) выбрал 'Валюты {region_name}'")
+    # При перегрузке отвечаем сразу по имеющимся курсам, без запросов к API
+    if is_overloaded(context) and all(has_source_rates(source) for source in sources):
+        metrics.inc("admission_degraded")
+        text, markup = render()
+        await send(text, markup)
+        return
 
-    # Получаем актуальные курсы валют
-    rates = await get_exchange_rates(cache_key="world_rates", cache_time=CACHE_TIME_WORLD)
-    if not rates:
-        message = "Не удалось получить курсы валют. Попробуйте позже."
-        await safe_edit_message(query, message, create_main_menu_keyboard())
+    tasks = [refresh_source(source) for source in sources]
+    _, pending = await asyncio.wait(tasks, timeout=RESPONSE_BUDGET)
+    if not pending or not all(has_source_rates(source) for source in sources):
+        if pending:
+            await asyncio.wait(pending)
+        text, markup = render()
+        await send(text, markup)
         return
 
-    # Формируем сообщение с курсами валют
+    updated_at = min(get_source_update_time(source) for source in sources)
+    text, markup = render()
+    stale_text = f"{text}\n\n⏳ Курсы обновлены {format_rates_age(updated_at)}, запрашиваются свежие..."
+    message = await send(stale_text, markup)
+    metrics.inc("stale_responses")
+    key = (message.chat_id, message.message_id)
+    token = refine_tokens[key] = object()
+
+    # Уточнение выполняется в фоне, чтобы не задерживать обработку других обновлений.
+    # Сообщение редактируется, только если на нем все еще ответ по устаревшим курсам.
+    async def refine():
+        try:
+            await asyncio.wait(pending, timeout=REFINE_TIMEOUT)
+            async with chat_lock(context.application, message.chat_id):
+                if refine_tokens.get(key) is not token:
+                    metrics.inc("refines_skipped")
+                    return
+                new_text, new_markup = render()
+                if min(get_source_update_time(source) for source in sources) <= updated_at:
+                    new_text += f"\n\n⚠️ Не удалось обновить курсы, данные {format_rates_age(updated_at)}."
+                if new_text != stale_text:
+                    await edit(new_text, new_markup)
+        except Exception as e:
+            logger.error("Ошибка при уточнении ответа: %s", e)
+        finally:
+            if refine_tokens.get(key) is token:
+                del refine_tokens[key]
+
+    context.application.create_task(refine())
+
+
+# Текст с курсами валют региона
+def render_region_rates(region_currencies, region_name):
+    rates = exchange_rates_world
     message = f"Текущие курсы валют {region_name}:\n\n"
     for currency, name in region_currencies.items():
-        rate = rates.get(currency, "— данные недоступны")
-        message += f"{name} ({currency}) = {rate:.2f} USD\n"
+        rate = rates.get(currency)
+        message += f"{name} ({currency}) = {f'{rate:.2f} USD' if rate else '— данные недоступны'}\n"
+    return message
+
+
+# Универсальная функция для обработки регионов
+async def handle_region_currencies(query, context, region_currencies, region_name):
+    """
+    Отображает курсы валют для выбранного региона.
+    """
+    from telegram import InlineKeyboardButton, InlineKeyboardMarkup
+
+    logger.info("Пользователь %s (%s) выбрал 'Валюты %s'", query.from_user.id, query.from_user.username, region_name, extra=CALLBACK_LOG_EXTRA)
 
     # Создаем клавиатуру с кнопками для каждой валюты
     keyboard = []
     for currency in region_currencies.keys():
         flag = get_currency_flag(currency)  # Получаем флаг для валюты
-        keyboard.append([InlineKeyboardButton(f"{currency} {flag}", callback_data=f"convert_from_{currency}")])
+        keyboard.append([InlineKeyboardButton(f"{currency} {flag}", callback_data=encode_callback("f", currency))])
 
     # Добавляем кнопки "Конвертировать" и "Назад"
-    keyboard.append([InlineKeyboardButton("🔍 Конвертировать", callback_data="convert_currency")])
-    keyboard.append([InlineKeyboardButton("⬅️ Назад", callback_data="start")])
+    keyboard.append([InlineKeyboardButton("🔍 Конвертировать", callback_data=encode_callback("cv"))])
+    keyboard.append([InlineKeyboardButton("⬅️ Назад", callback_data=encode_callback("m"))])
+    markup = InlineKeyboardMarkup(keyboard)
 
-    # Отправляем сообщение пользователю
-    await safe_edit_message(query, message, InlineKeyboardMarkup(keyboard))
+    def render():
+        if not exchange_rates_world:
+            return "Не удалось получить курсы валют. Попробуйте позже.", create_main_menu_keyboard(query.from_user.id)
+        return render_region_rates(region_currencies, region_name), markup
+
+    async def send(text, reply_markup):
+        await safe_edit_message(query, text, reply_markup)
+        return query.message
+
+    async def edit(text, reply_markup):
+        await query.edit_message_text(text=text, reply_markup=reply_markup)
+
+    await respond_with_rates(context, ["world"], render, send, edit)
+
+
+# Клавиатура под результатом конвертации: закрепление пары и главное меню с избранным
+def create_conversion_result_keyboard(user_id, base, quote):
+    from telegram import InlineKeyboardButton, InlineKeyboardMarkup
+
+    if get_favorite_pairs().is_pinned(user_id, base, quote):
+        pin_text = f"📌 Открепить {base} → {quote}"
+    else:
+        pin_text = f"📌 Закрепить {base} → {quote}"
+    keyboard = [[InlineKeyboardButton(pin_text, callback_data=encode_callback("pin", base, quote))]]
+    keyboard += create_main_menu_keyboard(user_id).inline_keyboard
+    return InlineKeyboardMarkup(keyboard)
+
+
+# Текст результата конвертации по текущим курсам
+def render_conversion(amount, from_currency, to_currency):
+    rate = get_pair_rate(from_currency, to_currency)
+    if rate is None:
+        return "Ошибка: Не найдены курсы для выбранных валют."
+    return (
+        f"Результат конвертации:\n\n"
+        f"{amount:.2f} {from_currency} = {amount * rate:.2f} {to_currency}"
+    )
 
 
 # Обработка текстового ввода для конвертации
 async def convert_currency(update: Update, context: ContextTypes.DEFAULT_TYPE):
     try:
-        current_step = context.user_data.get("step")
-        if current_step not in ["enter_amount", "enter_amount_crypto"]:
+        session = get_session(update.effective_user)
+        current_step = session.step
+        if current_step in CURRENCY_SEARCH_STEPS:
+            # На шагах выбора валюты текст - это поисковый запрос
+            await reply_currency_search(
+                update.message, update.message.text.strip(), CURRENCY_SEARCH_STEPS[current_step],
+                exclude=session.from_currency if CURRENCY_SEARCH_STEPS[current_step] == "to" else None,
+            )
+            return
+
+        if current_step not in (Step.ENTER_AMOUNT, Step.ENTER_AMOUNT_CRYPTO):
             message = "Ошибка: Неверный шаг. Пожалуйста, начните заново."
             await update.message.reply_text(
                 text=message,
                 parse_mode="HTML",
-                reply_markup=create_main_menu_keyboard(),
+                reply_markup=create_main_menu_keyboard(update.effective_user.id),
             )
             return
 
-        logger.info(f"Пользователь {update.effective_user.id} ({update.effective_user.username}) ввел сумму для конвертации")
+        logger.info("Пользователь %s (%s) ввел сумму для конвертации", update.effective_user.id, update.effective_user.username)
 
         # Парсим введенную сумму
         try:
@@ -916,227 +1647,759 @@ async def convert_currency(update: Update, context: ContextTypes.DEFAULT_TYPE):
             return
 
         # Получаем исходную и целевую валюты
-        from_currency = context.user_data.get("from_currency")
-        to_currency = context.user_data.get("to_currency")
+        from_currency = session.from_currency
+        to_currency = session.to_currency
         if not from_currency or not to_currency:
             message = "Ошибка: Не выбраны валюты для конвертации."
             await update.message.reply_text(
                 text=message,
                 parse_mode="HTML",
-                reply_markup=create_main_menu_keyboard(),
+                reply_markup=create_main_menu_keyboard(update.effective_user.id),
             )
             return
 
-        # Конвертация обычных валют
-        if from_currency in ALL_CURRENCIES and to_currency in ALL_CURRENCIES:
-            rates = await get_exchange_rates(cache_key="world_rates", cache_time=CACHE_TIME_WORLD)
-            if not rates:
-                message = "Не удалось получить курсы валют. Попробуйте позже."
-                await update.message.reply_text(
-                    text=message,
-                    parse_mode="HTML",
-                    reply_markup=create_main_menu_keyboard(),
-                )
-                return
+        # Курсы криптовалют нужны, только если в паре есть криптовалюта; пересчет идет через USD
+        sources = ["world"]
+        if is_crypto_currency(from_currency) or is_crypto_currency(to_currency):
+            sources.append("crypto")
+
+        # Учет пары для избранного
+        user_id = update.effective_user.id
+        get_favorite_pairs().record(user_id, from_currency, to_currency)
+
+        def render():
+            if not all(has_source_rates(source) for source in sources):
+                return "Не удалось получить курсы валют. Попробуйте позже.", create_main_menu_keyboard(user_id)
+            return (
+                render_conversion(amount, from_currency, to_currency),
+                create_conversion_result_keyboard(user_id, from_currency, to_currency),
+            )
 
-            from_rate = rates.get(from_currency)
-            to_rate = rates.get(to_currency)
-            if not from_rate or not to_rate:
-                message = "Ошибка: Не найдены курсы для выбранных валют."
-                await update.message.reply_text(
-                    text=message,
-                    parse_mode="HTML",
-                    reply_markup=create_main_menu_keyboard(),
-                )
-                return
+        sent = []
 
-            converted_amount = (amount / from_rate) * to_rate
+        async def send(text, reply_markup):
+            sent.append(await update.message.reply_text(text=text, parse_mode="HTML", reply_markup=reply_markup))
+            return sent[0]
 
-        # Конвертация криптовалют
-        elif from_currency in ["BTC", "ETH", "BNB", "XRP", "ADA"] or to_currency in ["BTC", "ETH", "BNB", "XRP", "ADA"]:
-            crypto_rates = await get_crypto_exchange_rates_with_fallback()
-            if not crypto_rates:
-                message = "Не удалось получить курсы криптовалют. Попробуйте позже."
-                await update.message.reply_text(
-                    text=message,
-                    parse_mode="HTML",
-                    reply_markup=create_main_menu_keyboard(),
-                )
-                return
+        async def edit(text, reply_markup):
+            await sent[0].edit_text(text=text, parse_mode="HTML", reply_markup=reply_markup)
 
-            from_rate = crypto_rates.get(from_currency) if from_currency in crypto_rates else None
-            to_rate = crypto_rates.get(to_currency) if to_currency in crypto_rates else None
+        await respond_with_rates(context, sources, render, send, edit)
 
-            if not from_rate or not to_rate:
-                message = "Ошибка: Не найдены курсы для выбранных криптовалют."
-                await update.message.reply_text(
-                    text=message,
-                    parse_mode="HTML",
-                    reply_markup=create_main_menu_keyboard(),
-                )
-                return
+    except Exception as e:
+        logger.error("Ошибка при конвертации: %s", e)
+        message = "Произошла ошибка при конвертации. Пожалуйста, попробуйте еще раз."
+        await update.message.reply_text(
+            text=message,
+            parse_mode="HTML",
+            reply_markup=create_main_menu_keyboard(update.effective_user.id),
+        )
 
-            # Конвертация через USD
-            if from_currency in crypto_rates and to_currency in ALL_CURRENCIES:
-                exchange_rates = await get_exchange_rates(cache_key="world_rates", cache_time=CACHE_TIME_WORLD)
-                if not exchange_rates:
-                    message = "Не удалось получить курсы валют. Попробуйте позже."
-                    await update.message.reply_text(
-                        text=message,
-                        parse_mode="HTML",
-                        reply_markup=create_main_menu_keyboard(),
-                    )
-                    return
 
-                to_rate_usd = exchange_rates.get(to_currency)
-                if not to_rate_usd:
-                    message = f"Ошибка: Не найден курс для {to_currency}."
-                    await update.message.reply_text(
-                        text=message,
-                        parse_mode="HTML",
-                        reply_markup=create_main_menu_keyboard(),
-                    )
-                    return
+# Разбор периода вида 12h / 7d / 4w
+HISTORY_PERIOD_UNITS = {"h": 3600, "d": 86400, "w": 7 * 86400}
+HISTORY_DEFAULT_PERIOD = "7d"
+HISTORY_POINTS = 8
 
-                converted_amount = (amount * from_rate) / to_rate_usd
-
-            elif from_currency in ALL_CURRENCIES and to_currency in crypto_rates:
-                exchange_rates = await get_exchange_rates(cache_key="world_rates", cache_time=CACHE_TIME_WORLD)
-                if not exchange_rates:
-                    message = "Не удалось получить курсы валют. Попробуйте позже."
-                    await update.message.reply_text(
-                        text=message,
-                        parse_mode="HTML",
-                        reply_markup=create_main_menu_keyboard(),
-                    )
-                    return
 
-                from_rate_usd = exchange_rates.get(from_currency)
-                if not from_rate_usd:
-                    message = f"Ошибка: Не найден курс для {from_currency}."
-                    await update.message.reply_text(
-                        text=message,
-                        parse_mode="HTML",
-                        reply_markup=create_main_menu_keyboard(),
-                    )
-                    return
+def parse_history_period(period):
+    """
+    Переводит период вида '7d' в секунды. Возвращает None при ошибке.
+    """
+    period = period.strip().lower()
+    if len(period) < 2 or period[-1] not in HISTORY_PERIOD_UNITS or not period[:-1].isdigit():
+        return None
+    value = int(period[:-1])
+    return value * HISTORY_PERIOD_UNITS[period[-1]] if value > 0 else None
 
-                converted_amount = (amount / from_rate_usd) * to_rate
 
-            elif from_currency in crypto_rates and to_currency in crypto_rates:
-                converted_amount = (amount * from_rate) / to_rate
+# Форматирование значения курса для истории
+def format_history_value(value, sign=False):
+    """
+    Крупные значения выводятся с двумя знаками после запятой, мелкие - с восемью.
+    """
+    fmt = "+.2f" if sign else ".2f"
+    if abs(value) < 1:
+        fmt = "+.8f" if sign else ".8f"
+    return format(value, fmt)
 
-        # Отправляем результат пользователю
-        message = (
-            f"Результат конвертации:\n\n"
-            f"{amount:.2f} {from_currency} = {converted_amount:.2f} {to_currency}"
-        )
+
+# Команда /history
+async def history_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """
+    Обработчик команды /history <ИЗ> <В> [период], например: /history USD RUB 7d
+    """
+    args = context.args or []
+    usage = "Использование: /history USD RUB 7d\nПериод: 12h, 7d, 4w."
+    if len(args) < 2:
+        await update.message.reply_text(usage)
+        return
+
+    base, quote = args[0].upper(), args[1].upper()
+    period = parse_history_period(args[2] if len(args) > 2 else HISTORY_DEFAULT_PERIOD)
+    if period is None:
+        await update.message.reply_text(usage)
+        return
+
+    try:
+        history = get_rate_history()
+    except OSError as e:
+        logger.error(f"Ошибка при открытии истории курсов: {e}")
+        await update.message.reply_text("История курсов недоступна. Попробуйте позже.")
+        return
+
+    known = history.currencies()
+    for currency in (base, quote):
+        if currency not in known:
+            await update.message.reply_text(f"Нет истории для валюты {currency}.")
+            return
+
+    end = time.time()
+    start = end - period
+    stats = history.stats(base, quote, start, end)
+    if not stats:
+        await update.message.reply_text(f"Нет данных по паре {base}/{quote} за выбранный период.")
+        return
+
+    message = (
+        f"История курса 1 {base} в {quote} за {args[2] if len(args) > 2 else HISTORY_DEFAULT_PERIOD}:\n\n"
+        f"Начало: {format_history_value(stats['first'][1])}\n"
+        f"Сейчас: {format_history_value(stats['last'][1])}\n"
+        f"Минимум: {format_history_value(stats['min'])}\n"
+        f"Максимум: {format_history_value(stats['max'])}\n"
+        f"Изменение: {format_history_value(stats['change'], sign=True)} ({stats['change_pct']:+.2f}%)\n"
+    )
+    points = history.downsample(base, quote, start, end, HISTORY_POINTS)
+    if len(points) > 1:
+        message += "\n"
+        for timestamp, value in points:
+            message += f"{time.strftime('%d.%m %H:%M', time.localtime(timestamp))}  {format_history_value(value)}\n"
+
+    await update.message.reply_text(message)
+
+
+# Разбор условия оповещения вида "BTC > 70000 USD"
+ALERT_PATTERN = re.compile(r"^([A-Za-z]{2,10})\s*([<>])\s*(\d+(?:[.,]\d+)?)\s*([A-Za-z]{2,10})?$")
+
+
+# Команда /alert
+async def alert_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """
+    Обработчик команды /alert <ВАЛЮТА> <>|<> <ПОРОГ> [В ВАЛЮТЕ], например: /alert BTC > 70000 USD
+    """
+    usage = "Использование: /alert BTC > 70000 USD или /alert EUR < 95 RUB"
+    match = ALERT_PATTERN.match(" ".join(context.args or []).strip())
+    if not match:
+        await update.message.reply_text(usage)
+        return
+
+    base = match.group(1).upper()
+    direction = ABOVE if match.group(2) == ">" else BELOW
+    threshold = float(match.group(3).replace(",", "."))
+    quote = (match.group(4) or "USD").upper()
+    chat_id = update.effective_chat.id
+
+    snapshot = build_rates_snapshot()
+    for currency in (base, quote):
+        if currency not in snapshot:
+            await update.message.reply_text(f"Валюта {currency} не поддерживается.")
+            return
+
+    index = get_alert_index()
+    if index.count_for_chat(chat_id) >= MAX_ALERTS_PER_CHAT:
+        await update.message.reply_text(f"Можно создать не более {MAX_ALERTS_PER_CHAT} оповещений.")
+        return
+
+    current_rate = get_pair_rate(base, quote, snapshot)
+    if current_rate is None:
+        await update.message.reply_text(f"Нет курса для пары {base}/{quote}. Попробуйте позже.")
+        return
+    # Оповещение срабатывает при пересечении порога, поэтому уже выполненное условие не сработало бы никогда
+    if (current_rate >= threshold) if direction == ABOVE else (current_rate <= threshold):
         await update.message.reply_text(
-            text=message,
-            parse_mode="HTML",
-            reply_markup=create_main_menu_keyboard(),
+            f"Условие уже выполнено: 1 {base} = {current_rate:.4f} {quote}. "
+            f"Укажите порог {'выше' if direction == ABOVE else 'ниже'} текущего курса."
         )
+        return
+    alert = index.add(chat_id, base, quote, direction, threshold, current_rate=current_rate)
+    logger.info("Пользователь %s создал оповещение %s: %s %s %s %s", update.effective_user.id, alert["id"], base, direction, threshold, quote)
+    await update.message.reply_text(
+        f"Оповещение #{alert['id']} создано: {base} {direction} {threshold:g} {quote}.\n"
+        f"Текущий курс: 1 {base} = {current_rate:.4f} {quote}"
+    )
 
-    except Exception as e:
-        logger.error(f"Ошибка при конвертации: {e}")
-        message = "Произошла ошибка при конвертации. Пожалуйста, попробуйте еще раз."
-        await update.message.reply_text(
-            text=message,
-            parse_mode="HTML",
-            reply_markup=create_main_menu_keyboard(),
+
+# Команда /alerts - список оповещений пользователя
+async def alerts_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    alerts = get_alert_index().list_for_chat(update.effective_chat.id)
+    if not alerts:
+        await update.message.reply_text("У вас нет активных оповещений. Создайте: /alert BTC > 70000 USD")
+        return
+    message = "Ваши оповещения:\n\n"
+    for alert in alerts:
+        message += f"#{alert['id']}: {alert['base']} {alert['direction']} {alert['threshold']:g} {alert['quote']}\n"
+    message += "\nУдалить: /unalert <номер>"
+    await update.message.reply_text(message)
+
+
+# Команда /unalert - удаление оповещения
+async def unalert_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    args = context.args or []
+    if len(args) != 1 or not args[0].lstrip("#").isdigit():
+        await update.message.reply_text("Использование: /unalert <номер>")
+        return
+    alert_id = int(args[0].lstrip("#"))
+    if get_alert_index().remove(update.effective_chat.id, alert_id):
+        await update.message.reply_text(f"Оповещение #{alert_id} удалено.")
+    else:
+        await update.message.reply_text(f"Оповещение #{alert_id} не найдено.")
+
+
+# Текущие дата 'ГГГГ-ММ-ДД' и время 'ЧЧ:ММ' в часовом поясе дайджестов
+def get_digest_clock():
+    local_now = time.gmtime(time.time() + DIGEST_UTC_OFFSET * 3600)
+    return time.strftime("%Y-%m-%d", local_now), time.strftime("%H:%M", local_now)
+
+
+# Формирование текста дайджеста для набора валют
+def render_digest(currencies, snapshot):
+    """
+    Строит текст дайджеста: курс каждой валюты к USD и изменение за сутки
+    по истории курсов.
+    """
+    message = "☀️ Дайджест курсов валют:\n\n"
+    day_ago = time.time() - 86400
+    try:
+        history = get_rate_history()
+    except OSError as e:
+        logger.error(f"Ошибка при открытии истории курсов: {e}")
+        history = None
+    for currency in currencies:
+        # Криптовалюты показываем в USD за монету, фиат - в единицах за 1 USD
+        if is_crypto_currency(currency):
+            base, quote = currency, "USD"
+        else:
+            base, quote = "USD", currency
+        rate = get_pair_rate(base, quote, snapshot)
+        if rate is None:
+            message += f"{currency}: — данные недоступны\n"
+            continue
+        line = f"1 {base} = {rate:.2f} {quote} {get_currency_flag(currency)}"
+        stats = history.stats(base, quote, day_ago, time.time()) if history else None
+        if stats and stats["count"] > 1:
+            line += f" ({stats['change_pct']:+.2f}% за сутки)"
+        message += line + "\n"
+    return message
+
+
+# Отправка дайджестов, время которых наступило
+DIGEST_CHECK_INTERVAL = 30
+digest_render_cache = {}
+digest_render_version = None
+
+
+async def send_due_digests():
+    """
+    Группирует подписчиков по набору валют, формирует каждый текст один раз
+    на версию курсов и ставит рассылку в очередь.
+    """
+    global digest_render_cache, digest_render_version
+    subscriptions = get_digest_subscriptions()
+    today, now_time = get_digest_clock()
+    groups = subscriptions.due(today, now_time)
+    if not groups:
+        return
+
+    # Курсы берутся из кэша; запрос к API выполняется, только если кэш устарел
+    await get_source_rates("world")
+    await get_source_rates("crypto")
+    snapshot = build_rates_snapshot()
+
+    version = (last_update_world, last_update_crypto)
+    if version != digest_render_version:
+        digest_render_cache = {}
+        digest_render_version = version
+
+    texts = {}
+    recipients = []
+    for key, (currencies, chat_ids) in enumerate(groups.items()):
+        if currencies not in digest_render_cache:
+            digest_render_cache[currencies] = render_digest(currencies, snapshot)
+        texts[key] = digest_render_cache[currencies]
+        recipients.extend((chat_id, key) for chat_id in chat_ids)
+
+    get_broadcast_queue().enqueue(texts, recipients, priority=PRIORITY_DIGEST)
+    subscriptions.mark_sent([chat_id for chat_id, _ in recipients], today)
+    logger.info(f"Дайджест поставлен в очередь: {len(recipients)} получателей, {len(texts)} вариантов текста")
+
+
+# Планировщик дайджестов
+async def digest_scheduler():
+    while True:
+        try:
+            await send_due_digests()
+        except Exception as e:
+            logger.error(f"Ошибка в планировщике дайджестов: {e}")
+        await asyncio.sleep(DIGEST_CHECK_INTERVAL)
+
+
+# Команда /digest
+async def digest_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """
+    Обработчик команды /digest:
+    /digest USD EUR BTC 09:00 - подписаться, /digest off - отписаться, /digest - текущая подписка.
+    """
+    subscriptions = get_digest_subscriptions()
+    chat_id = update.effective_chat.id
+    args = context.args or []
+    usage = (
+        f"Использование: /digest USD EUR BTC 09:00\n"
+        f"Время указывается в UTC{DIGEST_UTC_OFFSET:+d}, отписаться: /digest off"
+    )
+
+    if not args:
+        subscription = subscriptions.get(chat_id)
+        if subscription:
+            await update.message.reply_text(
+                f"Вы подписаны на дайджест: {' '.join(subscription['currencies'])} в {subscription['time']}.\n\n{usage}"
+            )
+        else:
+            await update.message.reply_text(usage)
+        return
+
+    if len(args) == 1 and args[0].lower() == "off":
+        if subscriptions.unsubscribe(chat_id):
+            await update.message.reply_text("Подписка на дайджест отменена.")
+        else:
+            await update.message.reply_text("Вы не подписаны на дайджест.")
+        return
+
+    send_time = DEFAULT_DIGEST_TIME
+    if ":" in args[-1]:
+        send_time = parse_digest_time(args[-1])
+        args = args[:-1]
+        if send_time is None:
+            await update.message.reply_text(usage)
+            return
+
+    currencies = [arg.upper() for arg in args]
+    if not currencies or len(currencies) > MAX_DIGEST_CURRENCIES:
+        await update.message.reply_text(f"Укажите от 1 до {MAX_DIGEST_CURRENCIES} валют.\n\n{usage}")
+        return
+    snapshot = build_rates_snapshot()
+    unknown = [currency for currency in currencies if currency not in snapshot]
+    if unknown:
+        await update.message.reply_text(f"Валюты не поддерживаются: {', '.join(unknown)}")
+        return
+
+    subscription = subscriptions.subscribe(chat_id, currencies, send_time, *get_digest_clock())
+    logger.info("Пользователь %s подписался на дайджест: %s", update.effective_user.id, subscription)
+    await update.message.reply_text(
+        f"Готово! Дайджест {' '.join(subscription['currencies'])} будет приходить ежедневно в "
+        f"{subscription['time']} (UTC{DIGEST_UTC_OFFSET:+d})."
+    )
+
+
+# Ответ на поисковый запрос валюты
+async def reply_currency_search(message, text, step, exclude=None):
+    """
+    Ищет валюты по запросу и отвечает клавиатурой с найденными валютами.
+
+    :param step: Шаг клавиатуры ('from' или 'to').
+    :param exclude: Валюта, которую не нужно показывать (уже выбранная исходная).
+    """
+    rebuild_currency_index()
+    matches = [code for code in currency_index.search(text, CURRENCY_SEARCH_LIMIT + 1) if code != exclude]
+    matches = matches[:CURRENCY_SEARCH_LIMIT]
+    if not matches:
+        await message.reply_text(
+            f"По запросу «{text}» ничего не найдено. Попробуйте другой код или название.",
+            reply_markup=create_back_keyboard(),
+        )
+        return
+
+    reply = "Найденные валюты:\n\n"
+    for code in matches:
+        reply += f"{code} {get_currency_flag(code)} — {currency_index.name(code)}\n"
+    reply += "\nВыберите исходную валюту:" if step == "from" else "\nВыберите целевую валюту:"
+    await message.reply_text(reply, reply_markup=create_currency_selection_keyboard(matches, step=step))
+
+
+# Команда /find
+async def find_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """
+    Обработчик команды /find <запрос>, например: /find фунт
+    """
+    query_text = " ".join(context.args or []).strip()
+    session = get_session(update.effective_user)
+    if not query_text:
+        session.step = Step.SEARCH_CURRENCY
+        await update.message.reply_text("Отправьте код, название или страну валюты (например: фунт, Japan, KZT):")
+        return
+    logger.info("Пользователь %s ищет валюту: %s", update.effective_user.id, query_text)
+    session.step = Step.SEARCH_CURRENCY
+    await reply_currency_search(update.message, query_text, "from")
+
+
+# Строка с возрастом и версией курсов источника
+def format_source_status(name, source, updated_at, count):
+    if not updated_at:
+        return f"  {name}: нет данных"
+    return f"  {name}: v{rates_versions[source]}, {format_rates_age(updated_at)}, валют: {count}"
+
+
+# Текст статистики работающего процесса
+def render_stats(application):
+    """
+    Собирается только из состояния процесса, без запросов к API.
+    """
+    snapshot = metrics.snapshot()
+    uptime = int(time.time() - PROCESS_STARTED)
+    lines = [
+        "📊 Статистика",
+        f"Процесс: {PROCESS_ROLE}" + (f" #{WORKER_INDEX}" if WORKER_INDEX is not None else "")
+        + f", pid {os.getpid()}, работает {uptime // 3600} ч {uptime % 3600 // 60} мин",
+        f"Среда: JSON - {fast_runtime.codec}, цикл событий - {fast_runtime.loop_implementation}",
+        "",
+        "Курсы:",
+        format_source_status("мировые", "world", last_update_world, len(exchange_rates_world or {})),
+        format_source_status("региональные", "regional", last_update_regional, len(exchange_rates_regional or {})),
+        format_source_status("криптовалюты", "crypto", last_update_crypto, len(exchange_rates_crypto or {})),
+        "",
+        "Внешние API:",
+    ]
+    if not metrics.upstream:
+        lines.append("  запросов не было")
+    for source, stats in sorted(metrics.upstream.items()):
+        total = stats["ok"] + stats["errors"]
+        line = (
+            f"  {source}: {stats['ok']}/{total} успешно ({stats['ok'] / total:.0%}), "
+            f"среднее {stats['latency_total'] / total * 1000:.0f} мс, макс {stats['latency_max'] * 1000:.0f} мс"
+        )
+        if stats["last_error"]:
+            line += f", последняя ошибка: {stats['last_error']}"
+        lines.append(line)
+
+    lines += ["", "Интервалы обновления:"]
+    for source in ("world", "regional", "crypto"):
+        change = refresh_scheduler.changes[source]
+        lines.append(
+            f"  {source}: {refresh_scheduler.interval(source) / 60:.0f} мин"
+            + (f", изменение курсов за интервал {change * 100:.2f}%" if change is not None else "")
         )
+    lines += ["", "Бюджеты API:"]
+    lines += [f"  {line}" for line in api_budgets.describe()] or ["  запросов не было"]
+
+    rss = get_process_rss()
+    lines += [
+        "",
+        f"Совмещенные запросы курсов: {snapshot.get('coalesced_fetches', 0)}",
+        f"Ответы по устаревшим курсам: {snapshot.get('stale_responses', 0)}",
+        f"Сессии: {snapshot.get('sessions', 0)} (~{snapshot.get('sessions_bytes', 0) / 1024:.0f} КБ), "
+        f"вытеснено по простою: {snapshot.get('sessions_evicted_idle', 0)}, по лимиту: {snapshot.get('sessions_evicted_lru', 0)}",
+        f"Очередь обновлений: {application.update_queue.qsize()}, в обработке: {snapshot.get('updates_pending', 0)} "
+        f"(одновременно до {CONCURRENT_UPDATES})",
+        f"Очередь рассылок: {get_broadcast_queue().depth()} сообщений "
+        f"(отправлено {get_broadcast_queue().sent_total}, ошибок {get_broadcast_queue().failed_total})",
+        f"Задержка цикла событий: {snapshot.get('loop_lag_ms', 0)} мс (макс {snapshot.get('loop_lag_max_ms', 0)} мс)",
+        f"Память (RSS): {rss / 1024 / 1024:.1f} МБ" if rss else "Память (RSS): недоступно",
+    ]
+    return "\n".join(lines)
+
+
+# Команда /stats (только для администраторов)
+async def stats_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    user = update.effective_user
+    if user.id not in ADMIN_IDS:
+        logger.warning("Пользователь %s (%s) запросил /stats без прав администратора", user.id, user.username)
+        return
+    await update.message.reply_text(render_stats(context.application))
 
 
 # Переход к следующему блоку11
 # Регистрация обработчиков
-async def register_handlers(application):
+def register_handlers(application):
     """
     Регистрация всех обработчиков для бота.
     """
+    from telegram import Update
+    from telegram.ext import CommandHandler, CallbackQueryHandler, MessageHandler, TypeHandler, filters
+
+    # Контроль допуска до всех остальных обработчиков
+    application.add_handler(TypeHandler(Update, admission_control), group=-1)
+
     # Обработчики команд
     application.add_handler(CommandHandler("start", start))
-
-    # Обработчик числового ввода для конвертации обычных валют
-    application.add_handler(
-        MessageHandler(filters.Regex(r'^\d+(\.\d+)?$'), convert_currency)
-    )
+    application.add_handler(CommandHandler("history", history_command))
+    application.add_handler(CommandHandler("alert", alert_command))
+    application.add_handler(CommandHandler("alerts", alerts_command))
+    application.add_handler(CommandHandler("unalert", unalert_command))
+    application.add_handler(CommandHandler("digest", digest_command))
+    application.add_handler(CommandHandler("find", find_command))
+    application.add_handler(CommandHandler("stats", stats_command))
 
     # Обработчики кнопок
     application.add_handler(CallbackQueryHandler(button_handler))
 
+    # Текстовый ввод: сумма для конвертации или поисковый запрос валюты
+    application.add_handler(MessageHandler(filters.TEXT & ~filters.COMMAND, convert_currency))
 
-# Точка входа
-async def close_connector():
-    global client_session
-    if client_session and not client_session.closed:
-        try:
-            await client_session.close()
-            logger.info("ClientSession успешно закрыт.")
-        except Exception as e:
-            logger.error(f"Ошибка при закрытии ClientSession: {e}")
-    client_session = None
+
+# Инициализация структур данных, которые читаются с диска
+def init_runtime():
+    """
+    Загружает сохраненный список криптовалют, сессии, индекс оповещений, подписки
+    и незавершенные рассылки. Вызывается при запуске бота, а не при импорте модуля.
+    """
+    crypto_universe.load()
+    api_budgets.load()
+    sessions.load(CONVERSATIONS_FILE)
+    get_favorite_pairs()
+    rebuild_currency_index()
+    get_alert_index()
+    get_digest_subscriptions()
+    get_broadcast_queue()
 
 
-async def shutdown():
+# Запуск фоновых задач после инициализации приложения
+background_tasks = []
+
+
+async def start_background_tasks(application):
+    """
+    Запускает обработчик очереди рассылок, планировщик дайджестов, вывод метрик,
+    замер задержки цикла событий и сохранение избранных пар.
+    """
+    background_tasks.append(asyncio.create_task(get_broadcast_queue().run(application.bot)))
+    background_tasks.append(asyncio.create_task(digest_scheduler()))
+    background_tasks.append(asyncio.create_task(metrics_reporter()))
+    background_tasks.append(asyncio.create_task(loop_monitor.run()))
+    loop_monitor.start_watchdog()
+    background_tasks.append(asyncio.create_task(flush_favorites_periodically()))
+    # Курсы обновляет процесс, который запрашивает API; в воркерах - супервизор
+    if PROCESS_ROLE == "single":
+        background_tasks.append(asyncio.create_task(refresh_rates_periodically()))
+
+
+# Периодическое вытеснение простаивающих сессий и вывод метрик в лог
+METRICS_LOG_INTERVAL = env_number("METRICS_LOG_INTERVAL", 300)
+
+
+async def metrics_reporter():
+    while True:
+        await asyncio.sleep(METRICS_LOG_INTERVAL)
+        sessions.evict_idle()
+        snapshot = metrics.snapshot()
+        logger.info(
+            "Метрики: " + ", ".join(f"{name}={value}" for name, value in snapshot.items()),
+            extra={"event": "metrics", "metrics": snapshot},
+        )
+
+
+# Действия после инициализации Application
+async def on_startup(application):
+    """
+    Курсы, сохраненные предыдущим процессом, подхватываются из снимка; из API
+    запрашиваются только устаревшие источники.
+    """
+    init_runtime()
+    has_snapshot = load_rates_snapshot()
+    if has_snapshot:
+        rebuild_currency_index()
+        logger.info(f"Курсы загружены из снимка {RATES_SNAPSHOT_FILE}.")
+    if PROCESS_ROLE == "worker":
+        background_tasks.append(asyncio.create_task(watch_shared_rates()))
+    else:
+        await preload_exchange_rates(force_update=not has_snapshot)
+    await start_background_tasks(application)
+    logger.info("Бот запущен. Нажмите Ctrl+C для остановки.")
+
+
+# Завершение обработки начатых обновлений
+async def drain_application(application):
+    """
+    Останавливает Application: обновления, которые уже получены, обрабатываются
+    не дольше SHUTDOWN_DRAIN_TIMEOUT секунд.
+    """
+    stop_task = asyncio.ensure_future(application.stop())
+    try:
+        await asyncio.wait_for(asyncio.shield(stop_task), SHUTDOWN_DRAIN_TIMEOUT)
+    except asyncio.TimeoutError:
+        logger.warning(
+            f"Обработчики не завершились за {SHUTDOWN_DRAIN_TIMEOUT} с., "
+            f"необработанных обновлений: {application.update_queue.qsize()}"
+        )
+        stop_task.cancel()
+
+
+async def shutdown(application=None):
     try:
+        for task in background_tasks:
+            task.cancel()
+        await asyncio.gather(*background_tasks, return_exceptions=True)
+        background_tasks.clear()
+        loop_monitor.stop_watchdog()
+        # Сессии и снимок курсов для следующего процесса (у воркеров снимок пишет супервизор)
+        sessions.save(CONVERSATIONS_FILE)
+        get_favorite_pairs().flush()
+        api_budgets.flush()
+        if rate_history is not None:
+            rate_history.close()
+        if PROCESS_ROLE == "single":
+            save_rates_snapshot()
         await close_connector()
+        shutdown_offload()
         logger.info("Бот остановлен.")
     except Exception as e:
         logger.error(f"Ошибка при завершении работы: {e}")
 
 
-def main():
+# Запуск бота с плавной остановкой по SIGTERM/SIGINT
+async def run_bot(application):
+    """
+    По сигналу остановки бот перестает получать обновления, дообрабатывает
+    уже полученные (см. drain_application) и сохраняет снимок курсов, так что
+    новый процесс стартует без повторных запросов к API.
+    """
+    import signal
+
+    stop_event = asyncio.Event()
+    loop = asyncio.get_running_loop()
+    for sig in (signal.SIGINT, signal.SIGTERM):
+        loop.add_signal_handler(sig, stop_event.set)
+
+    rate_api_runner = None
+    await application.initialize()
     try:
-        loop = asyncio.new_event_loop()
-        asyncio.set_event_loop(loop)
-        application = Application.builder().token(token).build()
+        await on_startup(application)
+        if RATE_API_PORT:
+            from rate_api import start_rate_api
+
+            rate_api_runner = await start_rate_api(sys.modules[__name__], RATE_API_HOST, RATE_API_PORT, RATE_API_TOKEN)
+        await application.updater.start_polling()
+        await application.start()
+        admission.mark_started()
+        await stop_event.wait()
+        logger.info("Получен сигнал остановки, прием обновлений прекращен.")
+    finally:
+        if application.updater.running:
+            await application.updater.stop()
+        if rate_api_runner is not None:
+            await rate_api_runner.cleanup()
+        if application.running:
+            await drain_application(application)
+        await shutdown(application)
+        await application.shutdown()
+
+
+# Фабрика приложения
+def create_application():
+    """
+    Создает и настраивает Application. Библиотека python-telegram-bot
+    импортируется здесь, а не при импорте модуля.
+    """
+    from telegram.ext import ApplicationBuilder
+
+    token = get_token()
+    if not token:
+        raise RuntimeError("Токен бота не настроен. Установите переменную окружения TELEGRAM_BOT_TOKEN.")
+    configure_runtime()
+    # Очередь запоминает время получения обновлений для контроля допуска
+    builder = ApplicationBuilder().token(token).update_queue(ReceiptQueue(admission))
+    if CONCURRENT_UPDATES > 1:
+        from update_processor import ChatOrderedUpdateProcessor
+
+        update_processor = ChatOrderedUpdateProcessor(CONCURRENT_UPDATES)
+        builder.concurrent_updates(update_processor)
+        metrics.gauge("updates", update_processor.stats)
+    application = builder.build()
+    register_handlers(application)
+    return application
+
+
+# Профилирование запуска
+def profile_startup():
+    """
+    Измеряет время импорта тяжелых библиотек и инициализации бота без
+    подключения к Telegram, без запросов к API курсов и без записи на диск
+    (файлы данных только читаются).
+    Подробный разбор импортов: python -X importtime main.py --profile-startup
+    """
+    import importlib
 
-        # Предварительная загрузка данных
-        loop.run_until_complete(preload_exchange_rates())
+    timings = []
 
-        # Регистрация обработчиков
-        loop.run_until_complete(register_handlers(application))
+    def measure(name, func):
+        started = time.perf_counter()
+        func()
+        timings.append((name, time.perf_counter() - started))
 
-        # Запуск бота
-        logger.info("Бот запущен. Нажмите Ctrl+C для остановки.")
-        loop.run_until_complete(application.run_polling(close_loop=False))
-    except KeyboardInterrupt:
-        logger.info("Бот остановлен пользователем.")
-    except Exception as e:
-        logger.error(f"Критическая ошибка: {e}")
-    finally:
-        if 'loop' in locals() and loop.is_running():
-            tasks = asyncio.all_tasks(loop)
-            for task in tasks:
-                task.cancel()
-            loop.run_until_complete(asyncio.gather(*tasks, return_exceptions=True))
-            loop.run_until_complete(shutdown())
-            if application:
-                loop.run_until_complete(application.shutdown())
-            loop.close()
+    timings.append(("import main (модуль бота)", MODULE_IMPORT_TIME))
+    for module_name in ("aiohttp", "telegram", "telegram.ext"):
+        measure(f"import {module_name}", lambda: importlib.import_module(module_name))
+    measure("configure_runtime", configure_runtime)
+    measure("init_runtime (данные с диска)", init_runtime)
+    measure("create_application", create_application if get_token() else lambda: None)
 
+    total = sum(duration for _, duration in timings)
+    lines = ["Профиль запуска:"]
+    for name, duration in timings:
+        lines.append(f"  {name:<40} {duration * 1000:8.1f} мс")
+    lines.append(f"  {'итого':<40} {total * 1000:8.1f} мс")
+    if not get_token():
+        lines.append("  (create_application пропущен: TELEGRAM_BOT_TOKEN не установлена)")
+    print("\n".join(lines))
 
-import asyncio
 
-if __name__ == "__main__":
-    loop = asyncio.new_event_loop()
-    asyncio.set_event_loop(loop)
+# Точка входа
+def main(argv=None):
+    argv = sys.argv[1:] if argv is None else argv
+    setup_logging()
+    log_environment()
+
+    if "--profile-startup" in argv:
+        profile_startup()
+        return
+
+    # Быстрый режим (uvloop + orjson); через окружение передается и процессам-воркерам
+    if "--fast" in argv:
+        os.environ["FAST_RUNTIME"] = "1"
+    if os.getenv("FAST_RUNTIME", "").lower() in ("1", "true", "yes"):
+        fast_runtime.enable_fast_runtime()
+
+    # Многопроцессный режим: супервизор принимает webhook и раздает обновления воркерам
+    workers_value = os.getenv("WORKERS", "1")
+    if "--workers" in argv:
+        position = argv.index("--workers") + 1
+        workers_value = argv[position] if position < len(argv) else ""
+    try:
+        workers_count = int(workers_value)
+    except ValueError:
+        workers_count = 0
+    if workers_count < 1:
+        logger.error(f"Неверное число воркеров: {workers_value!r}. Использование: python main.py --workers N (N >= 1)")
+        sys.exit(2)
+    if workers_count > 1:
+        import workers
+
+        workers.run_supervisor(workers_count)
+        return
+
+    # Состояние могло остаться от запуска с воркерами
+    reshard_state(1)
+    try:
+        application = create_application()
+    except RuntimeError as e:
+        logger.error(str(e))
+        sys.exit(1)
+
     try:
-        # Предварительная загрузка курсов валют
-        loop.run_until_complete(preload_exchange_rates())
+        asyncio.run(run_bot(application))
+    except Exception as e:
+        logger.error(f"Критическая ошибка: {e}")
 
-        # Создаем объект application
-        application = ApplicationBuilder().token(token).build()
 
-        # Добавляем обработчики команд
-        application.add_handler(CommandHandler("start", start))
-        application.add_handler(CallbackQueryHandler(button_handler))
-        application.add_handler(MessageHandler(filters.TEXT & ~filters.COMMAND, convert_currency))
+MODULE_IMPORT_TIME = time.perf_counter() - MODULE_IMPORT_STARTED
 
-        # Запускаем бота
-        loop.run_until_complete(application.run_polling())
-    finally:
-        # Закрываем ClientSession при завершении работы
-        if not loop.is_closed():
-            loop.run_until_complete(close_connector())
-        loop.close()
\ No newline at end of file
+if __name__ == "__main__":
+    main()
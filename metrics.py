@@ -0,0 +1,92 @@
+# Метрики бота
+# Счетчики увеличиваются в обработчиках; показатели (размер сессий, глубина
+# очереди рассылок и т.п.) вычисляются функциями в момент снятия снимка.
+# Запросы к внешним API учитываются отдельно: успехи, ошибки и время ответа.
+import logging
+import time
+from contextlib import contextmanager
+
+logger = logging.getLogger(__name__)
+
+
+class Metrics:
+    def __init__(self):
+        self.counters = {}
+        self.gauges = {}
+        self.upstream = {}
+
+    def inc(self, name, value=1):
+        self.counters[name] = self.counters.get(name, 0) + value
+
+    def gauge(self, name, func):
+        """
+        Регистрирует показатель. func() возвращает число или словарь {имя: число}.
+        """
+        self.gauges[name] = func
+
+    # Учет одного запроса к внешнему API
+    def record_upstream(self, source, ok, latency, error=None):
+        stats = self.upstream.get(source)
+        if stats is None:
+            stats = self.upstream[source] = {"ok": 0, "errors": 0, "latency_total": 0.0, "latency_max": 0.0, "last_error": None}
+        stats["ok" if ok else "errors"] += 1
+        stats["latency_total"] += latency
+        stats["latency_max"] = max(stats["latency_max"], latency)
+        if error is not None:
+            stats["last_error"] = error
+
+    @contextmanager
+    def track(self, source):
+        """
+        Контекст для запроса к API: исключение внутри блока считается ошибкой.
+        """
+        started = time.perf_counter()
+        try:
+            yield
+        except Exception as e:
+            self.record_upstream(source, False, time.perf_counter() - started, str(e) or type(e).__name__)
+            raise
+        self.record_upstream(source, True, time.perf_counter() - started)
+
+    # Снимок всех метрик
+    def snapshot(self):
+        data = dict(self.counters)
+        for name, func in self.gauges.items():
+            try:
+                value = func()
+            except Exception as e:
+                logger.error(f"Ошибка при вычислении метрики {name}: {e}")
+                continue
+            if isinstance(value, dict):
+                data.update(value)
+            else:
+                data[name] = value
+        for source, stats in self.upstream.items():
+            data[f"upstream_{source}_ok"] = stats["ok"]
+            data[f"upstream_{source}_errors"] = stats["errors"]
+        return data
+
+
+# Потребление памяти процессом (RSS) в байтах
+def get_process_rss():
+    """
+    Текущий RSS из /proc (Linux); на других системах - пиковый RSS из getrusage.
+    """
+    try:
+        with open("/proc/self/status", "r") as f:
+            for line in f:
+                if line.startswith("VmRSS:"):
+                    return int(line.split()[1]) * 1024
+    except OSError:
+        pass
+    try:
+        import resource
+        import sys
+
+        peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        return peak if sys.platform == "darwin" else peak * 1024
+    except (ImportError, OSError):
+        return None
+
+
+metrics = Metrics()
@@ -0,0 +1,176 @@
+# HTTP API курсов только для чтения (включается через RATE_API_PORT)
+# Другие сервисы получают те же курсы, что показывает бот, из его кэша: запросы
+# к API никогда не обращаются к внешним источникам курсов. Версия снимка
+# (время обновления world/regional/crypto и номера обновлений в процессе)
+# служит ETag, поэтому повторный запрос с If-None-Match получает 304 без тела,
+# пока курсы не обновились. Время обновления сохраняется в снимке курсов,
+# поэтому после перезапуска или в другом процессе у других курсов будет другой ETag.
+#
+# GET  /api/rates                          - все курсы (единиц валюты за 1 USD)
+# GET  /api/convert?from=BTC&to=RUB&amount=2 - конвертация одной пары
+# POST /api/convert/batch                  - [{"from": ..., "to": ..., "amount": ...}, ...]
+import logging
+import math
+import secrets
+
+from aiohttp import web
+
+import fast_runtime
+from metrics import metrics
+
+logger = logging.getLogger(__name__)
+
+API_PREFIX = "/api"
+MAX_BATCH_CONVERSIONS = 100
+
+
+class RateApi:
+    """
+    :param main: Модуль бота, из кэша которого берутся курсы.
+    :param token: Если задан, запросы должны содержать заголовок Authorization: Bearer <token>.
+    """
+
+    def __init__(self, main, token=None):
+        self.main = main
+        self.token = token
+        self._snapshot_version = None
+        self._snapshot = {}
+        self._snapshot_body = None
+
+    # Версия курсов: меняется при каждом обновлении любого источника
+    def version(self):
+        versions = self.main.rates_versions
+        updated = "-".join(f"{int((timestamp or 0) * 1000):x}" for timestamp in self.updated().values())
+        return f"{updated}.{versions['world']}.{versions['regional']}.{versions['crypto']}"
+
+    # Объединенный снимок курсов (пересобирается только при смене версии)
+    def snapshot(self):
+        # Запросы к API - такой же спрос на курсы, как запросы пользователей бота
+        self.main.refresh_scheduler.record_demand("world")
+        self.main.refresh_scheduler.record_demand("crypto")
+        version = self.version()
+        if version != self._snapshot_version:
+            self._snapshot = self.main.build_rates_snapshot()
+            self._snapshot_body = None
+            self._snapshot_version = version
+        return self._snapshot
+
+    def updated(self):
+        return {
+            "world": self.main.last_update_world,
+            "regional": self.main.last_update_regional,
+            "crypto": self.main.last_update_crypto,
+        }
+
+    def convert(self, snapshot, item):
+        """
+        :param item: Словарь с ключами from, to и необязательным amount.
+        :return: Результат конвертации или словарь с ключом error.
+        """
+        base = str(item.get("from", "")).upper()
+        quote = str(item.get("to", "")).upper()
+        try:
+            amount = float(item.get("amount", 1))
+        except (TypeError, ValueError):
+            amount = math.nan
+        if not math.isfinite(amount):
+            return {"from": base, "to": quote, "error": "amount должен быть конечным числом"}
+        rate = self.main.get_pair_rate(base, quote, snapshot)
+        if rate is None:
+            return {"from": base, "to": quote, "error": "нет курса для этой пары"}
+        result = amount * rate
+        # Бесконечность в ответе не является корректным JSON
+        if not math.isfinite(result):
+            return {"from": base, "to": quote, "error": "результат слишком велик"}
+        return {"from": base, "to": quote, "amount": amount, "rate": rate, "result": result}
+
+    # Подключение маршрутов API к приложению aiohttp (см. start_rate_api)
+    def add_routes(self, app):
+        api = web.Application(middlewares=[self._authorize])
+        api.router.add_get("/rates", self.handle_rates)
+        api.router.add_get("/convert", self.handle_convert)
+        api.router.add_post("/convert/batch", self.handle_batch)
+        app.add_subapp(API_PREFIX, api)
+
+    @web.middleware
+    async def _authorize(self, request, handler):
+        authorization = request.headers.get("Authorization", "")
+        if self.token and not secrets.compare_digest(authorization, f"Bearer {self.token}"):
+            return self._json({"error": "unauthorized"}, status=401)
+        metrics.inc("rate_api_requests")
+        return await handler(request)
+
+    def _json(self, data, status=200, etag=None, body=None):
+        headers = {"Cache-Control": "no-cache"}
+        if etag:
+            headers["ETag"] = etag
+        return web.Response(
+            text=body if body is not None else fast_runtime.dumps(data),
+            status=status,
+            content_type="application/json",
+            headers=headers,
+        )
+
+    # Ответ 304, если у клиента та же версия курсов
+    def _not_modified(self, request, etag):
+        if etag in (tag.strip() for tag in request.headers.get("If-None-Match", "").split(",")):
+            metrics.inc("rate_api_not_modified")
+            return web.Response(status=304, headers={"ETag": etag, "Cache-Control": "no-cache"})
+        return None
+
+    async def handle_rates(self, request):
+        snapshot = self.snapshot()
+        etag = f'"{self._snapshot_version}"'
+        not_modified = self._not_modified(request, etag)
+        if not_modified:
+            return not_modified
+        if self._snapshot_body is None:
+            self._snapshot_body = fast_runtime.dumps({
+                "base": "USD",
+                "version": self._snapshot_version,
+                "updated": self.updated(),
+                "rates": snapshot,
+            })
+        return self._json(None, etag=etag, body=self._snapshot_body)
+
+    async def handle_convert(self, request):
+        snapshot = self.snapshot()
+        # Результат зависит от версии курсов и параметров запроса
+        etag = f'"{self._snapshot_version}-{request.query_string}"'
+        not_modified = self._not_modified(request, etag)
+        if not_modified:
+            return not_modified
+        result = self.convert(snapshot, request.query)
+        result["version"] = self._snapshot_version
+        status = 400 if "error" in result else 200
+        return self._json(result, status=status, etag=etag if status == 200 else None)
+
+    async def handle_batch(self, request):
+        try:
+            items = fast_runtime.loads(await request.text())
+        except ValueError:
+            return self._json({"error": "тело запроса должно быть JSON-массивом"}, status=400)
+        if not isinstance(items, list) or not all(isinstance(item, dict) for item in items):
+            return self._json({"error": "тело запроса должно быть JSON-массивом объектов"}, status=400)
+        if len(items) > MAX_BATCH_CONVERSIONS:
+            return self._json({"error": f"не больше {MAX_BATCH_CONVERSIONS} конвертаций за запрос"}, status=400)
+        snapshot = self.snapshot()
+        return self._json({
+            "version": self._snapshot_version,
+            "updated": self.updated(),
+            "results": [self.convert(snapshot, item) for item in items],
+        })
+
+
+# Запуск API на отдельном порту (в многопроцессном режиме - в супервизоре)
+async def start_rate_api(main, host, port, token=None):
+    """
+    :return: AppRunner; при остановке вызывается runner.cleanup().
+    """
+    app = web.Application()
+    RateApi(main, token).add_routes(app)
+    runner = web.AppRunner(app)
+    await runner.setup()
+    await web.TCPSite(runner, host=host, port=port).start()
+    logger.info(f"API курсов запущено на {host}:{port}{API_PREFIX}.")
+    return runner
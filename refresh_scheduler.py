@@ -0,0 +1,222 @@
+# Адаптивные интервалы обновления курсов и бюджеты запросов к API
+# Интервал каждого источника подстраивается под то, насколько менялись курсы
+# между обновлениями: курсы exchangerate-api меняются раз в сутки, и интервал
+# растет до максимума, а криптовалюты меняются постоянно, и интервал
+# сокращается, пока изменение за интервал не станет близко к целевому.
+# Если курсы источника с прошлого обновления никто не запрашивал, интервал
+# увеличивается независимо от изменения курсов.
+# Бюджеты ограничивают число запросов (кредитов) к каждому API за
+# календарный месяц: расход распределяется равномерно по месяцу, поэтому
+# квота не заканчивается раньше его конца.
+import calendar
+import json
+import logging
+import os
+import time
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_TARGET_CHANGE = 0.005  # Целевое изменение курсов за интервал (0.5%)
+CHANGE_PERCENTILE = 0.9  # Изменение оценивается по 90-му перцентилю курсов
+MAX_INTERVAL_STEP = 2.0  # Интервал меняется не больше чем вдвое за одно обновление
+BUDGET_BURST_FRACTION = 0.02  # Сколько месячного бюджета можно потратить сверх равномерного расхода
+
+
+class RefreshScheduler:
+    """
+    :param intervals: {источник: (начальный, минимальный, максимальный интервал в секундах)}.
+    :param target_change: Желаемое относительное изменение курсов между обновлениями.
+    """
+
+    def __init__(self, intervals, target_change=DEFAULT_TARGET_CHANGE):
+        self.target_change = target_change
+        self.limits = {source: (low, high) for source, (_, low, high) in intervals.items()}
+        self.intervals = {source: max(low, min(high, initial)) for source, (initial, low, high) in intervals.items()}
+        self.changes = {source: None for source in intervals}
+        self.demand = {source: 0 for source in intervals}
+        # В супервизоре запросы пользователей обрабатывают воркеры, и спрос не виден
+        self.track_demand = True
+
+    def interval(self, source):
+        return self.intervals[source]
+
+    # Можно ли использовать курсы, обновленные в last_update
+    def is_fresh(self, source, last_update, now=None):
+        return bool(last_update) and (now or time.time()) - last_update < self.intervals[source]
+
+    # Обращение пользователя к курсам источника
+    def record_demand(self, source):
+        self.demand[source] += 1
+
+    # Учет нового ответа источника
+    def observe(self, source, old_rates, new_rates):
+        """
+        Пересчитывает интервал по изменению курсов с прошлого обновления.
+        """
+        change = rates_change(old_rates, new_rates)
+        if change is None:
+            return
+        self.changes[source] = change
+        if change == 0 or (self.track_demand and not self.demand[source]):
+            factor = MAX_INTERVAL_STEP
+        else:
+            factor = min(MAX_INTERVAL_STEP, max(1 / MAX_INTERVAL_STEP, self.target_change / change))
+        low, high = self.limits[source]
+        old_interval = self.intervals[source]
+        self.intervals[source] = max(low, min(high, old_interval * factor))
+        self.demand[source] = 0
+        if self.intervals[source] != old_interval:
+            logger.info(
+                f"Интервал обновления {source}: {old_interval:.0f} -> {self.intervals[source]:.0f} с "
+                f"(изменение курсов {change * 100:.3f}%)",
+                extra={"event": "refresh_interval"},
+            )
+
+    def stats(self):
+        data = {}
+        for source, interval in self.intervals.items():
+            data[f"refresh_interval_{source}"] = round(interval)
+            if self.changes[source] is not None:
+                data[f"rates_change_{source}_pct"] = round(self.changes[source] * 100, 3)
+        return data
+
+
+# Относительное изменение курсов (перцентиль по всем валютам)
+def rates_change(old_rates, new_rates):
+    if not old_rates or not new_rates:
+        return None
+    changes = sorted(
+        abs(new_rates[code] / old_rates[code] - 1)
+        for code in old_rates.keys() & new_rates.keys()
+        if old_rates[code] and new_rates[code]
+    )
+    if not changes:
+        return None
+    return changes[min(len(changes) - 1, int(len(changes) * CHANGE_PERCENTILE))]
+
+
+# Начало текущего календарного месяца (UTC) и его длительность
+def month_bounds(now):
+    year, month = time.gmtime(now)[:2]
+    start = calendar.timegm((year, month, 1, 0, 0, 0))
+    return start, calendar.monthrange(year, month)[1] * 86400
+
+
+class ApiBudgets:
+    """
+    Месячные бюджеты запросов к внешним API. Расходуются кредиты: для
+    CoinMarketCap - по правилам тарифа, для остальных API - один за запрос.
+    Расход сохраняется в файл вызовом flush() (фоновым обновлением курсов и
+    при остановке), чтобы перезапуск не обнулял счетчик; запросы к API сами
+    файл не пишут.
+    """
+
+    def __init__(self):
+        self.limits = {}
+        self.path = None
+        self.read_only = False
+        self.month = None
+        self.used = {}
+        self.denied = {}
+        self.dirty = False
+
+    # Настройка лимитов {api: кредитов в месяц}; 0 или None - без ограничения
+    def configure(self, limits, path=None, read_only=False):
+        """
+        :param read_only: Файл расхода только читается (воркеры: API запрашивает супервизор).
+        """
+        self.limits = {api: limit for api, limit in limits.items() if limit}
+        self.path = path
+        self.read_only = read_only
+
+    def load(self):
+        if not self.path or not os.path.exists(self.path):
+            return
+        try:
+            with open(self.path, "r", encoding="utf-8") as f:
+                data = json.load(f)
+        except (OSError, ValueError) as e:
+            logger.error(f"Ошибка при загрузке расхода API из {self.path}: {e}")
+            return
+        self.month = data.get("month")
+        self.used = data.get("used", {})
+
+    def flush(self):
+        if not self.dirty or not self.path or self.read_only:
+            return
+        directory = os.path.dirname(self.path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        tmp_path = f"{self.path}.tmp"
+        try:
+            with open(tmp_path, "w", encoding="utf-8") as f:
+                json.dump({"month": self.month, "used": self.used}, f)
+            os.replace(tmp_path, self.path)
+            self.dirty = False
+        except OSError as e:
+            logger.error(f"Ошибка при сохранении расхода API в {self.path}: {e}")
+
+    # Сброс счетчиков в начале нового месяца
+    def _roll(self, now):
+        month = time.strftime("%Y-%m", time.gmtime(now))
+        if month != self.month:
+            self.month = month
+            self.used = {}
+            self.dirty = True
+
+    # Сколько кредитов можно было потратить к текущему моменту
+    def allowance(self, api, now=None):
+        now = now or time.time()
+        limit = self.limits[api]
+        start, length = month_bounds(now)
+        return min(limit, limit * ((now - start) / length + BUDGET_BURST_FRACTION))
+
+    # Можно ли потратить cost кредитов сейчас
+    def allow(self, api, cost=1, now=None):
+        if api not in self.limits:
+            return True
+        now = now or time.time()
+        self._roll(now)
+        if self.used.get(api, 0) + cost <= self.allowance(api, now):
+            return True
+        self.denied[api] = self.denied.get(api, 0) + 1
+        logger.warning(
+            f"Бюджет запросов к {api} исчерпан на текущий момент: потрачено {self.used.get(api, 0)} "
+            f"из {self.limits[api]} за месяц",
+            extra={"event": "api_budget"},
+        )
+        return False
+
+    def spend(self, api, cost=1, now=None):
+        self._roll(now or time.time())
+        self.used[api] = self.used.get(api, 0) + cost
+        self.dirty = True
+
+    def stats(self):
+        data = {}
+        for api in sorted(self.used.keys() | self.limits.keys() | self.denied.keys()):
+            data[f"api_used_{api}"] = self.used.get(api, 0)
+            data[f"api_denied_{api}"] = self.denied.get(api, 0)
+        return data
+
+    # Строки для /stats
+    def describe(self, now=None):
+        now = now or time.time()
+        # Расход ведет другой процесс: показывается его последнее сохраненное состояние
+        if self.read_only:
+            self.load()
+        self._roll(now)
+        lines = []
+        for api in sorted(self.used.keys() | self.limits.keys()):
+            used = self.used.get(api, 0)
+            if api in self.limits:
+                lines.append(
+                    f"{api}: {used} из {self.limits[api]} за месяц "
+                    f"(доступно сейчас {self.allowance(api, now) - used:.0f}, отказов {self.denied.get(api, 0)})"
+                )
+            else:
+                lines.append(f"{api}: {used} за месяц, без ограничения")
+        return lines
+
+
+api_budgets = ApiBudgets()
@@ -0,0 +1,162 @@
+# Состояние диалога пользователя (шаг конвертации и выбранные валюты)
+# Сессии хранятся в OrderedDict в порядке последнего обращения: давно не
+# использованные сессии удаляются с начала словаря по времени простоя (TTL)
+# и при превышении максимального количества (LRU).
+import enum
+import logging
+import os
+import sys
+import time
+from collections import OrderedDict
+
+import fast_runtime
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_MAX_SESSIONS = 100000
+DEFAULT_SESSION_TTL = 86400
+
+
+class Step(str, enum.Enum):
+    SEARCH_CURRENCY = "search_currency"
+    SELECT_FROM = "select_from_currency"
+    SELECT_FROM_CRYPTO = "select_from_crypto_currency"
+    SELECT_TO = "select_to_currency"
+    SELECT_TO_CRYPTO = "select_to_currency_crypto"
+    ENTER_AMOUNT = "enter_amount"
+    ENTER_AMOUNT_CRYPTO = "enter_amount_crypto"
+
+
+class Session:
+    """
+    Состояние одного пользователя. Коды валют интернируются, поэтому все
+    сессии ссылаются на одни и те же строки.
+    """
+
+    __slots__ = ("step", "from_currency", "to_currency", "touched")
+
+    def __init__(self, step=None, from_currency=None, to_currency=None, touched=0.0):
+        self.step = step
+        self.from_currency = sys.intern(from_currency) if from_currency else None
+        self.to_currency = sys.intern(to_currency) if to_currency else None
+        self.touched = touched
+
+    def set_from(self, currency):
+        self.from_currency = sys.intern(currency)
+
+    def set_to(self, currency):
+        self.to_currency = sys.intern(currency)
+
+    def reset(self):
+        self.step = None
+        self.from_currency = None
+        self.to_currency = None
+
+
+class SessionStore:
+    """
+    Сессии пользователей с вытеснением по простою и по количеству.
+    """
+
+    def __init__(self, max_sessions=DEFAULT_MAX_SESSIONS, ttl=DEFAULT_SESSION_TTL):
+        self.max_sessions = max_sessions
+        self.ttl = ttl
+        self.sessions = OrderedDict()
+        self.evicted_idle = 0
+        self.evicted_lru = 0
+
+    def __len__(self):
+        return len(self.sessions)
+
+    # Сессия пользователя (создается при первом обращении)
+    def get(self, user_id):
+        now = time.time()
+        self.evict_idle(now)
+        session = self.sessions.get(user_id)
+        if session is None:
+            session = Session()
+            self.sessions[user_id] = session
+            while len(self.sessions) > self.max_sessions:
+                self.sessions.popitem(last=False)
+                self.evicted_lru += 1
+        else:
+            self.sessions.move_to_end(user_id)
+        session.touched = now
+        return session
+
+    def drop(self, user_id):
+        self.sessions.pop(user_id, None)
+
+    # Удаление сессий, простаивающих дольше ttl
+    def evict_idle(self, now=None):
+        """
+        Сессии упорядочены по времени обращения, поэтому проверяется только
+        начало словаря.
+        """
+        deadline = (now or time.time()) - self.ttl
+        evicted = 0
+        while self.sessions:
+            user_id, session = next(iter(self.sessions.items()))
+            if session.touched >= deadline:
+                break
+            del self.sessions[user_id]
+            evicted += 1
+        self.evicted_idle += evicted
+        return evicted
+
+    # Оценка занимаемой памяти
+    def memory_bytes(self):
+        """
+        Размер словаря и объектов сессий; строки кодов валют интернированы
+        и не учитываются.
+        """
+        if not self.sessions:
+            return sys.getsizeof(self.sessions)
+        sample_key, sample_session = next(iter(self.sessions.items()))
+        per_session = sys.getsizeof(sample_session) + sys.getsizeof(sample_key)
+        return sys.getsizeof(self.sessions) + per_session * len(self.sessions)
+
+    def stats(self):
+        return {
+            "sessions": len(self.sessions),
+            "sessions_bytes": self.memory_bytes(),
+            "sessions_evicted_idle": self.evicted_idle,
+            "sessions_evicted_lru": self.evicted_lru,
+        }
+
+    # Сохранение сессий для следующего процесса (плавный перезапуск)
+    def save(self, path):
+        directory = os.path.dirname(path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        data = {
+            str(user_id): [s.step.value if s.step else None, s.from_currency, s.to_currency, s.touched]
+            for user_id, s in self.sessions.items()
+            if s.step
+        }
+        tmp_path = f"{path}.tmp"
+        try:
+            with open(tmp_path, "w", encoding="utf-8") as f:
+                f.write(fast_runtime.dumps(data))
+            os.replace(tmp_path, path)
+        except OSError as e:
+            logger.error(f"Ошибка при сохранении сессий в {path}: {e}")
+
+    def load(self, path):
+        if not os.path.exists(path):
+            return
+        try:
+            with open(path, "r", encoding="utf-8") as f:
+                data = fast_runtime.loads(f.read())
+        except (OSError, ValueError) as e:
+            logger.error(f"Ошибка при загрузке сессий из {path}: {e}")
+            return
+        # Порядок по времени обращения, чтобы вытеснение по простою работало с начала словаря
+        for user_id, (step, from_currency, to_currency, touched) in sorted(data.items(), key=lambda item: item[1][3]):
+            try:
+                step = Step(step) if step else None
+            except ValueError:
+                continue
+            self.sessions[int(user_id)] = Session(step, from_currency, to_currency, touched)
+        self.evict_idle()
+        logger.info(f"Загружено сессий: {len(self.sessions)}")
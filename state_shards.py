@@ -0,0 +1,144 @@
+# Распределение состояния чатов по файлам воркеров
+# В многопроцессном режиме воркер k хранит состояние своих чатов
+# (chat_id % N == k) в файлах *.w{k}.json, в обычном режиме все хранится в
+# одном файле. При запуске проверяется, что каждый чат лежит в файле своего
+# воркера; если нет, состояние из всех найденных файлов собирается и
+# раскладывается под текущее число процессов, поэтому переход между режимами
+# и смена WORKERS не теряют оповещения, подписки, избранное и сессии.
+import glob
+import json
+import logging
+import os
+import re
+import shutil
+
+logger = logging.getLogger(__name__)
+
+SHARD_SUFFIX = re.compile(r"\.w(\d+)\.json$")
+
+
+# Файл воркера index для файла состояния path
+def shard_path(path, index):
+    return f"{os.path.splitext(path)[0]}.w{index}.json"
+
+
+# Файлы, в которых должно лежать состояние при count процессах
+def target_paths(path, count):
+    return [path] if count == 1 else [shard_path(path, index) for index in range(count)]
+
+
+# Все существующие файлы состояния (общий и файлы воркеров)
+def existing_paths(path):
+    paths = [path] if os.path.exists(path) else []
+    for candidate in sorted(glob.glob(f"{glob.escape(os.path.splitext(path)[0])}.w*.json")):
+        if SHARD_SUFFIX.search(candidate):
+            paths.append(candidate)
+    return paths
+
+
+def shard_index(chat_id, count):
+    return abs(int(chat_id)) % count
+
+
+def _read(path):
+    try:
+        with open(path, "r", encoding="utf-8") as f:
+            return json.load(f)
+    except (OSError, ValueError) as e:
+        logger.error(f"Ошибка при чтении {path}: {e}")
+        return None
+
+
+def _write(path, data):
+    directory = os.path.dirname(path)
+    if directory:
+        os.makedirs(directory, exist_ok=True)
+    tmp_path = f"{path}.tmp"
+    with open(tmp_path, "w", encoding="utf-8") as f:
+        json.dump(data, f, ensure_ascii=False)
+    os.replace(tmp_path, path)
+
+
+# Лежит ли каждый чат в файле своего воркера
+def is_placed(contents, targets, count, keys):
+    for index, target in enumerate(targets):
+        data = contents.get(target)
+        if data is not None and any(shard_index(key, count) != index for key in keys(data)):
+            return False
+    return True
+
+
+# Перераспределение одного файла состояния
+def reshard_file(path, count, split, keys):
+    """
+    :param split: Функция split(список прочитанных данных, count) -> список данных по файлам.
+    :param keys: Функция keys(данные файла) -> chat_id, хранящиеся в файле.
+    :return: True, если файлы были переписаны.
+    """
+    sources = existing_paths(path)
+    targets = target_paths(path, count)
+    if not sources:
+        return False
+    contents = {source: _read(source) for source in sources}
+    if set(sources) <= set(targets) and is_placed(contents, targets, count, keys):
+        return False
+    parts = [data for data in contents.values() if data is not None]
+    # Сначала пишутся новые файлы, потом удаляются старые: при сбое состояние дублируется, а не теряется
+    for target, data in zip(targets, split(parts, count)):
+        _write(target, data)
+    for source in sources:
+        if source not in targets:
+            os.remove(source)
+    logger.info(f"Состояние {os.path.basename(path)} перераспределено: {len(sources)} файлов -> {len(targets)}")
+    return True
+
+
+# Файлы вида {chat_id: значение} (подписки, избранное, сессии)
+def mapping_keys(data):
+    return data.keys()
+
+
+def split_mapping(parts, count):
+    shards = [{} for _ in range(count)]
+    for part in parts:
+        for key, value in part.items():
+            shards[shard_index(key, count)][key] = value
+    return shards
+
+
+# Файл оповещений: номера оповещений переназначаются, чтобы не совпадали
+def alert_keys(data):
+    return (alert["chat_id"] for alert in data.get("alerts", []))
+
+
+def split_alerts(parts, count):
+    last_rates = {}
+    alerts = []
+    for part in parts:
+        last_rates.update(part.get("last_rates", {}))
+        alerts.extend(part.get("alerts", []))
+    shards = [{"next_id": 1, "alerts": [], "last_rates": last_rates} for _ in range(count)]
+    for next_id, alert in enumerate(alerts, 1):
+        shard = shards[shard_index(alert["chat_id"], count)]
+        shard["alerts"].append({**alert, "id": next_id})
+    for shard in shards:
+        shard["next_id"] = len(alerts) + 1
+    return shards
+
+
+# Незавершенные рассылки: отправить их может любой процесс, файлы переносятся целиком
+def reshard_broadcasts(directory, count):
+    target = directory if count == 1 else os.path.join(directory, "w0")
+    allowed = {directory} if count == 1 else {os.path.join(directory, f"w{index}") for index in range(count)}
+    sources = [directory] + sorted(glob.glob(os.path.join(glob.escape(directory), "w*")))
+    moved = 0
+    for source in sources:
+        if source in allowed or not os.path.isdir(source):
+            continue
+        for filename in os.listdir(source):
+            if filename.endswith((".json", ".pos")):
+                os.makedirs(target, exist_ok=True)
+                shutil.move(os.path.join(source, filename), os.path.join(target, filename))
+                moved += 1
+    if moved:
+        logger.info(f"Перенесено файлов незавершенных рассылок: {moved}")
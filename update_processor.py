@@ -0,0 +1,83 @@
+# Параллельная обработка обновлений с сохранением порядка внутри чата
+# Обновления разных чатов обрабатываются одновременно (не больше limit сразу),
+# а обновления одного чата - строго по очереди, чтобы шаги диалога (сессия
+# пользователя) не менялись двумя обработчиками одновременно.
+import asyncio
+import contextlib
+import logging
+
+from telegram.ext import BaseUpdateProcessor
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_CONCURRENT_UPDATES = 32
+# Ограничение библиотеки не используется: обновление сначала ждет своей
+# очереди в чате и только потом занимает место среди limit одновременных,
+# иначе один чат с пачкой обновлений занял бы все места ожиданием.
+UNBOUNDED_UPDATES = 1 << 30
+
+
+# Чат (или пользователь), к которому относится обновление
+def get_update_key(update):
+    chat = getattr(update, "effective_chat", None)
+    if chat is not None:
+        return chat.id
+    user = getattr(update, "effective_user", None)
+    if user is not None:
+        return user.id
+    return None
+
+
+class ChatOrderedUpdateProcessor(BaseUpdateProcessor):
+    """
+    :param limit: Сколько обновлений обрабатывается одновременно.
+    """
+
+    __slots__ = ("limit", "pending", "chat_locks", "_slots")
+
+    def __init__(self, limit=DEFAULT_CONCURRENT_UPDATES):
+        super().__init__(UNBOUNDED_UPDATES)
+        self.limit = limit
+        self.pending = 0  # Получены, но еще не обработаны
+        self.chat_locks = {}  # chat_id -> [блокировка, число ожидающих обновлений]
+        self._slots = asyncio.Semaphore(limit)
+
+    async def do_process_update(self, update, coroutine):
+        self.pending += 1
+        try:
+            key = get_update_key(update)
+            if key is None:
+                async with self._slots:
+                    await coroutine
+                return
+            async with self.chat_lock(key), self._slots:
+                await coroutine
+        finally:
+            self.pending -= 1
+
+    # Очередь чата; ее же занимают фоновые задачи, редактирующие сообщения чата
+    @contextlib.asynccontextmanager
+    async def chat_lock(self, key):
+        entry = self.chat_locks.get(key)
+        if entry is None:
+            entry = self.chat_locks[key] = [asyncio.Lock(), 0]
+        entry[1] += 1
+        try:
+            async with entry[0]:
+                yield
+        finally:
+            entry[1] -= 1
+            if not entry[1]:
+                del self.chat_locks[key]
+
+    async def initialize(self):
+        pass
+
+    async def shutdown(self):
+        pass
+
+    def stats(self):
+        return {
+            "updates_pending": self.pending,
+            "updates_chats_waiting": len(self.chat_locks),
+        }
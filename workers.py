@@ -0,0 +1,245 @@
+# Многопроцессный режим бота
+# Супервизор принимает обновления Telegram через webhook, обновляет курсы и
+# записывает общий снимок курсов; каждое обновление передается воркеру по
+# номеру чата (chat_id % N), так что все состояние чата (сессия, оповещения,
+# подписки, рассылки) живет в одном процессе и не требует синхронизации.
+import asyncio
+import logging
+import multiprocessing
+import os
+import signal
+import time
+
+logger = logging.getLogger(__name__)
+
+WORKER_RESTART_CHECK_INTERVAL = 5
+WEBHOOK_PATH = "/telegram"
+
+
+# Определение чата, к которому относится обновление
+def get_update_chat_id(data):
+    """
+    Возвращает chat_id из JSON-обновления Telegram или None.
+    """
+    for key in ("message", "edited_message", "channel_post", "edited_channel_post"):
+        if key in data:
+            return data[key]["chat"]["id"]
+    callback_query = data.get("callback_query")
+    if callback_query:
+        message = callback_query.get("message")
+        if message:
+            return message["chat"]["id"]
+        return callback_query["from"]["id"]
+    for key in ("inline_query", "chosen_inline_result", "my_chat_member", "chat_member"):
+        if key in data:
+            item = data[key]
+            if "chat" in item:
+                return item["chat"]["id"]
+            return item["from"]["id"]
+    return None
+
+
+# Номер воркера для обновления
+def get_worker_index(data, workers_count):
+    chat_id = get_update_chat_id(data)
+    if chat_id is None:
+        return 0
+    return abs(chat_id) % workers_count
+
+
+# Точка входа процесса-воркера
+def worker_process(index, count, updates, started_at):
+    """
+    Запускается в отдельном процессе (spawn): обрабатывает обновления,
+    которые супервизор кладет в очередь updates. None - сигнал остановки.
+
+    :param started_at: Время запуска супервизора: очередь, накопившаяся до
+        запуска, приходит в супервизор, а перезапуск воркера ее не создает.
+    """
+    import main
+    from logging_setup import setup_logging
+
+    setup_logging()
+    if os.getenv("FAST_RUNTIME", "").lower() in ("1", "true", "yes"):
+        main.fast_runtime.enable_fast_runtime()
+    main.configure_worker(index, count)
+    # Остановкой управляет супервизор через очередь
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    signal.signal(signal.SIGTERM, signal.SIG_IGN)
+    asyncio.run(run_worker(main, index, updates, started_at))
+
+
+async def run_worker(main, index, updates, started_at):
+    from telegram import Update
+
+    application = main.create_application()
+    loop = asyncio.get_running_loop()
+    await application.initialize()
+    await main.on_startup(application)
+    await application.start()
+    main.admission.mark_started(started_at)
+    logger.info(f"Воркер {index} запущен (pid {os.getpid()}).")
+    try:
+        while True:
+            item = await loop.run_in_executor(None, updates.get)
+            if item is None:
+                break
+            # Время получения обновления супервизором: ожидание в очереди воркера тоже считается
+            received_at, data = item
+            try:
+                update = Update.de_json(data, application.bot)
+                main.admission.stamp(update.update_id, received_at)
+                await application.update_queue.put(update)
+            except Exception as e:
+                logger.error(f"Воркер {index}: ошибка при разборе обновления: {e}")
+    finally:
+        await main.drain_application(application)
+        await main.shutdown(application)
+        await application.shutdown()
+        logger.info(f"Воркер {index} остановлен.")
+
+
+class Supervisor:
+    """
+    Запускает N воркеров, раздает им обновления и перезапускает упавшие процессы.
+    """
+
+    def __init__(self, workers_count):
+        self.workers_count = workers_count
+        self.context = multiprocessing.get_context("spawn")
+        self.queues = [self.context.Queue() for _ in range(workers_count)]
+        self.processes = [None] * workers_count
+        self.stopping = False
+        self.started_at = time.time()
+
+    def start_worker(self, index):
+        process = self.context.Process(
+            target=worker_process,
+            args=(index, self.workers_count, self.queues[index], self.started_at),
+            name=f"bot-worker-{index}",
+            daemon=True,
+        )
+        process.start()
+        self.processes[index] = process
+        logger.info(f"Запущен воркер {index} (pid {process.pid}).")
+
+    def start(self):
+        for index in range(self.workers_count):
+            self.start_worker(index)
+
+    def dispatch(self, data):
+        self.queues[get_worker_index(data, self.workers_count)].put((time.time(), data))
+
+    # Перезапуск упавших воркеров
+    async def watch(self):
+        while not self.stopping:
+            await asyncio.sleep(WORKER_RESTART_CHECK_INTERVAL)
+            for index, process in enumerate(self.processes):
+                if not self.stopping and process is not None and not process.is_alive():
+                    logger.error(f"Воркер {index} завершился с кодом {process.exitcode}, перезапуск.")
+                    self.start_worker(index)
+
+    def stop(self, timeout=30):
+        self.stopping = True
+        for updates in self.queues:
+            updates.put(None)
+        for index, process in enumerate(self.processes):
+            if process is None:
+                continue
+            process.join(timeout)
+            if process.is_alive():
+                logger.warning(f"Воркер {index} не остановился за {timeout} с., принудительное завершение.")
+                process.terminate()
+
+
+async def run_supervisor_async(main, workers_count):
+    from aiohttp import web
+    from telegram import Bot
+
+    webhook_url = os.getenv("WEBHOOK_URL")
+    if not webhook_url:
+        raise RuntimeError("Для режима с воркерами нужен webhook: установите переменную окружения WEBHOOK_URL.")
+    webhook_secret = os.getenv("WEBHOOK_SECRET")
+    port = main.env_number("WEBHOOK_PORT", main.env_number("PORT", 8080))
+
+    main.PROCESS_ROLE = "supervisor"
+    main.configure_runtime()
+    main.crypto_universe.load()
+    main.api_budgets.load()
+    # Запросы пользователей обрабатывают воркеры: интервалы подстраиваются только под изменение курсов
+    main.refresh_scheduler.track_demand = False
+    # Курсы из снимка предыдущего запуска; из API запрашиваются только устаревшие
+    has_snapshot = main.load_rates_snapshot()
+    await main.preload_exchange_rates(force_update=not has_snapshot)
+
+    # Состояние чатов раскладывается под текущее число воркеров до их запуска
+    main.reshard_state(workers_count)
+    supervisor = Supervisor(workers_count)
+    supervisor.start()
+
+    async def handle_update(request):
+        if webhook_secret and request.headers.get("X-Telegram-Bot-Api-Secret-Token") != webhook_secret:
+            return web.Response(status=403)
+        try:
+            data = await request.json()
+        except ValueError:
+            return web.Response(status=400)
+        supervisor.dispatch(data)
+        return web.Response()
+
+    app = web.Application()
+    app.router.add_post(WEBHOOK_PATH, handle_update)
+    runner = web.AppRunner(app)
+    await runner.setup()
+    site = web.TCPSite(runner, port=port)
+    await site.start()
+
+    # API курсов обслуживает супервизор: у него самые свежие курсы
+    rate_api_runner = None
+    if main.RATE_API_PORT:
+        from rate_api import start_rate_api
+
+        rate_api_runner = await start_rate_api(main, main.RATE_API_HOST, main.RATE_API_PORT, main.RATE_API_TOKEN)
+
+    bot = Bot(main.get_token())
+    async with bot:
+        await bot.set_webhook(
+            url=webhook_url.rstrip("/") + WEBHOOK_PATH,
+            secret_token=webhook_secret,
+            allowed_updates=["message", "edited_message", "callback_query"],
+        )
+    logger.info(f"Супервизор запущен: {workers_count} воркеров, webhook на порту {port}.")
+
+    stop_event = asyncio.Event()
+    loop = asyncio.get_running_loop()
+    for sig in (signal.SIGINT, signal.SIGTERM):
+        loop.add_signal_handler(sig, stop_event.set)
+
+    tasks = [asyncio.create_task(supervisor.watch()), asyncio.create_task(main.refresh_rates_periodically())]
+    try:
+        await stop_event.wait()
+    finally:
+        logger.info("Остановка супервизора...")
+        await runner.cleanup()
+        if rate_api_runner is not None:
+            await rate_api_runner.cleanup()
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+        await loop.run_in_executor(None, supervisor.stop)
+        main.api_budgets.flush()
+        await main.close_connector()
+        logger.info("Супервизор остановлен.")
+
+
+# Запуск бота в многопроцессном режиме
+def run_supervisor(workers_count):
+    """
+    :param workers_count: Количество процессов-воркеров.
+    """
+    import main
+
+    try:
+        asyncio.run(run_supervisor_async(main, workers_count))
+    except RuntimeError as e:
+        logger.error(str(e))